@@ -56,6 +56,21 @@ class Worker:
             ps_args["parameters_file"]=self.config.parameters_file
         ps_args["spectra_listfile"]=spectra_listfile
         ps_args["logdir"]=log_dir
+        ps_args["output_mode"]=self.config.output_mode
+        ps_args["flush_size"]=str(self.config.flush_size)
+        ps_args["flush_interval"]=str(self.config.flush_interval)
+        ps_args["journal"]=self.config.journal
+        ps_args["write_behind"]=self.config.write_behind
+        ps_args["prefetch_depth"]=str(self.config.prefetch_depth)
+        ps_args["prefetch_memory"]=str(self.config.prefetch_memory)
+        ps_args["prescreen_min_valid"]=str(self.config.prescreen_min_valid)
+        if self.config.prescreen_target_types:
+            ps_args["prescreen_target_types"]=str(self.config.prescreen_target_types)
+        ps_args["output_backend"]=self.config.output_backend
+        if self.config.output_mode == 'service':
+            ps_args["writer_address"]=self.config.writer_address
+        if self.config.coadd_cache:
+            ps_args["coadd_cache"]=self.config.coadd_cache
 
         ps_args_list = ["process_spectra"]
         for k,v in ps_args.items():
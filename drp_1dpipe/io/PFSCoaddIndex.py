@@ -0,0 +1,130 @@
+import io
+import os
+import numpy as np
+from astropy.io import fits
+from pfs.datamodel.drp import PfsCoadd, PfsCalibrated
+
+# index of the i-th input file of a run
+INDEX_FILENAME = "pfsCoaddIndex-%d.fits"
+
+# rows of MASK read at once when counting valid pixels
+MASK_CHUNK = 1024
+
+
+def get_spectra_class(path):
+    """Datamodel class of a pfsCoadd or pfsCalibrated file, from its name"""
+    if os.path.basename(path).startswith("pfsCalibrated"):
+        return PfsCalibrated
+    return PfsCoadd
+
+
+def write_coadd_index(coadd_file, path):
+    """Write the object index of a pfsCoadd or pfsCalibrated file
+
+    The index gives for each objId its row in the per-target HDUs, its
+    targetId, catId, number of visits and number of unmasked pixels.
+
+    Parameters
+    ----------
+    coadd_file : str
+        Path of the pfsCoadd or pfsCalibrated file
+    path : str
+        Path of the index file
+    """
+    with fits.open(coadd_file, memmap=True) as hdulist:
+        target = hdulist["TARGET"].data
+        nb_targets = len(target)
+        index = np.zeros(nb_targets, dtype=[("objId", ">i8"), ("row", ">i4"), ("targetId", ">i4"),
+                                            ("catId", ">i4"), ("nVisit", ">i4"), ("nValid", ">i4")])
+        index["objId"] = target["objId"]
+        index["row"] = np.arange(nb_targets)
+        index["targetId"] = target["targetId"]
+        index["catId"] = target["catId"]
+        visits_target_ids, nb_visits = np.unique(hdulist["OBSERVATIONS"].data["targetId"],
+                                                 return_counts=True)
+        index["nVisit"] = nb_visits[np.searchsorted(visits_target_ids, index["targetId"])]
+        mask = hdulist["MASK"].data
+        for start in range(0, nb_targets, MASK_CHUNK):
+            chunk = mask[start:start + MASK_CHUNK]
+            index["nValid"][start:start + MASK_CHUNK] = np.count_nonzero(
+                chunk.reshape(len(chunk), -1) == 0, axis=1)
+    fits.BinTableHDU(index, name="INDEX").writeto(path, overwrite=True)
+
+
+def read_coadd_index(path):
+    """Read an object index written by `write_coadd_index`
+
+    Return
+    ------
+    :obj:`numpy.ndarray`
+        Index rows
+    """
+    with fits.open(path) as hdulist:
+        return np.array(hdulist["INDEX"].data)
+
+
+def find_coadd_rows(coadd_file, object_ids):
+    """Rows of some objIds in the per-target HDUs of a pfsCoadd or pfsCalibrated file
+
+    Only the TARGET table is read, the file being memory mapped.
+
+    Parameters
+    ----------
+    coadd_file : str
+        Path of the pfsCoadd or pfsCalibrated file
+    object_ids : list
+        objIds of the spectra
+
+    Return
+    ------
+    :obj:`numpy.ndarray`
+        Rows of the spectra found in the file
+    """
+    with fits.open(coadd_file, memmap=True) as hdulist:
+        selected = np.isin(hdulist["TARGET"].data["objId"], [int(object_id) for object_id in object_ids])
+        return np.flatnonzero(selected)
+
+
+def read_coadd_rows(coadd_file, rows):
+    """Extract some spectra of a pfsCoadd or pfsCalibrated file
+
+    Only the selected rows are read, the file being memory mapped. Tables
+    with a targetId column are filtered on the targetId of the selected
+    spectra, tables and images with one row per target on their row.
+    Other HDUs are copied.
+
+    Parameters
+    ----------
+    coadd_file : str
+        Path of the pfsCoadd or pfsCalibrated file
+    rows : list
+        Rows of the spectra in the per-target HDUs
+
+    Return
+    ------
+    :obj:`io.BytesIO`
+        FITS file holding the selected spectra only, to be read with the
+        class given by `get_spectra_class`
+    """
+    rows = np.sort(np.asarray(rows, dtype=int))
+    subset = fits.HDUList()
+    with fits.open(coadd_file, memmap=True) as hdulist:
+        nb_targets = hdulist["TARGET"].header["NAXIS2"]
+        target_ids = hdulist["TARGET"].data["targetId"][rows]
+        subset.append(fits.PrimaryHDU(header=hdulist[0].header))
+        for hdu in hdulist[1:]:
+            if isinstance(hdu, fits.BinTableHDU):
+                data = hdu.data
+                if "targetId" in hdu.columns.names:
+                    data = data[np.isin(data["targetId"], target_ids)]
+                elif len(data) == nb_targets:
+                    data = data[rows]
+                subset.append(fits.BinTableHDU(data, header=hdu.header, name=hdu.name))
+            elif hdu.data is not None and hdu.data.shape[0] == nb_targets:
+                subset.append(fits.ImageHDU(hdu.data[rows], header=hdu.header, name=hdu.name))
+            else:
+                subset.append(hdu.copy())
+        buffer = io.BytesIO()
+        subset.writeto(buffer)
+    buffer.seek(0)
+    return buffer
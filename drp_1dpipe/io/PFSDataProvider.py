@@ -1,12 +1,15 @@
+import threading
+import collections
+
 from drp_1dpipe.io.PFSReader import PFSReader
 from drp_1dpipe.io.PFSExternalStorage import PFSExternalStorage
 
 
 class PFSDataProvider():
     """Data provider class"""
-    def __init__(self, config, parameters, calibration):
+    def __init__(self, config, parameters, calibration, object_ids=None):
         self.config = config
-        self.storage = PFSExternalStorage(self.config)
+        self.storage = PFSExternalStorage(self.config, object_ids)
         self.reader = PFSReader(parameters, calibration, None)
 
     def get_spectrum(self, spectrum_id):
@@ -18,7 +21,7 @@ class PFSDataProvider():
 
         spectrun_id: str
             id of the source
-        
+
         Return
         ------
         spectrum
@@ -29,3 +32,121 @@ class PFSDataProvider():
                 reader.source_id = spectrum_id
                 reader.load_all(resource, spectrum_infos)
             return reader.get_spectrum()
+
+    def iter_spectra(self, object_ids):
+        """
+        Yield the spectra of object_ids in file order
+
+        Spectra of object_ids are read from the coadd in bulk, with their
+        observation infos built column-wise from the coadd tables.
+
+        Parameters
+        ----------
+
+        object_ids: list
+            ids of the sources
+
+        Yields
+        ------
+        tuple
+            id of the source, Amazed spectrum object or None, loading
+            exception or None
+        """
+        try:
+            object_ids = self.storage.load(self.config.coadd_file, object_ids)
+        except Exception as e:
+            for object_id in object_ids:
+                yield object_id, None, e
+            return
+        for object_id in object_ids:
+            try:
+                yield object_id, self.get_spectrum(object_id), None
+            except Exception as e:
+                yield object_id, None, e
+
+    def prefetch(self, object_ids, depth, max_memory=0):
+        """
+        Yield the spectra of `iter_spectra`, loaded ahead by a background thread
+
+        At most depth spectra are kept loaded ahead. When max_memory is given,
+        loading also waits while the spectra loaded ahead exceed it, at least
+        one spectrum being loaded ahead. The provider must not be used by the
+        caller while iterating. An exception raised by the loading thread
+        outside of the loading of a spectrum is raised by the iteration.
+
+        Parameters
+        ----------
+
+        object_ids: list
+            ids of the sources
+        depth: int
+            Maximum number of spectra loaded ahead
+        max_memory: float
+            Maximum size in bytes of the spectra loaded ahead, 0 for no limit
+
+        Yields
+        ------
+        tuple
+            id of the source, Amazed spectrum object or None, loading
+            exception or None
+        """
+        loaded = collections.deque()
+        condition = threading.Condition()
+        state = {"memory": 0, "last_size": 0, "stopped": False, "error": None}
+
+        def is_full():
+            if not loaded:
+                return False
+            if len(loaded) >= depth:
+                return True
+            return max_memory > 0 and state["memory"] + state["last_size"] > max_memory
+
+        def load():
+            try:
+                spectra = self.iter_spectra(object_ids)
+                while True:
+                    with condition:
+                        while is_full() and not state["stopped"]:
+                            condition.wait()
+                        if state["stopped"]:
+                            return
+                    item = next(spectra, None)
+                    if item is None:
+                        break
+                    object_id, spectrum, e = item
+                    # wavelength, flux, error and mask samples
+                    size = 4 * spectrum.get_wave(filtered_only=False).nbytes if e is None else 0
+                    item = (object_id, spectrum, e, size)
+                    with condition:
+                        loaded.append(item)
+                        state["memory"] += item[3]
+                        state["last_size"] = item[3] or state["last_size"]
+                        condition.notify_all()
+            except Exception as e:
+                state["error"] = e
+            finally:
+                # the end of loading is always signaled to the consumer
+                with condition:
+                    loaded.append(None)
+                    condition.notify_all()
+
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        try:
+            while True:
+                with condition:
+                    while not loaded:
+                        condition.wait()
+                    item = loaded.popleft()
+                    if item is None:
+                        if state["error"] is not None:
+                            raise state["error"]
+                        return
+                    state["memory"] -= item[3]
+                    condition.notify_all()
+                yield item[:3]
+        finally:
+            with condition:
+                state["stopped"] = True
+                condition.notify_all()
+            thread.join()
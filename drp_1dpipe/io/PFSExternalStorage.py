@@ -1,17 +1,166 @@
 import os
-from pfs.datamodel.drp import PfsObject, PfsCoadd
+import numpy as np
+from astropy.io import fits
+from pfs.datamodel.drp import PfsObject
 from pylibamazed.AbstractExternalStorage import AbstractExternalStorage, register_storage
+from drp_1dpipe.io.PFSCoaddIndex import get_spectra_class, read_coadd_index, find_coadd_rows, read_coadd_rows
+from drp_1dpipe.io.PFSSharedCoadd import SharedCoadd
+
+
+def get_observation_infos(pfs_object):
+    """Spectrum infos read from the target and observations of a PFS object"""
+    arms = list(set(pfs_object.observations.arm))
+    return {"arms": "".join(sorted(arms)),
+            "nVisit": pfs_object.nVisit,
+            "RA": pfs_object.target.ra,
+            "DEC": pfs_object.target.dec,
+            "designIds": list(pfs_object.observations.pfsDesignId),
+            "visits": list(pfs_object.observations.visit),
+            "fiberId": list(pfs_object.observations.fiberId),
+            "targetType": pfs_object.target.targetType}
+
+
+def _decode(values):
+    """Strings of a FITS character column"""
+    values = np.asarray(values)
+    if values.dtype.kind == "S":
+        values = np.char.decode(values)
+    return values.astype(str)
+
+
+def read_observation_infos(source):
+    """Build column-wise the spectrum infos of all the objects of a coadd file
+
+    Infos are computed from the TARGET and OBSERVATIONS tables at once,
+    instead of from the observations of each PFS object.
+
+    Parameters
+    ----------
+    source : str or file-like
+        pfsCoadd file
+
+    Return
+    ------
+    dict
+        objId to the infos returned by `get_observation_infos`, in file order
+    """
+    with fits.open(source, memmap=True) as hdulist:
+        target = hdulist["TARGET"].data
+        observations = hdulist["OBSERVATIONS"].data
+        order = np.argsort(observations["targetId"], kind="stable")
+        target_ids = observations["targetId"][order]
+        starts = np.searchsorted(target_ids, target["targetId"], side="left")
+        ends = np.searchsorted(target_ids, target["targetId"], side="right")
+        arm = _decode(observations["arm"][order])
+        design_ids = observations["pfsDesignId"][order]
+        visits = observations["visit"][order]
+        fiber_ids = observations["fiberId"][order]
+        infos = dict()
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            infos[int(target["objId"][i])] = {
+                "arms": "".join(sorted(set(arm[start:end]))),
+                "nVisit": int(end - start),
+                "RA": target["ra"][i],
+                "DEC": target["dec"][i],
+                "designIds": list(design_ids[start:end]),
+                "visits": list(visits[start:end]),
+                "fiberId": list(fiber_ids[start:end]),
+                "targetType": int(target["targetType"][i])}
+    return infos
+
+
+def _same_infos(infos, other):
+    return infos.keys() == other.keys() and \
+        all(np.array_equal(np.asarray(infos[key]), np.asarray(other[key])) for key in infos)
 
 
 class PFSExternalStorage(AbstractExternalStorage):
-    """Opener for FITS files that should be treated with an PFSSpectrumReader."""
+    """Opener for pfsCoadd and pfsCalibrated files that should be treated with an PFSSpectrumReader.
+
+    When the configuration gives the manifest of a coadd shared by the
+    scheduler, spectra are read from shared memory. Otherwise, when object_ids
+    are known, only their rows are decoded from the memory mapped file,
+    located with the object index written by pre_process when given.
+    """
 
-    def __init__(self, config):
+    def __init__(self, config, object_ids=None):
         super().__init__(config)
         if not config.reader == "pfs":
             raise Exception(f"Cannot initialize PFSExternalStorage for a {config.reader} reader.")
         self.read_flag = False
-       
+        self.object_ids = object_ids
+        # FITS content of the loaded coadd, None when it is shared
+        self.source = None
+        self.observation_infos = None
+        self.infos_checked = False
+
+    def _get_filepath(self, path):
+        if hasattr(self.config, 'spectrum_dir') :
+            return os.path.join(self.config.spectrum_dir, path)
+        return path
+
+    def _read_coadd(self, filepath):
+        if getattr(self.config, 'coadd_cache', ''):
+            return SharedCoadd(self.config.coadd_cache)
+        spectra_class = get_spectra_class(filepath)
+        if self.object_ids is None:
+            self.source = filepath
+            return spectra_class.readFits(filepath)
+        if getattr(self.config, 'coadd_index', ''):
+            index = read_coadd_index(self.config.coadd_index)
+            selected = np.isin(index["objId"], [int(object_id) for object_id in self.object_ids])
+            rows = index["row"][selected]
+        else:
+            rows = find_coadd_rows(filepath, self.object_ids)
+        self.source = read_coadd_rows(filepath, rows)
+        coadd = spectra_class.readFits(self.source)
+        self.source.seek(0)
+        return coadd
+
+    def load(self, path, object_ids):
+        """
+        Read in bulk the spectra of object_ids and their observation infos.
+
+        Parameters
+        ----------
+
+        path: str
+            path of the coadd file
+        object_ids: list
+            ids of the sources
+
+        Return
+        ------
+        list
+            object_ids in file order, ids missing from the file last
+        """
+        self.object_ids = object_ids
+        self.coadd = self._read_coadd(self._get_filepath(path))
+        self.read_flag = True
+        if self.source is not None:
+            try:
+                self.observation_infos = read_observation_infos(self.source)
+            except Exception:
+                # infos are read from each PFS object
+                self.observation_infos = None
+            rows = {object_id: row for row, object_id in enumerate(self.observation_infos or [])}
+        else:
+            rows = self.coadd.rows
+        return sorted(object_ids, key=lambda object_id: rows.get(int(object_id), len(rows)))
+
+    def _get_observation_infos(self, spectrum_id, pfs_object):
+        if self.observation_infos is None or int(spectrum_id) not in self.observation_infos:
+            return get_observation_infos(pfs_object)
+        infos = self.observation_infos[int(spectrum_id)]
+        if not self.infos_checked:
+            # column-wise infos are checked against the first PFS object
+            self.infos_checked = True
+            object_infos = get_observation_infos(pfs_object)
+            if not _same_infos(infos, object_infos):
+                self.observation_infos = None
+                return object_infos
+        return infos
+
     def read(
         self,
         spectrum_id: str,
@@ -30,21 +179,16 @@ class PFSExternalStorage(AbstractExternalStorage):
             path or anything else neded to acquire the resource
         obs_id: str
             id of the observation
-        
+
         Return
         ------
         PfsObject
             PFS spectrum object
         """
-        if hasattr(self.config, 'spectrum_dir') :
-            filepath = os.path.join(self.config.spectrum_dir, path)
-        else:
-            filepath  = path
-
         if not self.read_flag:
-            self.coadd = PfsCoadd.readFits(filepath)
+            self.coadd = self._read_coadd(self._get_filepath(path))
             self.read_flag = True
-        
+
         pfs_object = self.coadd.get(int(spectrum_id))
         pfs_object_id = pfs_object.getIdentity()
         self.spectrum_infos["pfs_object_id"] = pfs_object_id
@@ -52,17 +196,9 @@ class PFSExternalStorage(AbstractExternalStorage):
 
         self.global_infos["VERSION_drp_stella"] = pfs_object.metadata["VERSION_DRP_STELLA"]
         self.global_infos["damd_version"] = pfs_object.metadata["VERSION_DATAMODEL"]
-        
-        arms = list(set(pfs_object.observations.arm))
-        self.spectrum_infos["arms"] = "".join(sorted(arms)) 
-        self.spectrum_infos["nVisit"] = pfs_object.nVisit
+
+        self.spectrum_infos.update(self._get_observation_infos(spectrum_id, pfs_object))
         self.spectrum_infos["fiberFlux"] = pfs_object.target.fiberFlux
-        self.spectrum_infos["RA"]=pfs_object.target.ra
-        self.spectrum_infos["DEC"]=pfs_object.target.dec
-        self.spectrum_infos["designIds"]=list(pfs_object.observations.pfsDesignId)
-        self.spectrum_infos["visits"]=list(pfs_object.observations.visit)
-        self.spectrum_infos["fiberId"] = list(pfs_object.observations.fiberId)
-        self.spectrum_infos["targetType"]=pfs_object.target.targetType
 
         return pfs_object
 
@@ -77,6 +213,6 @@ class PFSExternalStorage(AbstractExternalStorage):
             External resource.
         """
         pass
-        
+
 
 register_storage("pfs", PFSExternalStorage)
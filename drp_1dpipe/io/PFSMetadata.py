@@ -0,0 +1,46 @@
+import yaml
+from astropy.io import fits
+
+VERSION_KEYS = ["VERSION_DATAMODEL", "VERSION_DRP_STELLA", "VERSION_OBS_PFS"]
+
+
+def _read_first_metadata(hdulist):
+    """Metadata of the first spectrum, stored as YAML in the METADATA table"""
+    metadata = hdulist["METADATA"].data["metadata"][0]
+    if isinstance(metadata, bytes):
+        metadata = metadata.decode()
+    return yaml.safe_load(metadata)
+
+
+def probe_coadd_metadata(path):
+    """Read the metadata needed to create the output files from a
+    pfsCoadd or pfsCalibrated file, without loading its spectra
+
+    Only the TARGET table and headers are read, the file being memory
+    mapped. Versions are read from the primary header, or from the
+    metadata of the first spectrum when missing there.
+
+    Parameters
+    ----------
+    path : str
+        Path of the pfsCoadd or pfsCalibrated file
+
+    Return
+    ------
+    int
+        catId of the first spectrum
+    dict
+        VERSION_DATAMODEL, VERSION_DRP_STELLA and VERSION_OBS_PFS
+    int
+        Number of wavelength samples of the first spectrum
+    """
+    with fits.open(path, memmap=True) as hdulist:
+        catId = int(hdulist["TARGET"].data["catId"][0])
+        wl_size = hdulist["WAVELENGTH"].header["NAXIS1"]
+        header = hdulist[0].header
+        if all(key in header for key in VERSION_KEYS):
+            metadata = header
+        else:
+            metadata = _read_first_metadata(hdulist)
+        versions = {key: metadata[key] for key in VERSION_KEYS}
+    return catId, versions, wl_size
@@ -5,6 +5,28 @@ from pfs.datamodel.drp import PfsObject, PfsCoadd
 
 import numpy as np
 
+from drp_1dpipe.io.gridCache import GridCache
+
+# nJy to erg.cm-2.s-1.Angstrom-1 factors per wavelength grid
+_flux_factors = GridCache()
+
+
+def get_flux_factor(wave):
+    """Cached float32 factor converting flux from nJy to erg.cm-2.s-1.Angstrom-1
+
+    Parameters
+    ----------
+    wave : :obj:`numpy.ndarray`
+        Wavelength grid in Angstrom
+
+    Return
+    ------
+    :obj:`numpy.ndarray`
+        1 / wave**2 * 2.99792458e-14, as float32
+    """
+    return _flux_factors.get(wave, lambda wave: np.float32(1 / wave ** 2 * 2.99792458 / 10 ** 14))
+
+
 class PFSReader(AbstractSpectrumReader):
 
     def __init__(self, parameters, calibration_library, source_id):
@@ -50,7 +72,7 @@ class PFSReader(AbstractSpectrumReader):
         """
         try:
             flux = np.array(pfs_object.flux, dtype=np.float32)
-            flux = np.multiply(1 / self.waves.get(obs_id) ** 2, flux) * 2.99792458 / 10 ** 14
+            flux *= get_flux_factor(self.waves.get(obs_id))
             self.fluxes.append(flux, obs_id)
         except Exception as e:
             raise Exception(f"Could not load flux : {e}")
@@ -71,8 +93,8 @@ class PFSReader(AbstractSpectrumReader):
             Identifiant of the observation
         """
         try:
-            error = np.array(np.sqrt(pfs_object.covar[0][0:]), dtype=np.float32)
-            error = np.multiply(1 / self.waves.get(obs_id) ** 2, error) * 2.99792458 / 10 ** 14
+            error = np.sqrt(pfs_object.covar[0], dtype=np.float32)
+            error *= get_flux_factor(self.waves.get(obs_id))
             self.errors.append(error, obs_id)
         except Exception as e:
             raise Exception(f"Could not load error : {e}")
@@ -0,0 +1,152 @@
+import json
+import pickle
+from types import SimpleNamespace
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+from drp_1dpipe.io.PFSCoaddIndex import get_spectra_class
+
+# arrays decoded once and shared by the process_spectra of a local run
+ARRAYS = ["wavelength", "flux", "variance", "mask"]
+
+
+def _get_infos(pfs_object):
+    """Metadata of a spectrum used by PFSExternalStorage"""
+    return {"identity": pfs_object.getIdentity(),
+            "metadata": pfs_object.metadata,
+            "nVisit": pfs_object.nVisit,
+            "target": {"fiberFlux": pfs_object.target.fiberFlux,
+                       "ra": pfs_object.target.ra,
+                       "dec": pfs_object.target.dec,
+                       "targetType": pfs_object.target.targetType},
+            "observations": {"arm": list(pfs_object.observations.arm),
+                             "pfsDesignId": list(pfs_object.observations.pfsDesignId),
+                             "visit": list(pfs_object.observations.visit),
+                             "fiberId": list(pfs_object.observations.fiberId)}}
+
+
+def _share(array, blocks):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    blocks.append(shm)
+    return {"name": shm.name, "shape": list(array.shape), "dtype": array.dtype.str}
+
+
+def create_shared_coadd(coadd_file, manifest_path):
+    """Decode a pfsCoadd or pfsCalibrated file into shared memory blocks
+
+    Wavelength, flux, variance and mask of all spectra are stacked in one
+    block each, the other metadata used by PFSExternalStorage being pickled
+    in another block. Blocks are described in a JSON manifest given to
+    process_spectra.
+
+    Parameters
+    ----------
+    coadd_file : str
+        Path of the pfsCoadd or pfsCalibrated file
+    manifest_path : str
+        Path of the JSON manifest
+
+    Return
+    ------
+    list
+        :obj:`multiprocessing.shared_memory.SharedMemory` blocks, to be
+        released with `release_shared_coadd` once processing is done
+    """
+    coadd = get_spectra_class(coadd_file).readFits(coadd_file)
+    spectra = [coadd[target] for target in coadd]
+    del coadd
+    blocks = []
+    try:
+        manifest = {"arrays": dict()}
+        for name in ARRAYS:
+            if name == "variance":
+                rows = [spectrum.covar[0] for spectrum in spectra]
+            else:
+                rows = [getattr(spectrum, name) for spectrum in spectra]
+            array = np.stack(rows)
+            manifest["arrays"][name] = _share(array.astype(array.dtype.newbyteorder("=")), blocks)
+        infos = pickle.dumps([_get_infos(spectrum) for spectrum in spectra])
+        manifest["infos"] = _share(np.frombuffer(infos, dtype=np.uint8), blocks)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+    except Exception:
+        release_shared_coadd(blocks)
+        raise
+    return blocks
+
+
+def release_shared_coadd(blocks):
+    """Free the shared memory blocks of a coadd"""
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before python 3.13 attached blocks are registered to be unlinked
+        # at exit, they belong to the scheduler
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SharedPfsObject:
+    """Read-only spectrum of a shared coadd
+
+    Holds the attributes of a PfsObject read by PFSExternalStorage and
+    PFSReader, arrays being views on the shared memory blocks.
+    """
+
+    def __init__(self, infos, wavelength, flux, variance, mask):
+        self.wavelength = wavelength
+        self.flux = flux
+        self.covar = variance[np.newaxis]
+        self.mask = mask
+        self.metadata = infos["metadata"]
+        self.nVisit = infos["nVisit"]
+        self.target = SimpleNamespace(**infos["target"])
+        self.observations = SimpleNamespace(**infos["observations"])
+        self._identity = infos["identity"]
+
+    def getIdentity(self):
+        return dict(self._identity)
+
+
+class SharedCoadd:
+    """Coadd attached to the shared memory blocks created by the scheduler
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path of the JSON manifest written by `create_shared_coadd`
+    """
+
+    def __init__(self, manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        self.blocks = []
+        self.arrays = {name: self._view(block) for name, block in manifest["arrays"].items()}
+        self.infos = pickle.loads(self._view(manifest["infos"]).tobytes())
+        self.rows = {int(infos["identity"]["objId"]): row for row, infos in enumerate(self.infos)}
+
+    def _view(self, block):
+        shm = _attach(block["name"])
+        self.blocks.append(shm)
+        array = np.ndarray(block["shape"], dtype=block["dtype"], buffer=shm.buf)
+        array.flags.writeable = False
+        return array
+
+    def get(self, object_id):
+        """Spectrum of objId object_id
+
+        Return
+        ------
+        :obj:`SharedPfsObject`
+            Spectrum
+        """
+        row = self.rows[int(object_id)]
+        return SharedPfsObject(self.infos[row], *[self.arrays[name][row] for name in ARRAYS])
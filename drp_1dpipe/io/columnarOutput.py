@@ -0,0 +1,165 @@
+import os
+import h5py
+import pandas as pd
+from astropy.io import fits
+from astropy.table import Table
+
+from drp_1dpipe.io.redshiftCoCandidates import CoZcandidatesWriter, clear_output_file, _shift_ids
+
+
+def get_columnar_path(path):
+    """Path of the HDF5 file holding the rows of a pfsCoZcandidates file"""
+    return os.path.splitext(path)[0] + ".h5"
+
+
+def _create_datasets(f, path, layout):
+    """Create an extendable dataset for each per-target HDU of path"""
+    with fits.open(path) as hdulist:
+        f.attrs["hdu_names"] = [hdu.name for hdu in hdulist]
+        if "SHARDID" in hdulist[0].header:
+            f.attrs["shard_id"] = hdulist[0].header["SHARDID"]
+    for name, empty in layout.items():
+        f.create_dataset(name, shape=empty.shape, maxshape=(None,) + empty.shape[1:],
+                         dtype=empty.dtype, chunks=True)
+
+
+def _read_record(columnar_path, layout):
+    """Read all the rows of a columnar file as a single record"""
+    with h5py.File(columnar_path, "r") as f:
+        return {name: f[name][()] for name in layout if name in f}
+
+
+class H5CandidatesWriter(CoZcandidatesWriter):
+    """Buffered writer of pfsCoZcandidates rows into an HDF5 file
+
+    Rows of each per-target HDU are appended to an extendable dataset of a
+    HDF5 file next to the pfsCoZcandidates file, which only serves as layout
+    template until `export_fits` is called. Appending does not rewrite the
+    rows already written, as it does with FITS binary tables.
+
+    Parameters
+    ----------
+    path : str
+        Path of a pfsCoZcandidates file created by `init_output_file`
+    flush_size : int
+        Number of spectra buffered before flushing
+    flush_interval : float
+        Maximum time in seconds between two flushes, 0 to disable
+    columnar_path : str
+        Path of the HDF5 file, next to the pfsCoZcandidates file when None
+    """
+
+    def __init__(self, path, flush_size=1, flush_interval=0, columnar_path=None):
+        super().__init__(path, flush_size, flush_interval)
+        self.columnar_path = columnar_path or get_columnar_path(path)
+        self.nb_rows = self._read_nb_rows()
+
+    def _read_nb_rows(self):
+        if not os.path.exists(self.columnar_path):
+            return {name: 0 for name in self.layout}
+        with h5py.File(self.columnar_path, "r") as f:
+            return {name: len(f[name]) for name in self.layout}
+
+    def flush(self):
+        """Append buffered rows to the HDF5 file
+
+        When the file is shared, caller is responsible for holding the lock.
+        """
+        if not self.nb_spectra:
+            return
+        with h5py.File(self.columnar_path, "a") as f:
+            if not len(f):
+                _create_datasets(f, self.path, self.layout)
+            nb_rows = {name: len(f[name]) for name in self.pending}
+            target_offset = nb_rows["TARGET"] - self.nb_rows["TARGET"]
+            for name, pending in self.pending.items():
+                if not len(pending):
+                    continue
+                rows = pending.data
+                if rows.ndim == 1:
+                    rows = _shift_ids(rows, target_offset, nb_rows[name] - self.nb_rows[name])
+                dataset = f[name]
+                dataset.resize(nb_rows[name] + len(rows), axis=0)
+                dataset[nb_rows[name]:] = rows
+        self.nb_rows = {name: nb_rows[name] + len(pending) for name, pending in self.pending.items()}
+        self._reset()
+
+    def fsync(self):
+        """Wait for the written rows to reach the disk"""
+        if not os.path.exists(self.columnar_path):
+            return
+        fd = os.open(self.columnar_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def concatenate_columnar_files(path, shard_paths, columnar_path=None):
+    """Append the HDF5 files of pfsCoZcandidates shards to the one of path
+
+    Parameters
+    ----------
+    path : str
+        Path of the destination pfsCoZcandidates file
+    shard_paths : list
+        Paths of the shard pfsCoZcandidates files
+    columnar_path : str
+        Path of the destination HDF5 file, the one of path when None
+    """
+    writer = H5CandidatesWriter(path, columnar_path=columnar_path)
+    for shard_path in shard_paths:
+        writer.append(_read_record(get_columnar_path(shard_path), writer.layout))
+    writer.flush()
+
+
+def export_fits(path):
+    """Write the rows of the HDF5 file of path to the pfsCoZcandidates file
+
+    The HDF5 file holds all the rows, rows of a previous export are replaced.
+
+    Parameters
+    ----------
+    path : str
+        Path of the pfsCoZcandidates file
+    """
+    clear_output_file(path)
+    writer = CoZcandidatesWriter(path)
+    writer.append(_read_record(get_columnar_path(path), writer.layout))
+    writer.flush()
+
+
+def read_table(path, hdu, columns=None):
+    """Read a pfsCoZcandidates table, from its HDF5 file when there is one
+
+    Only the requested columns are read from the HDF5 file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the pfsCoZcandidates file
+    hdu : int or str
+        HDU index or name
+    columns : list
+        Names of the columns to read, all if None
+
+    Return
+    ------
+    :obj:`pandas.DataFrame`
+        Table content
+    """
+    columnar_path = get_columnar_path(path)
+    if os.path.exists(columnar_path):
+        with h5py.File(columnar_path, "r") as f:
+            name = f.attrs["hdu_names"][hdu] if isinstance(hdu, int) else hdu
+            if name in f:
+                dataset = f[name]
+                if columns is None:
+                    columns = list(dataset.dtype.names)
+                data = dataset.fields(list(columns))[()]
+                return pd.DataFrame({column: data[column].astype(data[column].dtype.newbyteorder("="))
+                                     for column in columns})
+    table = Table.read(path, hdu=hdu, format="fits")
+    if columns is not None:
+        table = table[columns]
+    return table.to_pandas()
@@ -0,0 +1,57 @@
+import collections
+import numpy as np
+
+
+class GridCache:
+    """Bounded cache of values computed from a grid
+
+    Entries are keyed by the grid size and bounds, hashing the grid costing
+    more than the conversions cached, and a hit is confirmed by comparing
+    the grids. Least recently used entries are dropped first.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of entries
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+
+    @staticmethod
+    def _get_key(grid, key):
+        return key + ((len(grid), grid[0], grid[-1]) if len(grid) else (0,))
+
+    def lookup(self, grid, key=()):
+        """Value cached for grid, None when there is none
+
+        Parameters
+        ----------
+        grid : :obj:`numpy.ndarray`
+            Grid
+        key : tuple
+            Other parameters the value depends on
+        """
+        grid_key = self._get_key(grid, key)
+        entry = self.entries.get(grid_key)
+        if entry is None or not np.array_equal(entry[0], grid):
+            return None
+        self.entries.move_to_end(grid_key)
+        return entry[1]
+
+    def store(self, grid, value, key=()):
+        """Cache the value computed for grid"""
+        grid_key = self._get_key(grid, key)
+        self.entries[grid_key] = (np.array(grid), value)
+        self.entries.move_to_end(grid_key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def get(self, grid, compute, key=()):
+        """Value cached for grid, computed by compute(grid) when missing"""
+        value = self.lookup(grid, key)
+        if value is None:
+            value = compute(grid)
+            self.store(grid, value, key)
+        return value
@@ -1,6 +1,9 @@
 from pylibamazed.redshift import WarningCode, ErrorCode
 import json
 
+# error codes set by the pipeline itself, out of the library ErrorCode range
+PIPELINE_ERROR_CODES = {"PRESCREEN_REJECTED": 1000}
+
 def get_warning_codes():
     ret = dict()
     for wc in WarningCode:
@@ -12,8 +15,24 @@ def get_error_codes():
     ret = dict()
     for ec in ErrorCode:
         ret[ec.value]=ec.name
+    for name, value in PIPELINE_ERROR_CODES.items():
+        ret[value]=name
     return ret
 
+
+def get_error_name(code):
+    """Name of a library or pipeline error code
+
+    Raises
+    ------
+    ValueError
+        Unknown error code
+    """
+    for name, value in PIPELINE_ERROR_CODES.items():
+        if code == value:
+            return name
+    return ErrorCode(code).name
+
 def get_infos():
     return {"WarningCodes":get_warning_codes(),
             "ErrorCodes":get_error_codes()}
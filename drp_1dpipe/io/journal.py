@@ -0,0 +1,423 @@
+import os
+import re
+import glob
+import shutil
+import logging
+import pickle
+import struct
+import h5py
+import numpy as np
+from astropy.io import fits
+
+from drp_1dpipe.io.redshiftCoCandidates import (CoZcandidatesWriter, clear_output_file, read_layout,
+                                              _get_nb_rows, LAYOUT_DIR)
+from drp_1dpipe.io.columnarOutput import get_columnar_path, read_table
+
+logger = logging.getLogger("recover")
+
+JOURNAL_FILENAME = "coZcandidates.journal"
+
+# entries are pickled (filename, record) prefixed by their size
+_entry_header = struct.Struct("<Q")
+
+
+def _read_entries(path):
+    """Yield the entries of a journal and the offset following each of them"""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(_entry_header.size)
+            if len(header) < _entry_header.size:
+                return
+            size, = _entry_header.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size:
+                # entry interrupted by a crash
+                return
+            yield pickle.loads(payload), f.tell()
+
+
+def read_journal(path):
+    """Read the entries of a journal
+
+    A last entry left incomplete by a crash is ignored.
+
+    Parameters
+    ----------
+    path : str
+        Journal path
+
+    Yields
+    ------
+    tuple
+        pfsCoZcandidates file name and record
+    """
+    for entry, _ in _read_entries(path):
+        yield entry
+
+
+def get_journaled_spectra(path):
+    """Get the spectra recorded in a journal
+
+    Parameters
+    ----------
+    path : str
+        Journal path
+
+    Return
+    ------
+    set
+        pfsCoZcandidates file name and objId of the journaled spectra
+    """
+    spectra = set()
+    for filename, record in read_journal(path):
+        spectra.update((filename, int(objid)) for objid in record["TARGET"]["objId"])
+    return spectra
+
+
+def _get_written_objids(path):
+    """objId of the spectra written to a pfsCoZcandidates file, or its HDF5 file"""
+    if not os.path.exists(path):
+        return set()
+    return set(int(objid) for objid in read_table(path, "TARGET", ["objId"])["objId"])
+
+
+def _read_written_rows(path, layout):
+    """Rows written to the per-target HDUs of a pfsCoZcandidates file, or its HDF5 file
+
+    Tables are read as their targetId, modelId and objId columns, images
+    as their number of rows.
+    """
+    written = dict()
+    columns = {name: [column for column in ("targetId", "modelId", "objId") if column in empty.dtype.names]
+               for name, empty in layout.items() if empty.ndim == 1}
+    columnar_path = get_columnar_path(path)
+    if os.path.exists(columnar_path):
+        with h5py.File(columnar_path, "r") as f:
+            for name in layout:
+                if name in columns:
+                    written[name] = {column: f[name].fields(column)[()] for column in columns[name]}
+                else:
+                    written[name] = len(f[name])
+    else:
+        with fits.open(path) as hdulist:
+            for name in layout:
+                if name in columns:
+                    written[name] = {column: np.array(hdulist[name].data[column]) for column in columns[name]}
+                else:
+                    written[name] = _get_nb_rows(hdulist[name])
+    return written
+
+
+def _get_incomplete_target(path, records):
+    """First target of the records partly written to a pfsCoZcandidates file
+
+    A flush interrupted by a crash can leave the rows of a record in some
+    HDUs only. A record is written when each of its HDUs holds its rows:
+    tables the rows of its targets, models images the rows of its
+    candidates and other images one row per target.
+
+    Parameters
+    ----------
+    path : str
+        pfsCoZcandidates file path
+    records : list
+        Journaled records of the file
+
+    Return
+    ------
+    int
+        targetId of the first target of a partly written record, or the
+        number of targets when rows of targets missing from TARGET are
+        written, None when all the records found in file are complete
+    """
+    written = _read_written_rows(path, read_layout(path)[0])
+    targets = dict()
+    for target_id, objid in zip(written["TARGET"]["targetId"], written["TARGET"]["objId"]):
+        targets.setdefault(int(objid), []).append(int(target_id))
+    nb_targets = max((int(target_id) + 1 for target_id in written["TARGET"]["targetId"]), default=0)
+    counts = {name: np.bincount(rows["targetId"].astype(int), minlength=nb_targets)
+              for name, rows in written.items() if isinstance(rows, dict)}
+    last_models = dict()
+    for name, rows in written.items():
+        if name.endswith("_MODELS"):
+            candidates = written[name.replace("_MODELS", "_CANDIDATES")]
+            last_models[name] = np.full(len(counts[name.replace("_MODELS", "_CANDIDATES")]), -1)
+            np.maximum.at(last_models[name], candidates["targetId"].astype(int), candidates["modelId"])
+
+    incomplete = None
+    for name, rows in written.items():
+        if name in last_models:
+            orphans = rows > counts[name.replace("_MODELS", "_CANDIDATES")][:nb_targets].sum()
+        elif name in counts:
+            orphans = counts[name][nb_targets:].sum() > 0
+        else:
+            orphans = rows > nb_targets
+        if orphans:
+            # rows of a record whose TARGET rows are not written
+            incomplete = nb_targets
+    for record in records:
+        record_targets = [target_id for objid in record["TARGET"]["objId"]
+                          for target_id in targets.get(int(objid), [])]
+        if not record_targets:
+            # not written at all
+            continue
+        for name, rows in record.items():
+            if name in last_models:
+                candidates = name.replace("_MODELS", "_CANDIDATES")
+                is_written = counts[candidates][record_targets].sum() >= len(rows) and \
+                    last_models[name][record_targets].max() < written[name]
+            elif name in counts:
+                is_written = counts[name][record_targets].sum() >= len(rows)
+            else:
+                is_written = max(record_targets) < written[name]
+            if not is_written:
+                incomplete = min(record_targets + ([incomplete] if incomplete is not None else []))
+                break
+    return incomplete
+
+
+def _truncate_output(path, nb_targets):
+    """Remove the rows of the targets following the first nb_targets of a pfsCoZcandidates file
+
+    Parameters
+    ----------
+    path : str
+        pfsCoZcandidates file path, its HDF5 file is truncated when there is one
+    nb_targets : int
+        Number of targets kept
+    """
+    layout = read_layout(path)[0]
+    written = _read_written_rows(path, layout)
+    nb_rows = {name: int(np.count_nonzero(rows["targetId"] < nb_targets))
+               for name, rows in written.items() if isinstance(rows, dict)}
+    for name, rows in written.items():
+        if name.endswith("_MODELS"):
+            # modelId is the row of the candidate
+            nb_rows[name] = min(rows, nb_rows[name.replace("_MODELS", "_CANDIDATES")])
+        elif name not in nb_rows:
+            nb_rows[name] = min(rows, nb_targets)
+    columnar_path = get_columnar_path(path)
+    if os.path.exists(columnar_path):
+        with h5py.File(columnar_path, "a") as f:
+            for name, size in nb_rows.items():
+                f[name].resize(size, axis=0)
+        return
+    with fits.open(path, "update") as hdulist:
+        for name, size in nb_rows.items():
+            if hdulist[name].data is not None:
+                hdulist[name].data = hdulist[name].data[:size]
+        hdulist.flush()
+
+
+def get_unwritten_records(path, write_dir):
+    """Get the journaled records missing from the pfsCoZcandidates files
+
+    Records journaled by a bunch interrupted before flushing them are in
+    the journal only. Records interrupted while being flushed can be
+    written to some HDUs only: the rows of their targets and of the
+    targets following them are removed, so that they can be written again.
+
+    Parameters
+    ----------
+    path : str
+        Journal path
+    write_dir : str
+        Directory of the pfsCoZcandidates files written by the bunch
+
+    Return
+    ------
+    list
+        pfsCoZcandidates file name and record of the unwritten records
+
+    Raises
+    ------
+    Exception
+        Rows of spectra missing from the journal follow a partly written
+        record, they would be removed
+    """
+    entries = list(read_journal(path))
+    records = dict()
+    for filename, record in entries:
+        records.setdefault(filename, []).append(record)
+    written = dict()
+    for filename, file_records in records.items():
+        file_path = os.path.join(write_dir, filename)
+        if not os.path.exists(file_path):
+            written[filename] = set()
+            continue
+        incomplete = _get_incomplete_target(file_path, file_records)
+        if incomplete is not None:
+            target = read_table(file_path, "TARGET", ["targetId", "objId"])
+            journaled = set(int(objid) for record in file_records for objid in record["TARGET"]["objId"])
+            others = set(int(objid) for objid in target["objId"][target["targetId"] >= incomplete]) - journaled
+            if others:
+                raise Exception(f"{len(others)} spectra missing from {path} follow spectra partly "
+                                f"written to {file_path}, recover the output with drp_1drecover")
+            _truncate_output(file_path, incomplete)
+        written[filename] = _get_written_objids(file_path)
+    return [(filename, record) for filename, record in entries
+            if not all(int(objid) in written[filename] for objid in record["TARGET"]["objId"])]
+
+
+class Journal:
+    """Append-only journal of the records of a bunch
+
+    Each record is written and synced to disk before being handed to the
+    pfsCoZcandidates writer, so that the results of a bunch killed before
+    writing can be recovered with `recover_output`.
+
+    Parameters
+    ----------
+    path : str
+        Journal path, appended to if it exists
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            # drop an entry left incomplete by a crash
+            offset = 0
+            for _, offset in _read_entries(path):
+                pass
+            os.truncate(path, offset)
+        self.file = open(path, "ab")
+
+    def append(self, filename, record):
+        """Write a record
+
+        Parameters
+        ----------
+        filename : str
+            Name of the pfsCoZcandidates file of the record
+        record : dict
+            HDU name to rows
+        """
+        payload = pickle.dumps((filename, record), protocol=pickle.HIGHEST_PROTOCOL)
+        self.file.write(_entry_header.pack(len(payload)) + payload)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class JournaledWriter:
+    """Writer journaling records before handing them to another writer
+
+    Parameters
+    ----------
+    writer : :obj:`CoZcandidatesWriter`
+        Writer of the pfsCoZcandidates file
+    journal : :obj:`Journal`
+        Journal of the bunch
+    """
+
+    def __init__(self, writer, journal):
+        self.writer = writer
+        self.journal = journal
+        self.path = writer.path
+        self.layout = writer.layout
+        self.ln_pdf_floors = writer.ln_pdf_floors
+
+    def append(self, record):
+        self.journal.append(os.path.basename(self.path), record)
+        self.writer.append(record)
+
+    def need_flush(self):
+        return self.writer.need_flush()
+
+    def flush(self):
+        self.writer.flush()
+
+
+def _bunch_id(path):
+    return int(re.search(r"B(\d+)$", os.path.dirname(path)).group(1))
+
+
+def recover_output(output_dir):
+    """Rebuild the pfsCoZcandidates files of a run from the bunches journals
+
+    The journals are replayed in bunch order into a copy of the empty file
+    kept in the layout directory, which then replaces the data directory
+    file, possibly left corrupt by a crash. Bunch shard files and HDF5
+    files are removed, their content being in the journals. Nothing is
+    changed when the data files hold spectra missing from the journals, as
+    those of a bunch processed without journal.
+
+    Parameters
+    ----------
+    output_dir : str
+        Output directory of the run
+
+    Return
+    ------
+    dict
+        Bunch id to number of recovered spectra
+
+    Raises
+    ------
+    Exception
+        A journal records results of an unknown pfsCoZcandidates file, or
+        spectra of a data file are not journaled
+    """
+    data_dir = os.path.join(output_dir, "data")
+    layout_dir = os.path.join(output_dir, LAYOUT_DIR)
+    filenames = set(os.path.basename(path) for pattern in [data_dir, layout_dir]
+                    for path in glob.glob(os.path.join(pattern, "pfsCoZcandidates-*.fits")))
+    paths = {filename: os.path.join(data_dir, filename) for filename in sorted(filenames)}
+    journals = sorted(glob.glob(os.path.join(output_dir, "B*", JOURNAL_FILENAME)), key=_bunch_id)
+
+    journaled = {filename: set() for filename in paths}
+    for journal_path in journals:
+        for filename, record in read_journal(journal_path):
+            if filename not in journaled:
+                raise Exception(f"{journal_path} records results of {filename}, "
+                                f"not found in {data_dir}")
+            journaled[filename].update(int(objid) for objid in record["TARGET"]["objId"])
+    for filename, path in paths.items():
+        if not os.path.exists(path):
+            continue
+        try:
+            written = _get_written_objids(path)
+        except Exception as e:
+            if not os.path.exists(os.path.join(layout_dir, filename)):
+                raise
+            logger.warning(f"unable to read {path} : {e}, rebuilt from the journals")
+            continue
+        missing = written - journaled[filename]
+        if missing:
+            raise Exception(f"{len(missing)} spectra of {path} are not journaled, "
+                            "recovering would remove them")
+
+    writers = dict()
+    for filename, path in paths.items():
+        layout_path = os.path.join(layout_dir, filename)
+        if os.path.exists(layout_path):
+            shutil.copyfile(layout_path, path + ".tmp")
+        else:
+            # run initialized without layout directory
+            shutil.copyfile(path, path + ".tmp")
+            clear_output_file(path + ".tmp")
+        writers[filename] = CoZcandidatesWriter(path + ".tmp")
+
+    recovered = dict()
+    for journal_path in journals:
+        bunch_id = _bunch_id(journal_path)
+        recovered[bunch_id] = 0
+        for filename, record in read_journal(journal_path):
+            writers[filename].append(record)
+            recovered[bunch_id] += 1
+        for writer in writers.values():
+            writer.flush()
+    for filename, path in paths.items():
+        writers[filename].fsync()
+        if os.path.exists(get_columnar_path(path)):
+            os.remove(get_columnar_path(path))
+        os.replace(path + ".tmp", path)
+    for journal_path in journals:
+        for shard_path in glob.glob(os.path.join(os.path.dirname(journal_path),
+                                                 "pfsCoZcandidates-*.fits")):
+            os.remove(shard_path)
+            if os.path.exists(get_columnar_path(shard_path)):
+                os.remove(get_columnar_path(shard_path))
+    return recovered
@@ -1,9 +1,14 @@
 import os
+import time
+import weakref
 import numpy as np
 from pylibamazed.redshift import get_version, ErrorCode
 from pylibamazed.PdfHandler import BuilderPdfHandler,get_final_regular_z_grid
+from pylibamazed.Exception import AmazedError
 from drp_1dpipe import version as drp_1dpipe_version
 from drp_1dpipe.core.logger import log_exception
+from drp_1dpipe.io.infos import PIPELINE_ERROR_CODES
+from drp_1dpipe.io.gridCache import GridCache
 
 from astropy.io import fits
 import json
@@ -13,9 +18,86 @@ import logging
 
 speed_of_light_kms = speed_of_light / 1.e3
 
-def init_output_file(output_dir, catId, user_param, damd_version,stella_version, obs_pfs_version, parameters, wl_size):
-    path = os.path.join(output_dir,
-                        "pfsCoZcandidates-%05d.fits" % (catId))
+# number of ln pdf bins per row of sparse *_LN_PDF tables
+LN_PDF_CHUNK = 16
+
+# HDUs left empty for each product level
+SKIPPED_HDUS = {
+    "full": [],
+    "standard": ["GALAXY_MODELS", "QSO_MODELS", "STAR_MODELS"],
+    "minimal": ["GALAXY_MODELS", "QSO_MODELS", "STAR_MODELS",
+                "GALAXY_LN_PDF", "QSO_LN_PDF", "STAR_LN_PDF"],
+}
+
+IMAGE_COMPRESSIONS = ["none", "lossless", "quantized"]
+
+# directory of the output directory keeping empty copies of the pfsCoZcandidates
+# files, from which they are rebuilt by the recovery
+LAYOUT_DIR = "layout"
+
+def _image_hdu(name, data, image_compression, quantize_level):
+    """Build an image HDU, tile-compressed row by row if requested
+
+    Parameters
+    ----------
+    name : str
+        HDU name
+    data : :obj:`numpy.ndarray`
+        Image data
+    image_compression : str
+        none, lossless (GZIP_2 without quantization) or quantized (RICE_1)
+    quantize_level : float
+        Quantization level of quantized compression
+
+    Return
+    ------
+    :obj:`astropy.io.fits.ImageHDU`
+        Image HDU
+    """
+    if image_compression == "lossless":
+        return fits.CompImageHDU(name=name, data=data,
+                                 compression_type="GZIP_2", quantize_level=0.0)
+    if image_compression == "quantized":
+        return fits.CompImageHDU(name=name, data=data,
+                                 compression_type="RICE_1", quantize_level=quantize_level,
+                                 quantize_method=2)
+    if image_compression != "none":
+        raise Exception(f"Unknown image compression {image_compression}")
+    return fits.ImageHDU(name=name, data=data)
+
+
+def _ln_pdf_hdu(name, nb_bins, image_compression, quantize_level, pdf_storage, ln_pdf_floor):
+    """Build an empty ln pdf HDU, either a dense image or a sparse table
+
+    The sparse table holds, for each target, the runs of bins above
+    `ln_pdf_floor` (at least the maximum bin), cut in rows of
+    `LN_PDF_CHUNK` values padded with NaN. See `expand_ln_pdf`.
+    """
+    if pdf_storage == "dense":
+        return _image_hdu(name, np.empty((0, nb_bins), dtype=np.float32),
+                          image_compression, quantize_level)
+    if pdf_storage != "sparse":
+        raise Exception(f"Unknown pdf storage {pdf_storage}")
+    hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name="targetId", format="I", array=np.array([], dtype=np.int16)),
+        fits.Column(name="start", format="J", array=np.array([], dtype=np.int32)),
+        fits.Column(name="values", format=f"{LN_PDF_CHUNK}E",
+                    array=np.empty((0, LN_PDF_CHUNK), dtype=np.float32))
+    ], name=name)
+    hdu.header["LNPFLOOR"] = (ln_pdf_floor, "ln pdf floor of stored bins")
+    hdu.header["NBINS"] = (nb_bins, "Number of bins of the dense ln pdf")
+    return hdu
+
+
+def get_output_filename(catId):
+    """Name of the pfsCoZcandidates file of a catId"""
+    return "pfsCoZcandidates-%05d.fits" % (catId)
+
+
+def init_output_file(output_dir, catId, user_param, damd_version,stella_version, obs_pfs_version, parameters, wl_size,
+                     image_compression="none", quantize_level=16, pdf_storage="dense", ln_pdf_floor=-20.,
+                     product_level="full"):
+    path = os.path.join(output_dir, get_output_filename(catId))
     hdul = []
     try:
         header = [fits.Card('D1D_VER', get_version(), 'Version of the DRP_1D library'),
@@ -25,8 +107,15 @@ def init_output_file(output_dir, catId, user_param, damd_version,stella_version,
                   fits.Card('OBS_VER', obs_pfs_version, 'Version of obs pfs'),
                   fits.Card('U_PARAM',
                             json.dumps(user_param),
-                            "User Parameters content, json")
+                            "User Parameters content, json"),
+                  fits.Card('PRODLVL', product_level, 'Product level, full, standard or minimal'),
+                  fits.Card('IMGCOMP', image_compression, 'Compression of the images, applied at merge'),
+                  fits.Card('QUANTLVL', quantize_level, 'Quantization level of quantized compression')
                   ]
+        if product_level not in SKIPPED_HDUS:
+            raise Exception(f"Unknown product level {product_level}")
+        if image_compression not in IMAGE_COMPRESSIONS:
+            raise Exception(f"Unknown image compression {image_compression}")
         hdr = fits.Header(header)
         primary = fits.PrimaryHDU(header=hdr)
         hdul.append(primary)
@@ -128,7 +217,7 @@ def init_output_file(output_dir, catId, user_param, damd_version,stella_version,
 
     
     empty_models = np.empty((0,wl_size),dtype=np.float32)
-    hdul.append(fits.ImageHDU(name="GALAXY_MODELS",data=empty_models))
+    hdul.append(_image_hdu("GALAXY_MODELS", empty_models, "none", quantize_level))
 
     zgrid = get_final_regular_z_grid("galaxy", parameters)
     hdul.append(fits.BinTableHDU.from_columns([fits.Column(name="redshift",
@@ -136,8 +225,8 @@ def init_output_file(output_dir, catId, user_param, damd_version,stella_version,
                                                            array=zgrid)
                                                ],
                                               name="GALAXY_REDSHIFT_GRID" ))
-    empty_pdf = np.empty((0,len(zgrid)),dtype=np.float32)
-    hdul.append(fits.ImageHDU(name="GALAXY_LN_PDF",data=empty_pdf))
+    hdul.append(_ln_pdf_hdu("GALAXY_LN_PDF", len(zgrid), "none", quantize_level,
+                            pdf_storage, ln_pdf_floor))
 
     # Define GALAXY_LINES binary table columns
     galaxy_lines_cols = fits.ColDefs([
@@ -162,15 +251,15 @@ def init_output_file(output_dir, catId, user_param, damd_version,stella_version,
 
     hdul.append(fits.BinTableHDU.from_columns(galaxy_qso_candidates_cols, name="QSO_CANDIDATES"))
    
-    hdul.append(fits.ImageHDU(name="QSO_MODELS",data=empty_models))
+    hdul.append(_image_hdu("QSO_MODELS", empty_models, "none", quantize_level))
     zgrid = get_final_regular_z_grid("qso", parameters)
     hdul.append(fits.BinTableHDU.from_columns([fits.Column(name="redshift",
                                                           format="E",
                                                            array=zgrid)
                                                ],
                                               name="QSO_REDSHIFT_GRID" ))
-    empty_pdf = np.empty((0,len(zgrid)),dtype=np.float32)
-    hdul.append(fits.ImageHDU(name="QSO_LN_PDF",data=empty_pdf))
+    hdul.append(_ln_pdf_hdu("QSO_LN_PDF", len(zgrid), "none", quantize_level,
+                            pdf_storage, ln_pdf_floor))
     hdul.append(fits.BinTableHDU.from_columns(galaxy_lines_cols, name="QSO_LINES" ))
 
     star_candidates_cols = fits.ColDefs([
@@ -195,7 +284,7 @@ def init_output_file(output_dir, catId, user_param, damd_version,stella_version,
     ])
     hdul.append(fits.BinTableHDU.from_columns(star_candidates_cols, name="STAR_CANDIDATES"))
     
-    hdul.append(fits.ImageHDU(name="STAR_MODELS",data=empty_models))
+    hdul.append(_image_hdu("STAR_MODELS", empty_models, "none", quantize_level))
 
     zgrid = np.array(get_final_regular_z_grid("star", parameters)) * speed_of_light_kms
     hdul.append(fits.BinTableHDU.from_columns([fits.Column(name="velocity",
@@ -203,8 +292,8 @@ def init_output_file(output_dir, catId, user_param, damd_version,stella_version,
                                                            array=zgrid)
                                                ],
                                               name="STAR_VELOCITY_GRID" ))
-    empty_pdf = np.empty((0,len(zgrid)),dtype=np.float32)
-    hdul.append(fits.ImageHDU(name="STAR_LN_PDF",data=empty_pdf))
+    hdul.append(_ln_pdf_hdu("STAR_LN_PDF", len(zgrid), "none", quantize_level,
+                            pdf_storage, ln_pdf_floor))
     quality_columns = fits.ColDefs([
         fits.Column(name="targetId", format="I", array=np.array([], dtype=np.int16)), 
         fits.Column(name="nbPixels",
@@ -218,7 +307,428 @@ def init_output_file(output_dir, catId, user_param, damd_version,stella_version,
         fits.Column(name="qsoOII3729Snr", format="E", array=np.array([], dtype=np.float32))
     ])
     hdul.append(fits.BinTableHDU.from_columns(quality_columns, name="QUALITY"))
-    fits.HDUList(hdul).writeto(path) 
+    fits.HDUList(hdul).writeto(path)
+
+
+def _is_per_target_hdu(hdu):
+    """Whether hdu holds rows appended for each target (grids do not)"""
+    if hdu.is_image:
+        return True
+    return "targetId" in hdu.columns.names
+
+
+def _get_nb_rows(hdu):
+    """Number of rows of a per-target hdu, read from its header"""
+    return hdu.header.get("NAXIS2", 0)
+
+
+def _shift_ids(rows, target_offset, model_offset):
+    """Shift targetId and modelId of rows coming from another file
+
+    Parameters
+    ----------
+    rows : :obj:`numpy.ndarray`
+        Binary table rows
+    target_offset : int
+        Number of targets already present in destination file
+    model_offset : int
+        Number of rows already present in destination candidates table
+
+    Return
+    ------
+    :obj:`numpy.ndarray`
+        Shifted copy of rows
+    """
+    rows = np.array(rows)
+    if "targetId" in rows.dtype.names:
+        rows["targetId"] += target_offset
+    if "modelId" in rows.dtype.names:
+        rows["modelId"] += model_offset
+    return rows
+
+
+def get_skipped_hdus(header):
+    """Names of the HDUs left empty according to the product level
+
+    Parameters
+    ----------
+    header : :obj:`astropy.io.fits.Header`
+        Primary header of a pfsCoZcandidates file
+
+    Return
+    ------
+    list
+        HDU names
+    """
+    return SKIPPED_HDUS[header.get("PRODLVL", "full")]
+
+
+def read_layout(path):
+    """Read the per-target HDUs layout of a pfsCoZcandidates file
+
+    Parameters
+    ----------
+    path : str
+        Path of a pfsCoZcandidates file created by `init_output_file`
+
+    Return
+    ------
+    dict
+        HDU name to empty rows with the HDU dtype and width
+    dict
+        HDU name to number of rows in file
+    dict
+        Sparse ln pdf HDU name to its ln pdf floor
+    """
+    layout = dict()
+    nb_rows = dict()
+    ln_pdf_floors = dict()
+    with fits.open(path) as hdulist:
+        skipped = get_skipped_hdus(hdulist[0].header)
+        for hdu in hdulist[1:]:
+            if not _is_per_target_hdu(hdu) or hdu.name in skipped:
+                continue
+            if "LNPFLOOR" in hdu.header:
+                ln_pdf_floors[hdu.name] = hdu.header["LNPFLOOR"]
+            if hdu.is_image:
+                layout[hdu.name] = np.empty((0, hdu.header["NAXIS1"]), dtype=np.float32)
+            else:
+                layout[hdu.name] = np.array(hdu.data[:0])
+            nb_rows[hdu.name] = _get_nb_rows(hdu)
+    return layout, nb_rows, ln_pdf_floors
+
+
+def sparsify_ln_pdf(ln_pdf, ln_pdf_floor):
+    """Cut the runs of ln pdf bins above floor in rows of `LN_PDF_CHUNK` bins
+
+    The maximum bin is always kept, so that a target has at least one row.
+
+    Parameters
+    ----------
+    ln_pdf : :obj:`numpy.ndarray`
+        Dense ln pdf
+    ln_pdf_floor : float
+        Bins below floor are dropped
+
+    Return
+    ------
+    :obj:`numpy.ndarray`
+        Start index of each row
+    :obj:`numpy.ndarray`
+        Values of each row, padded with NaN
+    """
+    ln_pdf = np.asarray(ln_pdf, dtype=np.float32)
+    keep = ln_pdf >= min(ln_pdf_floor, np.max(ln_pdf))
+    edges = np.diff(np.concatenate([[0], keep.astype(np.int8), [0]]))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+    if not len(run_starts):
+        return np.empty(0, dtype=np.int32), np.empty((0, LN_PDF_CHUNK), dtype=np.float32)
+    starts = np.concatenate([np.arange(start, end, LN_PDF_CHUNK)
+                             for start, end in zip(run_starts, run_ends)])
+    ends = np.minimum(starts + LN_PDF_CHUNK,
+                      run_ends[np.searchsorted(run_ends, starts, side="right")])
+    values = np.full((len(starts), LN_PDF_CHUNK), np.nan, dtype=np.float32)
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        values[i, :end - start] = ln_pdf[start:end]
+    return starts, values
+
+
+def expand_ln_pdf(hdu, nb_targets, fill_value=None):
+    """Get the dense ln pdf of all targets from a *_LN_PDF HDU
+
+    Parameters
+    ----------
+    hdu : :obj:`astropy.io.fits.ImageHDU` or :obj:`astropy.io.fits.BinTableHDU`
+        Dense or sparse ln pdf HDU
+    nb_targets : int
+        Number of targets
+    fill_value : float
+        Value of the bins not stored, defaults to the ln pdf floor. Targets
+        without rows (solver error) are set to 0 as in the dense layout.
+
+    Return
+    ------
+    :obj:`numpy.ndarray`
+        ln pdf, one row per target
+    """
+    if hdu.is_image:
+        if hdu.data is None:
+            return np.zeros((nb_targets, hdu.header.get("NAXIS1", 0)), dtype=np.float32)
+        return np.array(hdu.data, dtype=np.float32)
+    nb_bins = hdu.header["NBINS"]
+    if fill_value is None:
+        fill_value = hdu.header["LNPFLOOR"]
+    rows = hdu.data
+    dense = np.zeros((nb_targets, nb_bins), dtype=np.float32)
+    dense[np.unique(rows["targetId"])] = fill_value
+    bins = rows["start"][:, np.newaxis] + np.arange(LN_PDF_CHUNK)
+    targets = np.broadcast_to(rows["targetId"][:, np.newaxis], bins.shape)
+    values = rows["values"]
+    valid = ~np.isnan(values) & (bins < nb_bins)
+    dense[targets[valid], bins[valid]] = values[valid]
+    return dense
+
+
+def _is_quantized(hdu):
+    return isinstance(hdu, fits.CompImageHDU) and bool(hdu.quantize_level)
+
+
+def compress_output_file(path):
+    """Tile-compress the images of a pfsCoZcandidates file
+
+    Images are written uncompressed while processing and compressed once
+    all their rows are written, with the compression given to
+    `init_output_file`, so that quantized rows are quantized only once.
+    Images already compressed are left as is.
+
+    Parameters
+    ----------
+    path : str
+        Path of the pfsCoZcandidates file
+    """
+    with fits.open(path) as hdulist:
+        image_compression = hdulist[0].header.get("IMGCOMP", "none")
+        quantize_level = hdulist[0].header.get("QUANTLVL", 16)
+        if image_compression == "none":
+            return
+        hdus = [hdulist[0]]
+        for hdu in hdulist[1:]:
+            if hdu.is_image and not isinstance(hdu, fits.CompImageHDU):
+                data = hdu.data
+                if data is None:
+                    data = np.empty((0, hdu.header.get("NAXIS1", 0)), dtype=np.float32)
+                hdu = _image_hdu(hdu.name, np.array(data, dtype=np.float32),
+                                 image_compression, quantize_level)
+            hdus.append(hdu)
+        tmp_path = path + ".tmp"
+        fits.HDUList(hdus).writeto(tmp_path, overwrite=True)
+    os.replace(tmp_path, path)
+
+
+def clear_output_file(path):
+    """Remove all rows of the per-target HDUs of a pfsCoZcandidates file
+
+    Parameters
+    ----------
+    path : str
+        Path of the pfsCoZcandidates file
+    """
+    with fits.open(path, "update") as hdulist:
+        for hdu in hdulist[1:]:
+            if not _is_per_target_hdu(hdu) or not _get_nb_rows(hdu):
+                continue
+            if hdu.is_image:
+                hdu.data = np.empty((0, hdu.header["NAXIS1"]), dtype=np.float32)
+            else:
+                hdu.data = hdu.data[:0]
+
+
+def concatenate_output_files(path, shard_paths):
+    """Append pfsCoZcandidates shard files to path
+
+    Shards are appended in the given order, targetId and modelId of each
+    shard being renumbered after the rows already present in path.
+
+    Parameters
+    ----------
+    path : str
+        Path of the destination pfsCoZcandidates file
+    shard_paths : list
+        Paths of the shard files
+    """
+    writer = CoZcandidatesWriter(path)
+    for shard_path in shard_paths:
+        with fits.open(shard_path) as shard:
+            record = dict()
+            for hdu in shard[1:]:
+                # empty compressed images have no data
+                if hdu.name in writer.layout and hdu.data is not None:
+                    record[hdu.name] = np.array(hdu.data)
+            writer.append(record)
+    writer.flush()
+
+
+class GrowableArray:
+    """Rows buffer with amortized appends
+
+    Rows are stored in a preallocated array whose capacity doubles when full,
+    so that appending does not copy the rows already buffered.
+
+    Parameters
+    ----------
+    empty : :obj:`numpy.ndarray`
+        Empty array giving the rows dtype and, for images, the rows width
+    capacity : int
+        Number of rows initially allocated
+    """
+
+    def __init__(self, empty, capacity=8):
+        self._buffer = np.empty((max(capacity, 1),) + empty.shape[1:], dtype=empty.dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def data(self):
+        """View on the buffered rows"""
+        return self._buffer[:self._size]
+
+    def _reserve(self, size):
+        capacity = len(self._buffer)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        buffer = np.empty((capacity,) + self._buffer.shape[1:], dtype=self._buffer.dtype)
+        buffer[:self._size] = self.data
+        self._buffer = buffer
+
+    def append(self, rows):
+        """Append rows, converted to the buffer dtype
+
+        Parameters
+        ----------
+        rows : :obj:`numpy.ndarray`
+            Rows to append
+        """
+        nb_rows = len(rows)
+        self._reserve(self._size + nb_rows)
+        self._buffer[self._size:self._size + nb_rows] = rows
+        self._size += nb_rows
+
+    def new_rows(self, nb_rows):
+        """Append nb_rows uninitialized rows
+
+        Return
+        ------
+        :obj:`numpy.ndarray`
+            View on the new rows, to be filled in place
+        """
+        self._reserve(self._size + nb_rows)
+        self._size += nb_rows
+        return self._buffer[self._size - nb_rows:self._size]
+
+    def append_row(self, row):
+        """Append a single row, given as a tuple for tables
+
+        Return
+        ------
+        int
+            Index of the appended row
+        """
+        self._reserve(self._size + 1)
+        self._buffer[self._size] = row
+        self._size += 1
+        return self._size - 1
+
+    def clear(self):
+        """Drop buffered rows, keeping the allocated capacity"""
+        self._size = 0
+
+
+class CoZcandidatesWriter:
+    """Buffered writer of pfsCoZcandidates files
+
+    Rows of the per-target HDUs are kept in memory and appended to the file
+    in one pass every `flush_size` spectra or every `flush_interval` seconds.
+
+    Rows are given as records, one per spectrum, mapping HDU names to the
+    rows to add. Record targetId and modelId are relative to the record, they
+    are renumbered after the rows already buffered when appended and after the
+    rows already in file when flushed, so that several writers can share the
+    same file as long as flushes are serialized.
+
+    Parameters
+    ----------
+    path : str
+        Path of a pfsCoZcandidates file created by `init_output_file`
+    flush_size : int
+        Number of spectra buffered before flushing
+    flush_interval : float
+        Maximum time in seconds between two flushes, 0 to disable
+    """
+
+    def __init__(self, path, flush_size=1, flush_interval=0):
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.layout, self.nb_rows, self.ln_pdf_floors = read_layout(path)
+        self.pending = {name: GrowableArray(empty, max(flush_size, 1))
+                        for name, empty in self.layout.items()}
+        self._reset()
+
+    def _reset(self):
+        for pending in self.pending.values():
+            pending.clear()
+        self.nb_spectra = 0
+        self.last_flush = time.time()
+
+    def get_size(self, hdu_name):
+        """Number of rows of hdu_name, buffered rows included"""
+        return self.nb_rows[hdu_name] + len(self.pending[hdu_name])
+
+    def append(self, record):
+        """Buffer the rows of a spectrum
+
+        Parameters
+        ----------
+        record : dict
+            HDU name to rows with targetId and modelId relative to the record
+        """
+        target_offset = self.get_size("TARGET")
+        for name, rows in record.items():
+            if self.layout[name].ndim == 1:
+                rows = _shift_ids(rows, target_offset, self.get_size(name))
+            self.pending[name].append(rows)
+        self.nb_spectra += 1
+
+    def need_flush(self):
+        """Whether buffered rows should be written"""
+        if self.nb_spectra >= self.flush_size:
+            return True
+        return self.flush_interval > 0 and self.nb_spectra > 0 and \
+            time.time() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        """Append buffered rows to the file
+
+        When the file is shared, caller is responsible for holding the lock.
+        """
+        if not self.nb_spectra:
+            return
+        with fits.open(self.path, "update") as hdulist:
+            nb_rows = {name: _get_nb_rows(hdulist[name]) for name in self.pending}
+            for name, pending in self.pending.items():
+                if len(pending) and nb_rows[name] and _is_quantized(hdulist[name]):
+                    raise Exception(f"{name} of {self.path} is quantized, "
+                                    "its rows would be quantized again")
+            target_offset = nb_rows["TARGET"] - self.nb_rows["TARGET"]
+            for name, pending in self.pending.items():
+                if not len(pending):
+                    continue
+                rows = pending.data
+                hdu_data = hdulist[name].data
+                if rows.ndim == 2 and hdu_data is None:
+                    # empty tile-compressed image
+                    hdulist[name].data = np.array(rows)
+                elif rows.ndim == 2:
+                    hdulist[name].data = np.vstack([hdu_data, rows])
+                else:
+                    rows = _shift_ids(rows, target_offset, nb_rows[name] - self.nb_rows[name])
+                    hdulist[name].data = np.append(hdu_data, rows.astype(hdu_data.dtype))
+            hdulist.flush()
+        self.nb_rows = {name: nb_rows[name] + len(pending) for name, pending in self.pending.items()}
+        self._reset()
+
+    def fsync(self):
+        """Wait for the written rows to reach the disk"""
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
 
 def filter_warning(warning, bitlist):
@@ -245,6 +755,171 @@ def filter_warning(warning, bitlist):
     return warning & mask
 
 
+class InterpolationPlan:
+    """Linear interpolation from a native grid onto a regular grid
+
+    Bracketing indices and offsets are computed once, applying the plan
+    gives the same values as `numpy.interp`.
+
+    Parameters
+    ----------
+    native_grid : :obj:`numpy.ndarray`
+        Increasing native grid
+    regular_grid : :obj:`numpy.ndarray`
+        Grid to interpolate on
+    """
+
+    def __init__(self, native_grid, regular_grid):
+        native_grid = np.asarray(native_grid, dtype=np.float64)
+        regular_grid = np.asarray(regular_grid, dtype=np.float64)
+        self.left = regular_grid < native_grid[0]
+        self.right = regular_grid >= native_grid[-1]
+        index = np.searchsorted(native_grid, regular_grid, side="right") - 1
+        self.index = np.clip(index, 0, len(native_grid) - 2)
+        self.step = native_grid[self.index + 1] - native_grid[self.index]
+        self.offset = regular_grid - native_grid[self.index]
+
+    def apply(self, values):
+        """Interpolate values given on the native grid"""
+        values = np.asarray(values, dtype=np.float64)
+        slope = (values[self.index + 1] - values[self.index]) / self.step
+        result = slope * self.offset + values[self.index]
+        result[self.left] = values[0]
+        result[self.right] = values[-1]
+        return result
+
+
+# per process caches of regular grids and interpolation plans, they only
+# depend on the parameters and on the native grid
+_regular_z_grids = dict()
+_interpolation_plans = GridCache()
+# an interpolation plan is used when it agrees with convertToRegular within
+# this tolerance, far below the float32 precision of the stored ln pdf
+PLAN_RTOL = 1e-9
+PLAN_ATOL = 1e-9
+# per wavelength grid model flux conversion factors
+_model_factors = GridCache()
+# Name/WaveLength projections of the line catalogs, by catalog id
+_line_catalogs = dict()
+# object types whose missing model_parameters dataset was logged
+_missing_model_parameters = set()
+
+
+def get_line_catalog_projection(line_catalog):
+    """Cached Name and WaveLength columns of a line catalog
+
+    Parameters
+    ----------
+    line_catalog : :obj:`pandas.DataFrame`
+        Line catalog indexed by line id
+
+    Return
+    ------
+    :obj:`pandas.DataFrame`
+        Name and WaveLength columns
+    """
+    key = id(line_catalog)
+    entry = _line_catalogs.get(key)
+    if entry is None or entry[0]() is not line_catalog:
+        # entry is dropped with its catalog, whose id may then be reused
+        entry = (weakref.ref(line_catalog), line_catalog[["Name", "WaveLength"]].copy())
+        _line_catalogs[key] = entry
+        weakref.finalize(line_catalog, _line_catalogs.pop, key, None)
+    return entry[1]
+
+
+def get_model_factor(wavelength):
+    """Cached float32 factor converting model flux to the output unit
+
+    Parameters
+    ----------
+    wavelength : :obj:`numpy.ndarray`
+        Wavelength grid of the spectrum
+
+    Return
+    ------
+    :obj:`numpy.ndarray`
+        wavelength**2 / 2.99792458 * 1e14, as float32
+    """
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    return _model_factors.get(wavelength,
+                              lambda wavelength: np.float32(wavelength ** 2 * (1 / 2.99792458) * 10 ** 14))
+
+
+def get_regular_z_grid(object_type, parameters):
+    """Cached `get_final_regular_z_grid`"""
+    key = (object_type, id(parameters))
+    if key not in _regular_z_grids:
+        _regular_z_grids[key] = np.asarray(get_final_regular_z_grid(object_type, parameters))
+    return _regular_z_grids[key]
+
+
+def _get_native_pdf(drp1d_output, object_type):
+    """Native grid and ln pdf of the output, None when not available"""
+    try:
+        native_grid = np.asarray(drp1d_output.get_attribute(object_type, "pdf", "PDFZGrid"),
+                                 dtype=np.float64)
+        native_pdf = np.asarray(drp1d_output.get_attribute(object_type, "pdf", "LogZPdfNative"),
+                                dtype=np.float64)
+    except Exception:
+        return None, None
+    if native_grid.ndim != 1 or len(native_grid) < 2 or native_pdf.shape != native_grid.shape:
+        return None, None
+    return native_grid, native_pdf
+
+
+def convert_to_regular(drp1d_output, object_type, parameters):
+    """Get the ln pdf of an object type on the regular grid
+
+    The first conversion from a native grid is done by a PdfHandler with
+    `convertToRegular` and used to check the interpolation plan built for
+    this grid. Next ones only apply the plan to the native ln pdf, without
+    building a PdfHandler. If the plan differs from `convertToRegular` by
+    more than PLAN_RTOL and PLAN_ATOL, `convertToRegular` is kept for this
+    grid.
+
+    Parameters
+    ----------
+    drp1d_output : :obj:`ResultStoreOutput`
+        Output of the spectrum
+    object_type : str
+        Object type
+    parameters : :obj:`Parameters`
+        Parameters
+
+    Return
+    ------
+    :obj:`numpy.ndarray`
+        ln pdf on the regular grid
+    """
+    key = (object_type, id(parameters))
+    native_grid, native_pdf = _get_native_pdf(drp1d_output, object_type)
+    plan = None
+    if native_grid is not None:
+        plan = _interpolation_plans.lookup(native_grid, key)
+        if plan:
+            return plan.apply(native_pdf)
+    pdf_handler = BuilderPdfHandler().add_params(drp1d_output, object_type, True).build()
+    if native_grid is None or plan is False:
+        pdf_handler.convertToRegular()
+        return pdf_handler.valProbaLog
+    handler_grid = np.asarray(pdf_handler.redshifts, dtype=np.float64)
+    handler_pdf = np.asarray(pdf_handler.valProbaLog, dtype=np.float64)
+    pdf_handler.convertToRegular()
+    regular_pdf = np.asarray(pdf_handler.valProbaLog)
+    plan = InterpolationPlan(native_grid, get_regular_z_grid(object_type, parameters))
+    if not np.array_equal(handler_grid, native_grid) or \
+       not np.array_equal(handler_pdf, native_pdf, equal_nan=True) or \
+       regular_pdf.shape != plan.offset.shape or \
+       not np.allclose(plan.apply(native_pdf), regular_pdf, rtol=PLAN_RTOL, atol=PLAN_ATOL,
+                       equal_nan=True):
+        logging.getLogger("process_spectra").warning(
+            f"{object_type} pdf interpolation plan differs from convertToRegular, not used")
+        plan = False
+    _interpolation_plans.store(native_grid, plan, key)
+    return pdf_handler.valProbaLog
+
+
 class RedshiftCoCandidates:
 
     def __init__(self, drp1d_output, spectrum, logger, calibration_library):
@@ -253,18 +928,50 @@ class RedshiftCoCandidates:
         self.spectrum_infos = spectrum.get_spectrum_infos()
         self.logger = logger
         self.calibration_library = calibration_library
-        self.hdulist = None
-        
+        self.record = None
+        self._model_conversion = None
+        self._lines = dict()
+
+    def get_output_path(self, output_dir):
+        return os.path.join(output_dir, get_output_filename(
+            self.spectrum_infos["pfs_object_id"]["catId"]))
+
     def write_fits(self, output_dir):
+        writer = CoZcandidatesWriter(self.get_output_path(output_dir))
+        self.write(writer)
+        writer.flush()
+
+    def write(self, writer):
+        """Buffer the spectrum rows into writer
+
+        Parameters
+        ----------
+        writer : :obj:`CoZcandidatesWriter`
+            Writer of the pfsCoZcandidates file
+        """
+        objId = self.spectrum_infos["pfs_object_id"]["objId"]
+        self.logger.log(logging.INFO,f"add data to {writer.path} from {objId}")
+        writer.append(self.get_record(writer.layout, writer.ln_pdf_floors))
+
+    def get_record(self, layout, ln_pdf_floors=None):
+        """Build the rows of the spectrum for each pfsCoZcandidates HDU
 
+        Parameters
+        ----------
+        layout : dict
+            HDU name to empty rows, as given by `CoZcandidatesWriter.layout`
+        ln_pdf_floors : dict
+            Sparse ln pdf HDU name to ln pdf floor
+
+        Return
+        ------
+        dict
+            HDU name to rows, targetId and modelId starting from 0
+        """
         params = self.calibration_library.parameters
         object_types = params.get_spectrum_models()
-        self.path = os.path.join(output_dir, "pfsCoZcandidates-%05d.fits" % (
-            self.spectrum_infos["pfs_object_id"]["catId"]))
-        objId = self.spectrum_infos["pfs_object_id"]["objId"]
-        self.logger.log(logging.INFO,f"add data to {self.path} from {objId}")
-        
-        self.hdulist = fits.open(self.path, "update")
+        self.record = {name: GrowableArray(empty) for name, empty in layout.items()}
+        self.ln_pdf_floors = ln_pdf_floors or dict()
         try:
             targetId = self.add_target()
         except Exception as e:
@@ -292,7 +999,7 @@ class RedshiftCoCandidates:
             if has_galaxy and not self.drp1d_output.has_error("galaxy","redshiftSolver"):
                 self.add_object_candidates("galaxy", targetId)
                 self.add_model("galaxy")
-            self.add_object_pdf("galaxy")
+            self.add_object_pdf("galaxy", targetId)
         except Exception as e:
             raise Exception(f'failed to write galaxy : {e}')
         try:
@@ -308,7 +1015,7 @@ class RedshiftCoCandidates:
             if has_qso and not self.drp1d_output.has_error("qso","redshiftSolver"):
                 self.add_object_candidates("qso", targetId)
                 self.add_model("qso")
-            self.add_object_pdf("qso")
+            self.add_object_pdf("qso", targetId)
         except Exception as e:
             raise Exception(f'failed to write qso : {e}')
         try:
@@ -322,7 +1029,7 @@ class RedshiftCoCandidates:
             if has_star and not self.drp1d_output.has_error("star","redshiftSolver"):
                 self.add_star_candidates(targetId)
                 self.add_model("star")
-            self.add_object_pdf("star")
+            self.add_object_pdf("star", targetId)
         except Exception as e:
             raise Exception(f'failed to write star : {e}')
 
@@ -331,37 +1038,20 @@ class RedshiftCoCandidates:
         except Exception as e:
             log_exception(self.logger, e)
             raise Exception(f'failed to write quality : {e}')
-        self.hdulist.flush()
-        self.hdulist.close()
-        
+        return {name: rows.data for name, rows in self.record.items()}
+
     def add_line_to_hdu(self, hdu_name, line):
         #self.logger.log(logging.INFO,f"add {line} to {hdu_name}") 
-        hdu_data = self.hdulist[hdu_name].data
-        targetId = len(hdu_data)
-        new_data = np.append(hdu_data,
-                             np.array([tuple([targetId]+line)],
-                                      dtype=hdu_data.dtype)
-                             )
-        self.hdulist[hdu_name].data = new_data
-
-        return targetId
+        rows = self.record[hdu_name]
+        return rows.append_row(tuple([len(rows)]+line))
 
     def add_lines_to_hdu(self, hdu_name, lines):
         #self.logger.log(logging.INFO,f"add {lines} to {hdu_name}")
-        hdu_data = self.hdulist[hdu_name].data
-        new_data = np.append(hdu_data,
-                             lines,
-                             )
-        self.hdulist[hdu_name].data = new_data
+        self.record[hdu_name].append(lines)
 
     def add_array_to_image_hdu(self, hdu_name, array):
         #self.logger.log(logging.INFO,f"add {array} to {hdu_name}")
-
-        hdu_data = self.hdulist[hdu_name].data
-        new_data = np.vstack([hdu_data,
-                             np.array([array],dtype=np.float32)
-                                      ])
-        self.hdulist[hdu_name].data = new_data
+        self.record[hdu_name].append_row(array)
         
     def add_target(self):
         pfsObjectId = self.spectrum_infos["pfs_object_id"]
@@ -376,14 +1066,11 @@ class RedshiftCoCandidates:
                        self.spectrum_infos["targetType"]]
         return self.add_line_to_hdu("TARGET",new_target)
 
-    def get_binary_table_size(self, hdu_name):
-        with fits.open(self.path) as hdulist:
-            hdu_data = hdulist[hdu_name].data
-            return len(hdu_data)
-        
     def get_error_code(self, ot, stage):
         try:
             err = self.drp1d_output.get_error(ot,stage)
+            if err["code"] in PIPELINE_ERROR_CODES:
+                return PIPELINE_ERROR_CODES[err["code"]]
             return ErrorCode[err["code"]].value
         except:
             return 0
@@ -529,43 +1216,48 @@ class RedshiftCoCandidates:
         dtype.append(('modelId','i4'))
         zcandidates = np.ndarray((nb_candidates,),
                                  dtype=dtype)
-        model_index = self.get_binary_table_size(f"{object_type.upper()}_CANDIDATES")
-        for rank in range(nb_candidates):
-            zcandidates[rank]['targetId'] = targetId
-            zcandidates[rank]['redshift'] = self.drp1d_output.get_candidate_data(object_type, rank, "Redshift")
-            zcandidates[rank]['redshiftError'] = self.drp1d_output.get_candidate_data(object_type, rank, "RedshiftUncertainty")
-            zcandidates[rank]['cRank'] = rank
-            zcandidates[rank]['redshiftProba'] = self.drp1d_output.get_candidate_data(object_type, rank, "RedshiftProba")
-            if params.get_redshift_solver_method(object_type).value == "lineModelSolve":
-                zcandidates[rank]['subClass'] = self.drp1d_output.get_candidate_data(object_type, rank, "SubType")
-                zcandidates[rank]['lineCatalogRatioFile'] = self.drp1d_output.get_candidate_data(object_type, rank, "LinesRatioName")
-                zcandidates[rank]['emissionVelocity'] = self.drp1d_output.get_candidate_data(object_type, rank, "VelocityEmission")
-                zcandidates[rank]['absorptionVelocity'] = self.drp1d_output.get_candidate_data(object_type, rank, "VelocityAbsorption")        
-                zcandidates[rank]['continuumReducedLeastSquare'] = self.drp1d_output.get_candidate_data(object_type, rank, "ContinuumReducedLeastSquare")
-                zcandidates[rank]['continuumPValue'] = self.drp1d_output.get_candidate_data(object_type, rank, "ContinuumPValue")
-                for measure in ["Mean","Std","Skewness","Kurtosis","Ks","KsStd","KsStdMean","Anderson"]:
-                    zcandidates[rank][f'continuumResiduals{measure}'] = self.drp1d_output.get_candidate_data(object_type, rank, f"ContinuumResiduals{measure}")
-                    zcandidates[rank][f'residuals{measure}'] = self.drp1d_output.get_candidate_data(object_type, rank, f"Residuals{measure}")
-                    
-                zcandidates[rank]['pValue'] = self.drp1d_output.get_candidate_data(object_type, rank, "PValue")
-                zcandidates[rank]['reducedLeastSquare'] = self.drp1d_output.get_candidate_data(object_type, rank, "ReducedChi2")
-            else:
-                zcandidates[rank]['subClass'] = ""
-                zcandidates[rank]['lineCatalogRatioFile'] = ""
-                zcandidates[rank]['emissionVelocity'] = np.nan
-                zcandidates[rank]['absorptionVelocity'] = np.nan
-                zcandidates[rank]['continuumReducedLeastSquare'] = -1
-                zcandidates[rank]['continuumPValue'] = -1
-                for measure in ["Mean","Std","Skewness","Kurtosis","Ks","KsStd","KsStdMean","Anderson"]:
-                    zcandidates[rank][f'continuumResiduals{measure}'] = -1
-                    zcandidates[rank][f'residuals{measure}'] = self.drp1d_output.get_candidate_data(object_type, rank, f"ContinuumResiduals{measure}")
-                zcandidates[rank]['pValue'] = self.drp1d_output.get_candidate_data(object_type, rank, "ContinuumPValue")
-                zcandidates[rank]['reducedLeastSquare'] = self.drp1d_output.get_candidate_data(object_type, rank, "ContinuumReducedLeastSquare")
-            zcandidates[rank]['continuumFile'] = self.drp1d_output.get_candidate_data(object_type, rank, "ContinuumName")
-                            
-            zcandidates[rank]['modelId'] = model_index
-            model_index = model_index + 1
-            
+        model_index = len(self.record[f"{object_type.upper()}_CANDIDATES"])
+        measures = ["Mean","Std","Skewness","Kurtosis","Ks","KsStd","KsStdMean","Anderson"]
+        names = ["Redshift", "RedshiftUncertainty", "RedshiftProba", "ContinuumName"]
+        if params.get_redshift_solver_method(object_type).value == "lineModelSolve":
+            names += ["SubType", "LinesRatioName", "VelocityEmission", "VelocityAbsorption",
+                      "ContinuumReducedLeastSquare", "ContinuumPValue", "PValue", "ReducedChi2"]
+            names += [f"ContinuumResiduals{measure}" for measure in measures]
+            names += [f"Residuals{measure}" for measure in measures]
+            candidates = self._get_candidates_data(object_type, nb_candidates, names)
+            zcandidates['subClass'] = candidates["SubType"]
+            zcandidates['lineCatalogRatioFile'] = candidates["LinesRatioName"]
+            zcandidates['emissionVelocity'] = candidates["VelocityEmission"]
+            zcandidates['absorptionVelocity'] = candidates["VelocityAbsorption"]
+            zcandidates['continuumReducedLeastSquare'] = candidates["ContinuumReducedLeastSquare"]
+            zcandidates['continuumPValue'] = candidates["ContinuumPValue"]
+            for measure in measures:
+                zcandidates[f'continuumResiduals{measure}'] = candidates[f"ContinuumResiduals{measure}"]
+                zcandidates[f'residuals{measure}'] = candidates[f"Residuals{measure}"]
+            zcandidates['pValue'] = candidates["PValue"]
+            zcandidates['reducedLeastSquare'] = candidates["ReducedChi2"]
+        else:
+            names += ["ContinuumPValue", "ContinuumReducedLeastSquare"]
+            names += [f"ContinuumResiduals{measure}" for measure in measures]
+            candidates = self._get_candidates_data(object_type, nb_candidates, names)
+            zcandidates['subClass'] = ""
+            zcandidates['lineCatalogRatioFile'] = ""
+            zcandidates['emissionVelocity'] = np.nan
+            zcandidates['absorptionVelocity'] = np.nan
+            zcandidates['continuumReducedLeastSquare'] = -1
+            zcandidates['continuumPValue'] = -1
+            for measure in measures:
+                zcandidates[f'continuumResiduals{measure}'] = -1
+                zcandidates[f'residuals{measure}'] = candidates[f"ContinuumResiduals{measure}"]
+            zcandidates['pValue'] = candidates["ContinuumPValue"]
+            zcandidates['reducedLeastSquare'] = candidates["ContinuumReducedLeastSquare"]
+        zcandidates['targetId'] = targetId
+        zcandidates['cRank'] = np.arange(nb_candidates)
+        zcandidates['redshift'] = candidates["Redshift"]
+        zcandidates['redshiftError'] = candidates["RedshiftUncertainty"]
+        zcandidates['redshiftProba'] = candidates["RedshiftProba"]
+        zcandidates['continuumFile'] = candidates["ContinuumName"]
+        zcandidates['modelId'] = np.arange(model_index, model_index + nb_candidates)
 
         self.add_lines_to_hdu(f"{object_type.upper()}_CANDIDATES",zcandidates)
 
@@ -589,32 +1281,86 @@ class RedshiftCoCandidates:
         dtype.append(('modelId','i4'))
         zcandidates = np.ndarray((nb_candidates,),
                                  dtype=dtype)
-        model_index = self.get_binary_table_size(f"STAR_CANDIDATES")
+        model_index = len(self.record["STAR_CANDIDATES"])
+        measures = ["Mean","Std","Skewness","Kurtosis","Ks","KsStd","KsStdMean","Anderson"]
+        names = ["Redshift", "RedshiftUncertainty", "RedshiftProba", "ContinuumName",
+                 "ContinuumPValue", "ContinuumReducedLeastSquare"]
+        names += [f"ContinuumResiduals{measure}" for measure in measures]
+        candidates = self._get_candidates_data("star", nb_candidates, names)
+
+        zcandidates['targetId'] = targetId
+        zcandidates['velocity'] = np.array(candidates["Redshift"], dtype=np.float64) * speed_of_light_kms
+        zcandidates['velocityError'] = np.array(candidates["RedshiftUncertainty"], dtype=np.float64) * speed_of_light_kms
+        zcandidates['cRank'] = np.arange(nb_candidates)
+        zcandidates['velocityProba'] = candidates["RedshiftProba"]
+        zcandidates['subClass'] = "" # ContinuumName.split("_")[0]
+        zcandidates['templateFile'] = candidates["ContinuumName"]
+        zcandidates['pValue'] = candidates["ContinuumPValue"]
+        zcandidates['reducedLeastSquare'] = candidates["ContinuumReducedLeastSquare"]
+        for measure in measures:
+            zcandidates[f'residuals{measure}'] = candidates[f"ContinuumResiduals{measure}"]
+        zcandidates['modelId'] = np.arange(model_index, model_index + nb_candidates)
 
-        for rank in range(nb_candidates):
-            zcandidates[rank]['targetId'] = targetId
-            zcandidates[rank]['velocity'] = self.drp1d_output.get_candidate_data("star", rank, "Redshift") * speed_of_light_kms
-            zcandidates[rank]['velocityError'] = self.drp1d_output.get_candidate_data("star", rank, "RedshiftUncertainty") * speed_of_light_kms
-            zcandidates[rank]['cRank'] = rank
-            zcandidates[rank]['velocityProba'] = self.drp1d_output.get_candidate_data("star", rank, "RedshiftProba")
-            zcandidates[rank]['subClass'] = "" # self.drp1d_output.get_candidate_data("star", rank, "ContinuumName").split("_")[0]
-            zcandidates[rank]['templateFile'] = self.drp1d_output.get_candidate_data("star", rank, "ContinuumName")
-            zcandidates[rank]['pValue'] = self.drp1d_output.get_candidate_data("star", rank, "ContinuumPValue")
-            zcandidates[rank]['reducedLeastSquare'] = self.drp1d_output.get_candidate_data("star", rank, "ContinuumReducedLeastSquare")
-            for measure in ["Mean","Std","Skewness","Kurtosis","Ks","KsStd","KsStdMean","Anderson"]:
-                zcandidates[rank][f'residuals{measure}'] = self.drp1d_output.get_candidate_data("star", rank, f"ContinuumResiduals{measure}")
-
-            zcandidates[rank]['modelId'] = model_index
-            model_index = model_index + 1
-            
         self.add_lines_to_hdu('STAR_CANDIDATES', zcandidates)
 
+    def _get_candidates_data(self, object_type, nb_candidates, names):
+        """Get candidates attributes for all ranks
+
+        The candidate dataset of each rank is read in one call, attributes
+        not found there are requested one by one.
+
+        Parameters
+        ----------
+        object_type : str
+            Object type
+        nb_candidates : int
+            Number of candidates
+        names : list
+            Attributes names
+
+        Return
+        ------
+        dict
+            Attribute name to list of values ordered by rank
+        """
+        candidates = {name: [] for name in names}
+        for rank in range(nb_candidates):
+            try:
+                dataset = self.drp1d_output.get_dataset(object_type, "model_parameters", rank) or {}
+            except AmazedError as e:
+                if object_type not in _missing_model_parameters:
+                    _missing_model_parameters.add(object_type)
+                    logging.getLogger("process_spectra").info(
+                        f"{object_type} model_parameters dataset not found ({e}), "
+                        "candidates attributes requested one by one")
+                dataset = {}
+            for name in names:
+                if name in dataset:
+                    value = dataset[name]
+                else:
+                    value = self.drp1d_output.get_candidate_data(object_type, rank, name)
+                candidates[name].append(value)
+        return candidates
+
     def _get_lines(self, object_type):
+        # computed once per spectrum, callers must not modify it
+        if object_type in self._lines:
+            return self._lines[object_type]
         fr = pd.DataFrame(self.drp1d_output.get_dataset(object_type, "linemeas"))
         fr = fr[fr["LinemeasLineLambda"] > 0]
         fr = fr.set_index("LinemeasLineID")
-        line_catalog = self.calibration_library.line_catalogs_df[object_type]["lineMeasSolve"]
-        fr = pd.merge(fr, line_catalog[["Name", "WaveLength"]], left_index=True, right_index=True)
+        line_catalog = get_line_catalog_projection(
+            self.calibration_library.line_catalogs_df[object_type]["lineMeasSolve"])
+        if line_catalog.index.is_unique:
+            # same rows and order as an inner merge on index
+            positions = line_catalog.index.get_indexer(fr.index)
+            fr = fr[positions >= 0].copy()
+            positions = positions[positions >= 0]
+            fr["Name"] = line_catalog["Name"].to_numpy()[positions]
+            fr["WaveLength"] = line_catalog["WaveLength"].to_numpy()[positions]
+        else:
+            fr = pd.merge(fr, line_catalog, left_index=True, right_index=True)
+        self._lines[object_type] = fr
         return fr
     
     def add_object_lines(self, object_type, targetId):
@@ -635,54 +1381,69 @@ class RedshiftCoCandidates:
                                    ('lineEWError', 'f4'),
                                    ('lineContinuumLevel', 'f4'),
                                    ('lineContinuumLevelError', 'f4')])
-        zi = 0
         z = self.drp1d_output.get_attribute(object_type, "linemeas_parameters", "LinemeasRedshift" )
-        for i in list(fr.index):
-            zlines[zi]['targetId']=targetId           
-            zlines[zi]['lineName'] = fr.at[i, "Name"]
-            zlines[zi]['lineWave'] = fr.at[i, "LinemeasLineLambda"]*0.1
-            offset = fr.at[i, "LinemeasLineOffset"]
-            zlines[zi]['lineZ'] = z + offset/speed_of_light_kms + z*offset/speed_of_light_kms
-            zlines[zi]['lineZError'] = fr.at[i, "LinemeasLineOffsetUncertainty"]/speed_of_light_kms*(1+z)
-            zlines[zi]['lineSigma'] = fr.at[i,"LinemeasLineWidth"]/10.
-            zlines[zi]['lineSigmaError'] = fr.at[i,"LinemeasLineWidthUncertainty"]/10.
-            zlines[zi]['lineVelocity'] = fr.at[i,"LinemeasLineVelocity"]
-            zlines[zi]['lineVelocityError'] = fr.at[i,"LinemeasLineVelocityUncertainty"]
-            # erg/cm2/s -> 10^-35 W/m2 : erg/cm2/s=10^-7W/cm2=10^-3W/m2 -> *10^-3
-            zlines[zi]['lineFlux'] = fr.at[i, "LinemeasLineFlux"] * 10**-3
-            zlines[zi]['lineFluxError'] = fr.at[i, "LinemeasLineFluxUncertainty"] * 10**-3
-            zlines[zi]['lineEW'] = fr.at[i, "LinemeasEquivalentWidth"]/10.
-            zlines[zi]['lineEWError'] = fr.at[i, "LinemeasEquivalentWidthUncertainty"]/10.
-            zlines[zi]['lineContinuumLevel'] = (zlines[zi]['lineWave']**2) * fr.at[i,"LinemeasLineContinuumFlux"]* (1 / 2.99792458) * 10 ** 16
-            zlines[zi]['lineContinuumLevelError'] = (zlines[zi]['lineWave']**2) * fr.at[i,"LinemeasLineContinuumFluxUncertainty"]* (1 / 2.99792458) * 10 ** 16
-            zi = zi+1
+        zlines['targetId'] = targetId
+        zlines['lineName'] = fr["Name"].to_numpy()
+        zlines['lineWave'] = fr["LinemeasLineLambda"].to_numpy()*0.1
+        offset = fr["LinemeasLineOffset"].to_numpy()
+        zlines['lineZ'] = z + offset/speed_of_light_kms + z*offset/speed_of_light_kms
+        zlines['lineZError'] = fr["LinemeasLineOffsetUncertainty"].to_numpy()/speed_of_light_kms*(1+z)
+        zlines['lineSigma'] = fr["LinemeasLineWidth"].to_numpy()/10.
+        zlines['lineSigmaError'] = fr["LinemeasLineWidthUncertainty"].to_numpy()/10.
+        zlines['lineVelocity'] = fr["LinemeasLineVelocity"].to_numpy()
+        zlines['lineVelocityError'] = fr["LinemeasLineVelocityUncertainty"].to_numpy()
+        # erg/cm2/s -> 10^-35 W/m2 : erg/cm2/s=10^-7W/cm2=10^-3W/m2 -> *10^-3
+        zlines['lineFlux'] = fr["LinemeasLineFlux"].to_numpy() * 10**-3
+        zlines['lineFluxError'] = fr["LinemeasLineFluxUncertainty"].to_numpy() * 10**-3
+        zlines['lineEW'] = fr["LinemeasEquivalentWidth"].to_numpy()/10.
+        zlines['lineEWError'] = fr["LinemeasEquivalentWidthUncertainty"].to_numpy()/10.
+        # continuum level uses the float32 rounded wavelength, as stored
+        zlines['lineContinuumLevel'] = (zlines['lineWave']**2) * fr["LinemeasLineContinuumFlux"].to_numpy()* (1 / 2.99792458) * 10 ** 16
+        zlines['lineContinuumLevelError'] = (zlines['lineWave']**2) * fr["LinemeasLineContinuumFluxUncertainty"].to_numpy()* (1 / 2.99792458) * 10 ** 16
         self.add_lines_to_hdu(f'{object_type.upper()}_LINES',zlines)
 
     def add_model(self, object_type):
+        if f'{object_type.upper()}_MODELS' not in self.record:
+            # not produced at this product level
+            return
         if object_type in self.drp1d_output.object_results:
             nb_candidates = self.drp1d_output.get_nb_candidates(object_type)
         else:
             nb_candidates = 0
+        models = self.record[f'{object_type.upper()}_MODELS'].new_rows(nb_candidates)
         for rank in range(nb_candidates):
-            model = self._get_model_on_lambda_range(object_type, rank)
-            self.add_array_to_image_hdu(f'{object_type.upper()}_MODELS',model)
+            self._get_model_on_lambda_range(object_type, rank, models[rank])
         
-    def add_object_pdf(self, object_type):
+    def add_object_pdf(self, object_type, targetId):
+        if f'{object_type.upper()}_LN_PDF' not in self.record:
+            # not produced at this product level
+            return
         if not self.drp1d_output.has_error(object_type,"redshiftSolver"):
             try:
                 ln_pdf = np.float32(self.drp1d_output.get_attribute(object_type,"pdf","LogZPdfNative"))
             except Exception as e:
                 raise Exception(f"Failed to get {object_type} pdf : {e}")
-            builder = BuilderPdfHandler()
-            pdfHandler = builder.add_params(self.drp1d_output, object_type, True).build()
-            pdfHandler.convertToRegular()
-            pdf = pdfHandler.valProbaLog
+            pdf = convert_to_regular(self.drp1d_output, object_type, self.calibration_library.parameters)
         else:
-            zgrid = get_final_regular_z_grid(object_type, self.calibration_library.parameters)
+            zgrid = get_regular_z_grid(object_type, self.calibration_library.parameters)
             pdf = np.zeros(len(zgrid)) 
-        self.add_array_to_image_hdu(f'{object_type.upper()}_LN_PDF',
+        hdu_name = f'{object_type.upper()}_LN_PDF'
+        if hdu_name in self.ln_pdf_floors:
+            # solver errors have no rows in sparse tables
+            if not self.drp1d_output.has_error(object_type,"redshiftSolver"):
+                self.add_sparse_pdf(hdu_name, pdf, targetId)
+            return
+        self.add_array_to_image_hdu(hdu_name,
                                     pdf)
 
+    def add_sparse_pdf(self, hdu_name, pdf, targetId):
+        starts, values = sparsify_ln_pdf(pdf, self.ln_pdf_floors[hdu_name])
+        rows = np.empty(len(starts), dtype=self.record[hdu_name].data.dtype)
+        rows['targetId'] = targetId
+        rows['start'] = starts
+        rows['values'] = values
+        self.add_lines_to_hdu(hdu_name, rows)
+
     def add_quality(self):
         attrs = [self._get_nb_valid_points()]
         for o in ["galaxy","qso"]:
@@ -712,14 +1473,31 @@ class RedshiftCoCandidates:
                 
         self.add_line_to_hdu("QUALITY",attrs)
         
-    def _get_model_on_lambda_range(self, object_type, rank):
-        wavelength = self.spectrum.get_wave(filtered_only=False)
-        mask = self.spectrum.get_others(filtered_only=False)["mask"]
-        model = np.array(wavelength, dtype=np.float64, copy=True)
+    def _get_model_conversion(self):
+        # unmasked pixels and their conversion factor, shared by all candidates
+        if self._model_conversion is None:
+            wavelength = self.spectrum.get_wave(filtered_only=False)
+            mask = self.spectrum.get_others(filtered_only=False)["mask"]
+            unmasked = np.asarray(mask) == 0
+            valid = np.flatnonzero(unmasked)
+            self._model_conversion = (unmasked, valid, get_model_factor(wavelength)[valid])
+        return self._model_conversion
+
+    def _get_model_on_lambda_range(self, object_type, rank, model=None):
+        """Model of a candidate on the spectrum wavelength grid, NaN on masked pixels
+
+        Model flux values are placed on the unmasked pixels as np.place does.
+        Computed in float32 into model if given.
+        """
+        unmasked, valid, factor = self._get_model_conversion()
+        if model is None:
+            model = np.empty(len(self.spectrum.get_wave(filtered_only=False)), dtype=np.float32)
         model.fill(np.nan)
-        np.place(model, mask == 0, self.drp1d_output.get_dataset(object_type,"model",rank)["ModelFlux"])
-        model = np.multiply(np.array(wavelength) ** 2, np.array(model)) * (1 / 2.99792458) * 10 ** 14
-        return np.float32(model)
+        flux = np.asarray(self.drp1d_output.get_dataset(object_type,"model",rank)["ModelFlux"],
+                          dtype=np.float32)
+        np.place(model, unmasked, flux)
+        model[valid] *= factor
+        return model
 
     def _get_pdf_grid(self, object_type):
         builder = BuilderPdfHandler()
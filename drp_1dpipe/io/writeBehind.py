@@ -0,0 +1,116 @@
+import queue
+import logging
+import threading
+
+
+class WriteBehindWriter:
+    """Writer handing records to a :obj:`WriteBehind` thread
+
+    Same interface as :obj:`CoZcandidatesWriter`, records are queued as
+    soon as they are appended, buffering and writing being done by the
+    write-behind thread.
+
+    Parameters
+    ----------
+    writer : :obj:`CoZcandidatesWriter`
+        Writer of the pfsCoZcandidates file, used by the thread only
+    write_behind : :obj:`WriteBehind`
+        Write-behind thread
+    """
+
+    def __init__(self, writer, write_behind):
+        self.writer = writer
+        self.write_behind = write_behind
+        self.path = writer.path
+        self.layout = writer.layout
+        self.ln_pdf_floors = writer.ln_pdf_floors
+
+    def append(self, record):
+        """Queue the rows of a spectrum, waiting if the queue is full"""
+        self.write_behind.put(self.writer, record)
+
+    def need_flush(self):
+        return False
+
+    def flush(self):
+        pass
+
+
+class WriteBehind:
+    """Thread appending records to writers and flushing them
+
+    Records are queued by the processing loop, which can start the next
+    spectrum while the thread waits for the output file lock and writes.
+    The queue is bounded so that records do not pile up in memory when
+    writing is slower than processing. A failure to buffer a record stops
+    the writing, the queued records being discarded, and is raised by the
+    next `put` and by `close`.
+
+    Parameters
+    ----------
+    flush : callable
+        Called with a writer to write its buffered rows, taking the lock
+        when the output file is shared
+    maxsize : int
+        Maximum number of queued records
+    logger : :obj:`logging.Logger`
+        Logger of the write errors
+    """
+
+    def __init__(self, flush, maxsize, logger=None):
+        self._flush = flush
+        self.logger = logger or logging.getLogger("write_behind")
+        self.records = queue.Queue(max(maxsize, 1))
+        self.writers = dict()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, writer, record):
+        """Queue a record for writer, waiting if the queue is full"""
+        if self.error is not None:
+            raise self.error
+        self.records.put((writer, record))
+
+    def _flush_writer(self, writer):
+        try:
+            self._flush(writer)
+        except Exception as e:
+            # rows are kept buffered for next flush
+            self.logger.error(f"Failed to write fits results to {writer.path} : {e}")
+
+    def _run(self):
+        while True:
+            message = self.records.get()
+            if message is None:
+                return
+            if self.error is not None:
+                # keeps the queue drained so that put does not block
+                continue
+            writer, record = message
+            self.writers[writer.path] = writer
+            try:
+                writer.append(record)
+                need_flush = writer.need_flush()
+            except Exception as e:
+                self.logger.error(f"Failed to buffer results for {writer.path} : {e}")
+                self.error = e
+                continue
+            if need_flush:
+                self._flush_writer(writer)
+
+    def close(self):
+        """Write the queued records and wait for them to reach the disk
+
+        Raises
+        ------
+        Exception
+            Failure to buffer a record
+        """
+        self.records.put(None)
+        self.thread.join()
+        for writer in self.writers.values():
+            self._flush_writer(writer)
+            writer.fsync()
+        if self.error is not None:
+            raise self.error
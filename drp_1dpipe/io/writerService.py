@@ -0,0 +1,191 @@
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+from drp_1dpipe.core.logger import init_logger
+from drp_1dpipe.io.redshiftCoCandidates import CoZcandidatesWriter, read_layout
+from drp_1dpipe.io.columnarOutput import H5CandidatesWriter
+
+
+class ServiceWriter:
+    """Writer forwarding records to the pfsCoZcandidates writer service
+
+    Same interface as :obj:`CoZcandidatesWriter`, records are sent to the
+    service as soon as they are appended, buffering and writing being done
+    by the service.
+
+    Parameters
+    ----------
+    path : str
+        Path of the pfsCoZcandidates file
+    connection : :obj:`multiprocessing.connection.Connection`
+        Connection to the writer service
+    """
+
+    def __init__(self, path, connection):
+        self.path = path
+        self.connection = connection
+        self.layout, _, self.ln_pdf_floors = read_layout(path)
+
+    def append(self, record):
+        """Send the rows of a spectrum to the service"""
+        self.connection.send((self.path, record))
+
+    def need_flush(self):
+        return False
+
+    def flush(self):
+        pass
+
+
+def connect(address):
+    """Connect to the writer service listening on address"""
+    return Client(address, family="AF_UNIX")
+
+
+def _receive(connection, messages):
+    """Forward messages received on connection until it is closed"""
+    with connection:
+        while True:
+            try:
+                messages.put(connection.recv())
+            except EOFError:
+                return
+
+
+def _flush(writer, logger):
+    try:
+        writer.flush()
+    except Exception as e:
+        # rows are kept buffered for next flush
+        logger.error(f"Failed to write fits results to {writer.path} : {e}")
+
+
+def serve(address, flush_size, flush_interval, logdir, log_level, ready=None, output_backend="fits"):
+    """Append the records sent by process_spectra to pfsCoZcandidates files
+
+    Records are received as (path, record) messages, one connection per
+    bunch, and buffered in a :obj:`CoZcandidatesWriter` per file. The service
+    stops on a None message, once all connections are closed.
+
+    Parameters
+    ----------
+    address : str
+        Unix socket path to listen on
+    flush_size : int
+        Number of spectra buffered before writing a file
+    flush_interval : float
+        Maximum time in seconds records stay buffered, 0 to disable
+    logdir : str
+        Log directory
+    log_level : int
+        Log level
+    ready : :obj:`multiprocessing.Event`
+        Set once the service is listening
+    output_backend : str
+        Write rows to the pfsCoZcandidates files (fits) or to their HDF5
+        files (hdf5)
+    """
+    logger = init_logger("writer_service", logdir, log_level)
+    messages = queue.Queue()
+    receivers = []
+    listener = Listener(address, family="AF_UNIX")
+
+    def accept():
+        while True:
+            try:
+                connection = listener.accept()
+            except OSError:
+                return
+            receiver = threading.Thread(target=_receive, args=(connection, messages), daemon=True)
+            receiver.start()
+            receivers.append(receiver)
+
+    threading.Thread(target=accept, daemon=True).start()
+    if ready is not None:
+        ready.set()
+    logger.info(f"listening on {address}")
+
+    writers = dict()
+    writer_class = H5CandidatesWriter if output_backend == "hdf5" else CoZcandidatesWriter
+
+    def append(message):
+        path, record = message
+        if path not in writers:
+            writers[path] = writer_class(path, flush_size, flush_interval)
+        writers[path].append(record)
+
+    timeout = flush_interval if flush_interval > 0 else None
+    while True:
+        try:
+            message = messages.get(timeout=timeout)
+        except queue.Empty:
+            message = ()
+        if message is None:
+            break
+        if message:
+            append(message)
+        for writer in writers.values():
+            if writer.need_flush():
+                _flush(writer, logger)
+
+    # records of the bunches are all received once their connections are closed
+    listener.close()
+    for receiver in list(receivers):
+        receiver.join()
+    while not messages.empty():
+        message = messages.get()
+        if message:
+            append(message)
+    for writer in writers.values():
+        _flush(writer, logger)
+    logger.info("writer service terminated")
+
+
+def start_service(config):
+    """Start the writer service in a dedicated process
+
+    Parameters
+    ----------
+    config : :obj:`Config`
+        Scheduler configuration object
+
+    Return
+    ------
+    :obj:`multiprocessing.Process`
+        Writer service process
+    str
+        Unix socket path of the service
+    """
+    address = os.path.join(tempfile.mkdtemp(prefix="drp1d-"), "writer.sock")
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=serve,
+                                      args=(address, int(config.flush_size),
+                                            float(config.flush_interval),
+                                            config.logdir, config.log_level, ready,
+                                            config.output_backend))
+    process.start()
+    while not ready.wait(1):
+        if not process.is_alive():
+            raise Exception(f"writer service failed to start on {address}")
+    return process, address
+
+
+def stop_service(process, address):
+    """Ask the writer service to write remaining records and wait for it
+
+    Parameters
+    ----------
+    process : :obj:`multiprocessing.Process`
+        Writer service process
+    address : str
+        Unix socket path of the service
+    """
+    with connect(address) as connection:
+        connection.send(None)
+    process.join()
+    shutil.rmtree(os.path.dirname(address), ignore_errors=True)
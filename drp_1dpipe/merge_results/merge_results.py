@@ -4,12 +4,17 @@ import argparse
 import shutil
 import json
 import sys
+import h5py
 
 from drp_1dpipe.core.logger import init_logger
 from drp_1dpipe.core.argparser import define_global_program_options, AbspathAction
 from drp_1dpipe.core.utils import get_conf_path, config_update, config_save
 from drp_1dpipe.merge_results.config import config_defaults
 from drp_1dpipe.merge_results.pfsOutputAnalyzer import PfsOutputAnalyzer
+from drp_1dpipe.io.redshiftCoCandidates import concatenate_output_files, compress_output_file
+from drp_1dpipe.io.journal import recover_output
+from drp_1dpipe.io.columnarOutput import (get_columnar_path, concatenate_columnar_files,
+                                          export_fits)
 from pylibamazed.Parameters import Parameters
 
 from astropy.io import fits
@@ -81,6 +86,38 @@ def make_diff_cli():
         install_conf_path=get_conf_path("merge_results.json")
         )
     make_diff(config)
+
+def define_recover_options():
+    """Define specific program options.
+    
+    Return
+    ------
+    :obj:`ArgumentParser`
+        An ArgumentParser object
+    """
+    parser = argparse.ArgumentParser(
+        prog='recover',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('--output_dir', '-o', metavar='DIR', action=AbspathAction,
+                        help='Output directory of a run processed with --journal on.')
+
+    return parser
+
+def recover_cli():
+    """Rebuild the pfsCoZcandidates files of a run from its journals"""
+    parser = define_recover_options()
+    define_global_program_options(parser)
+    args = parser.parse_args()
+    config = config_update(
+        config_defaults,
+        args=vars(args),
+        install_conf_path=get_conf_path("merge_results.json")
+        )
+    logger = init_logger("recover", config.logdir, config.log_level)
+    recovered = recover_output(config.output_dir)
+    for bunch_id, nb_spectra in recovered.items():
+        logger.info(f"recovered {nb_spectra} spectra of bunch {bunch_id}")
     
 def make_diff(config):
     with open(os.path.join(config.output_dir,"parameters.json")) as f:
@@ -167,7 +204,115 @@ def define_specific_program_options():
                         help='Output directory.')
 
     return parser
-    
+
+
+def _get_shard_id(shard_path):
+    """Identifier given to a shard by process_spectra, None for shards written without"""
+    return fits.getheader(shard_path).get("SHARDID")
+
+
+def merge_shards(output_dir, nb_bunches):
+    """Build the final pfsCoZcandidates files from the bunches shards
+
+    Shards are written in `B{i}` bunch directories when processing with
+    `output_mode=shards`. They are appended in bunch order to a copy of the
+    files of the data directory, which replaces them together with the
+    MERGED card listing the merged shards, then removed. Shards found
+    merged by an interrupted merge are only removed.
+
+    Parameters
+    ----------
+    output_dir : str
+        Output directory
+    nb_bunches : int
+        Number of bunches
+    """
+    data_dir = os.path.join(output_dir, 'data')
+    for path in glob.glob(os.path.join(data_dir, "pfsCoZcandidates-*.fits")):
+        filename = os.path.basename(path)
+        shard_paths = []
+        for bunch_id in range(nb_bunches):
+            shard_path = os.path.join(output_dir, f'B{bunch_id}', filename)
+            if os.path.isfile(shard_path):
+                shard_paths.append(shard_path)
+        if not shard_paths:
+            continue
+        merged = fits.getheader(path).get("MERGED", "").split()
+        shard_ids = {shard_path: _get_shard_id(shard_path) for shard_path in shard_paths}
+        unmerged = [shard_path for shard_path in shard_paths if shard_ids[shard_path] not in merged]
+        if unmerged:
+            logger.info(f"merging {len(unmerged)} shards into {path}")
+            tmp_path = path + ".tmp"
+            shutil.copyfile(path, tmp_path)
+            merged += [shard_ids[shard_path] for shard_path in unmerged if shard_ids[shard_path] is not None]
+            with fits.open(tmp_path, "update") as hdulist:
+                # written with the rows, long values being continued over several cards
+                hdulist[0].header["MERGED"] = " ".join(merged)
+            concatenate_output_files(tmp_path, unmerged)
+            os.replace(tmp_path, path)
+        for shard_path in shard_paths:
+            os.remove(shard_path)
+
+
+def _get_columnar_shard_id(columnar_path):
+    """Identifier of the shard of a HDF5 shard, None for shards written without"""
+    with h5py.File(columnar_path, "r") as f:
+        return f.attrs.get("shard_id")
+
+
+def export_columnar_files(output_dir, nb_bunches):
+    """Export the HDF5 files written with `output_backend=hdf5` to pfsCoZcandidates
+
+    Bunches HDF5 shards are first appended in bunch order to a copy of the
+    HDF5 file of the data directory, which replaces it together with the
+    merged attribute listing the merged shards, then removed. Shards found
+    merged by an interrupted merge are only removed. The HDF5 file is kept
+    for the analysis once exported.
+
+    Parameters
+    ----------
+    output_dir : str
+        Output directory
+    nb_bunches : int
+        Number of bunches
+    """
+    data_dir = os.path.join(output_dir, 'data')
+    for path in glob.glob(os.path.join(data_dir, "pfsCoZcandidates-*.fits")):
+        filename = os.path.basename(path)
+        columnar_path = get_columnar_path(path)
+        shard_paths = []
+        for bunch_id in range(nb_bunches):
+            shard_path = os.path.join(output_dir, f'B{bunch_id}', filename)
+            if os.path.isfile(get_columnar_path(shard_path)):
+                shard_paths.append(shard_path)
+        if shard_paths:
+            merged = []
+            if os.path.isfile(columnar_path):
+                with h5py.File(columnar_path, "r") as f:
+                    merged = f.attrs.get("merged", "").split()
+            shard_ids = {shard_path: _get_columnar_shard_id(get_columnar_path(shard_path))
+                         for shard_path in shard_paths}
+            unmerged = [shard_path for shard_path in shard_paths if shard_ids[shard_path] not in merged]
+            if unmerged:
+                logger.info(f"merging {len(unmerged)} HDF5 shards into {columnar_path}")
+                tmp_path = columnar_path + ".tmp"
+                if os.path.isfile(columnar_path):
+                    shutil.copyfile(columnar_path, tmp_path)
+                elif os.path.isfile(tmp_path):
+                    os.remove(tmp_path)
+                concatenate_columnar_files(path, unmerged, tmp_path)
+                merged += [shard_ids[shard_path] for shard_path in unmerged if shard_ids[shard_path] is not None]
+                with h5py.File(tmp_path, "a") as f:
+                    # written with the rows
+                    f.attrs["merged"] = " ".join(merged)
+                os.replace(tmp_path, columnar_path)
+            for shard_path in shard_paths:
+                os.remove(get_columnar_path(shard_path))
+        if os.path.isfile(columnar_path):
+            logger.info(f"exporting {columnar_path} to {path}")
+            export_fits(path)
+
+
 def merge_results(config):
     """main_method
 
@@ -191,6 +336,23 @@ def merge_results(config):
     os.makedirs(data_dir, exist_ok=True)
     nb_bunches = len(glob.glob(os.path.join(config.output_dir,f'spectralist_B*.json')))
 
+    try:
+        export_columnar_files(config.output_dir, nb_bunches)
+    except Exception as e:
+        logger.error(f"failed to export HDF5 results : {e}")
+
+    try:
+        merge_shards(config.output_dir, nb_bunches)
+    except Exception as e:
+        logger.error(f"failed to merge pfsCoZcandidates shards : {e}")
+
+    # images are compressed once all their rows are written
+    for path in glob.glob(os.path.join(data_dir, "pfsCoZcandidates-*.fits")):
+        try:
+            compress_output_file(path)
+        except Exception as e:
+            logger.error(f"failed to compress images of {path} : {e}")
+
     for bunch_id in range(nb_bunches):
         bunch_dir = os.path.join(config.output_dir,f'B{bunch_id}')
         ps_path = os.path.join(config.output_dir,f"process_spectra_{bunch_id}.sh")
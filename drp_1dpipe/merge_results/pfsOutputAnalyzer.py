@@ -1,7 +1,7 @@
 from .abstractOutputAnalyzer import AbstractOutputAnalyzer
 from .abstractInputManager import AbstractInputManager
 from pylibamazed.Parameters import Parameters
-from pylibamazed.redshift import ErrorCode
+from drp_1dpipe.io.infos import get_error_name
 import pandas as pd
 import numpy as np
 from astropy.table import Table
@@ -10,6 +10,8 @@ import os
 import json
 import glob
 import logging
+from drp_1dpipe.io.redshiftCoCandidates import get_skipped_hdus
+from drp_1dpipe.io.columnarOutput import read_table
 
 class PfsOutputAnalyzer(AbstractOutputAnalyzer):
 
@@ -35,23 +37,40 @@ class PfsOutputAnalyzer(AbstractOutputAnalyzer):
         with open(os.path.join(module_root_dir, DATAMODEL_CONVERSION_FILE)) as f:
             self.datamodel_conversion = json.load(f)
 
+    def get_paths(self) -> list:
+        """Paths of the pfsCoZcandidates files, one per catId"""
+        paths = sorted(glob.glob(os.path.join(self.output_directory, "data", "pfsCoZcandid*.fits")))
+        if not paths:
+            raise FileNotFoundError(f"No pfsCoZcandidates file in {self.output_directory}")
+        return paths
+
     def get_redshifts(self) -> pd.DataFrame:
-        pfsCoZPath = glob.glob(os.path.join(self.output_directory, "data", "pfsCoZcandid*.fits"))[0]
-        return self._get_redshifts_from_path(pfsCoZPath)
+        return pd.concat([self._get_redshifts_from_path(path) for path in self.get_paths()],
+                         ignore_index=True)
 
     def check_fits_integrity(self):
-        path = glob.glob(os.path.join(self.output_directory, "data", "pfsCoZcandid*.fits"))[0]
-        f = fits.open(path)
-        nb_targets = len(f[1].data)
-        for hdu in ["WARNINGS","ERRORS","GALAXY_LN_PDF","QSO_LN_PDF","STAR_LN_PDF"]:
-            if len(f[hdu].data) != nb_targets:
-                raise Exception(f'hdu {hdu} of size {len(f[hdu].data)} , should be {nb_targets}')
+        for path in self.get_paths():
+            with fits.open(path) as f:
+                # sizes from headers, images may be tile-compressed
+                nb_targets = f[1].header["NAXIS2"]
+                skipped = get_skipped_hdus(f[0].header)
+                for hdu in ["WARNINGS","ERRORS","GALAXY_LN_PDF","QSO_LN_PDF","STAR_LN_PDF"]:
+                    if hdu in skipped:
+                        continue
+                    if "LNPFLOOR" in f[hdu].header:
+                        # sparse ln pdf, rows are not one per target
+                        continue
+                    size = f[hdu].header.get("NAXIS2", 0)
+                    if size != nb_targets:
+                        raise Exception(f'hdu {hdu} of {path} of size {size} , should be {nb_targets}')
         
     def get_global_lines_infos(self,snr_threshold):
-        path = glob.glob(os.path.join(self.output_directory, "data", "pfsCoZcandid*.fits"))[0]
+        paths = self.get_paths()
         lines = dict()
-        lines["qso"] = Table.read(path, hdu=14, format="fits").to_pandas()
-        lines["galaxy"] = Table.read(path, hdu=9, format="fits").to_pandas()
+        lines["qso"] = pd.concat([read_table(path, 14, ["lineFlux", "lineFluxError"]) for path in paths],
+                                 ignore_index=True)
+        lines["galaxy"] = pd.concat([read_table(path, 9, ["lineFlux", "lineFluxError"]) for path in paths],
+                                    ignore_index=True)
         ret = dict()
         ret["count"] = dict()
         ret["meanCount"] = dict()
@@ -66,11 +85,14 @@ class PfsOutputAnalyzer(AbstractOutputAnalyzer):
         return ret
 
     def get_correct_lines(self, snr_threshold, object_type):
-        path = glob.glob(os.path.join(self.output_directory, "data", "pfsCoZcandid*.fits"))[0]
-        lines = Table.read(path, hdu=f'{object_type.upper()}_LINES', format="fits").to_pandas()
-        target = Table.read(path,hdu=1, format="fits").to_pandas()
-        lines = lines[lines.lineFluxError.notnull()]
-        lines = pd.merge(lines,target[["targetId","objId"]],left_on="targetId",right_on="targetId")
+        all_lines = []
+        for path in self.get_paths():
+            # targetId are numbered per file
+            lines = read_table(path, f'{object_type.upper()}_LINES')
+            target = read_table(path, 1, ["targetId", "objId"])
+            lines = lines[lines.lineFluxError.notnull()]
+            all_lines.append(pd.merge(lines,target[["targetId","objId"]],left_on="targetId",right_on="targetId"))
+        lines = pd.concat(all_lines, ignore_index=True)
         lines["snr"]=lines.lineFlux/lines.lineFluxError
         lines = lines[lines.snr > snr_threshold]
         lines = lines[lines.lineWave > self.parameters.get_lambda_range_min()*0.1]
@@ -133,15 +155,21 @@ class PfsOutputAnalyzer(AbstractOutputAnalyzer):
     def _get_redshifts_from_path(self, path):
         # get processingID first
 
-        targets = Table.read(path, hdu=1, format="fits").to_pandas()
+        targets = read_table(path, 1)
         targets["ProcessingID"] = targets.catId.map(str) + "-" + targets.objId.map(hex)
 
         redshifts = targets
         for dataset, infos in self.datamodel_conversion.items():
             hdu_index = infos["hdu_index"]
             cols_mapping = infos["map"]
-            hdu_table = Table.read(path, format="fits", hdu=hdu_index)
-            hdu_df = hdu_table.to_pandas()
+            if "_lines" in dataset:
+                columns = list(set(col.split(".")[-1] for col in cols_mapping.keys()))
+                columns += ["lineName"]
+            else:
+                columns = list(cols_mapping.keys())
+            columns += [infos["rankCol"]] if "rankCol" in infos.keys() else []
+            # only the mapped columns are read
+            hdu_df = read_table(path, hdu_index, columns + ["targetId"])
             if "rankCol" in infos.keys():
                 rCol = infos["rankCol"]
                 hdu_df = hdu_df[hdu_df[rCol] == 0]
@@ -180,7 +208,7 @@ class PfsOutputAnalyzer(AbstractOutputAnalyzer):
         for col in redshifts.columns:
             if col.startswith("error") and col.endswith("code"):
                 try:
-                    redshifts[col] = [ErrorCode(i).name if i != 0 else None for i in redshifts[col]]
+                    redshifts[col] = [get_error_name(i) if i != 0 else None for i in redshifts[col]]
                 except ValueError as e:
                     logging.getLogger("session_logger").error(
                         f"Wrong Amazed error code in pfs product at col {col} : {e}"
@@ -11,10 +11,16 @@ config_defaults = {
     'log_level': 30,
     # Specific programm options
     'coadd_file' : '',
+    'coadd_list' : '',
     'object_id' : '',
     'bunch_size': 8,
     'bunch_list': 'spectralist.json',
     'output_dir':'output',
     'object_id':0,
-    'parameters_file': ''
+    'parameters_file': '',
+    'image_compression': 'none',
+    'quantize_level': 16,
+    'pdf_storage': 'dense',
+    'ln_pdf_floor': -20.,
+    'product_level': 'full'
     }
@@ -11,15 +11,18 @@ import logging
 import glob
 import argparse
 import math
+import shutil
 
 from drp_1dpipe.core.logger import init_logger
 from drp_1dpipe.core.argparser import define_global_program_options, AbspathAction
 from drp_1dpipe.core.utils import normpath, get_conf_path, config_update, config_save
 from drp_1dpipe.pre_process.config import config_defaults
-from pfs.datamodel.drp import PfsCoadd,PfsCalibrated
 from drp_1dpipe.process_spectra.parameters import default_parameters
 from pylibamazed.Parameters import Parameters
-from drp_1dpipe.io.redshiftCoCandidates import init_output_file
+from drp_1dpipe.io.redshiftCoCandidates import init_output_file, get_output_filename, LAYOUT_DIR
+from drp_1dpipe.io.PFSMetadata import probe_coadd_metadata
+from drp_1dpipe.io.PFSCoaddIndex import (get_spectra_class, write_coadd_index, read_coadd_index,
+                                         INDEX_FILENAME)
 import collections.abc
 
 from flufl.lock import Lock
@@ -46,7 +49,11 @@ def define_specific_program_options():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
         )
     parser.add_argument('--coadd_file', metavar='FILE',
-                        help='Base path where to find pfsCoadd file relative to workdir.')
+                        help='Base path where to find pfsCoadd file relative to workdir, '
+                        'or glob pattern of several files.')
+    parser.add_argument('--coadd_list', metavar='FILE',
+                        help='Text file listing pfsCoadd files or glob patterns, one per line, '
+                        'relative to workdir.')
     parser.add_argument('--object_id', '-oid', type=int,
                         help='Run pipeline on a single object id belonging to coadd_file')
     parser.add_argument('--bunch_size', metavar='SIZE',
@@ -55,26 +62,92 @@ def define_specific_program_options():
                         help='List of files of bunch of astronomical objects.')
     parser.add_argument('--output_dir', '-o', metavar='DIR', action=AbspathAction,
                         help='Output directory.')
+    parser.add_argument('--image_compression', choices=['none', 'lossless', 'quantized'],
+                        help='Tile compression of models and ln pdf images, applied once all '
+                        'results are merged.')
+    parser.add_argument('--quantize_level', type=float,
+                        help='Quantization level of quantized image compression.')
+    parser.add_argument('--pdf_storage', choices=['dense', 'sparse'],
+                        help='Store ln pdf as full grids (dense) or as the bins above ln_pdf_floor (sparse).')
+    parser.add_argument('--ln_pdf_floor', type=float,
+                        help='ln pdf value under which bins are not stored in sparse pdf storage.')
+    parser.add_argument('--product_level', choices=['full', 'standard', 'minimal'],
+                        help='Products written, standard skips models, minimal skips models and ln pdf.')
 
     return parser
 
-        
-def bunch_pfscoadd_file(bunch_size, coadd_file, nb_bunches):
-    """Split the list of files in bunches of `bunch_size` files 
 
-    Get the list of spectra located into `coadd_file` fits.
-    Split the liste of files in bunches. The size of bunch is given by
-    the "bunch_size" argument.
+def list_coadd_files(coadd_file, coadd_list='', workdir='.'):
+    """List the input files of a run
+
+    Parameters
+    ----------
+    coadd_file : str or list
+        Path or glob pattern of pfsCoadd files, or list of them
+    coadd_list : str
+        Text file listing paths or glob patterns, one per line
+    workdir : str
+        Directory relative paths are given from
+
+    Return
+    ------
+    list
+        Paths of the files, without duplicates
+    """
+    if isinstance(coadd_file, list):
+        patterns = list(coadd_file)
+    else:
+        patterns = [coadd_file] if coadd_file else []
+    if coadd_list:
+        with open(normpath(workdir, coadd_list)) as f:
+            patterns += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    files = []
+    for pattern in patterns:
+        pattern = normpath(workdir, pattern)
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if path not in files:
+                files.append(path)
+    return files
+
+
+def _list_objects(coadd_file, index_path, logger):
+    """List objIds and catIds of a file from its object index
+
+    Return
+    ------
+    list
+        objIds in file order
+    list
+        catIds of the file
+    str
+        Path of the index, empty when it could not be written
+    """
+    try:
+        write_coadd_index(coadd_file, index_path)
+        index = read_coadd_index(index_path)
+        return ([int(object_id) for object_id in index["objId"]],
+                sorted(set(int(catId) for catId in index["catId"])), index_path)
+    except Exception as e:
+        logger.warning(f'Failed to write {index_path}, bunches will read the whole file : {e}')
+    spectra = get_spectra_class(coadd_file).readFits(coadd_file)
+    return ([int(source.objId) for source in spectra],
+            sorted(set(int(source.catId) for source in spectra)), '')
+
+
+def bunch_objects(bunch_size, objects, nb_bunches):
+    """Split the list of objects in bunches of `bunch_size` objects
 
-    Ex: for 85 files and bunch_size=20, the generator gives 4 bunches of 
-    20 files and 1 bunch of 5 file.
+    Objects are taken in order, bunches spanning several files when needed.
+
+    Ex: for 85 objects and bunch_size=20, the generator gives 4 bunches of 
+    20 objects and 1 bunch of 5 objects.
 
     Parameters
     ----------
     bunch_size : int
         The number of spectra per bunch
-    coadd_file : str
-        Path to pfsCoadd file
+    objects : list
+        objects of all the input files
     nb_bunches : int
         Number of bunches
     Yields
@@ -83,17 +156,12 @@ def bunch_pfscoadd_file(bunch_size, coadd_file, nb_bunches):
         A generator woth the max number of sources
     """    
     _list = []
-    if os.path.basename(coadd_file).startswith("pfsCo"):
-        spectra = PfsCoadd.readFits(coadd_file)
-    else:
-        spectra = PfsCalibrated.readFits(coadd_file)
     nb_bunches_remaining = nb_bunches
-    nb_remaining = len(spectra)
-    for source in spectra:
+    nb_remaining = len(objects)
+    for source in objects:
         if nb_remaining <= (bunch_size-1)*nb_bunches_remaining:
             bunch_size = bunch_size -1
-        object_id = int(source.objId)
-        _list.append(object_id)
+        _list.append(source)
         nb_remaining  = nb_remaining -1
         if len(_list) >= bunch_size:
             yield _list
@@ -103,18 +171,40 @@ def bunch_pfscoadd_file(bunch_size, coadd_file, nb_bunches):
     if _list:
         yield _list
 
-def init_output(pfscoadd_file, output_dir, parameters_file, logger):
-    if os.path.basename(pfscoadd_file).startswith("pfsCo"):
-        spectra = PfsCoadd.readFits(pfscoadd_file)
-    else:
-        spectra = PfsCalibrated.readFits(pfscoadd_file)
+def _read_metadata(pfscoadd_file):
+    """Read output files metadata from the first spectrum of a fully loaded file"""
+    spectra = get_spectra_class(pfscoadd_file).readFits(pfscoadd_file)
     for source in spectra:
-        catId = source.catId
-        damd_version = spectra[source].metadata["VERSION_DATAMODEL"]
-        stella_version = spectra[source].metadata["VERSION_DRP_STELLA"]
-        obs_pfs_version = spectra[source].metadata["VERSION_OBS_PFS"]
-        wl_size = len(spectra[source].wavelength)
-        break
+        versions = {key: spectra[source].metadata[key]
+                    for key in ["VERSION_DATAMODEL", "VERSION_DRP_STELLA", "VERSION_OBS_PFS"]}
+        return source.catId, versions, len(spectra[source].wavelength)
+
+
+def _probe_metadata(pfscoadd_file, logger):
+    try:
+        return probe_coadd_metadata(pfscoadd_file)
+    except Exception as e:
+        logger.log(logging.WARNING, f"unable to probe {pfscoadd_file} metadata : {e}, reading whole file")
+        return _read_metadata(pfscoadd_file)
+
+
+def init_output(pfscoadd_files, output_dir, parameters_file, logger, image_compression="none", quantize_level=16,
+                pdf_storage="dense", ln_pdf_floor=-20., product_level="full", catIds=None):
+    """Create the parameters file and the empty pfsCoZcandidates files of a run
+
+    One pfsCoZcandidates file is created per catId, with the versions of the
+    first input file holding this catId. An empty copy of each file is kept
+    in the layout directory for recovery.
+
+    Parameters
+    ----------
+    pfscoadd_files : str or list
+        Path of the input file or list of them
+    catIds : list
+        catIds of each input file, the catId of its first spectrum when None
+    """
+    if isinstance(pfscoadd_files, str):
+        pfscoadd_files = [pfscoadd_files]
     
     user_params = None
     params = default_parameters.copy()
@@ -133,16 +223,34 @@ def init_output(pfscoadd_file, output_dir, parameters_file, logger):
         json.dump(params, f, indent=4)
 
     os.mkdir(os.path.join(output_dir,"data"))
+    os.mkdir(os.path.join(output_dir,LAYOUT_DIR))
     fits_lock = Lock(os.path.join(output_dir,"data","coZcand.lock")) 
-    init_output_file(os.path.join(output_dir,"data"),
-                     catId,
-                     user_params,
-                     damd_version,
-                     stella_version,
-                     obs_pfs_version,
-                     Parameters(params),
-                     wl_size
-                     )
+    created = set()
+    for i, pfscoadd_file in enumerate(pfscoadd_files):
+        file_catIds = set(catIds[i]) if catIds is not None else set()
+        if file_catIds and file_catIds <= created:
+            continue
+        first_catId, versions, wl_size = _probe_metadata(pfscoadd_file, logger)
+        for catId in sorted(file_catIds or {first_catId}):
+            if catId in created:
+                continue
+            created.add(catId)
+            init_output_file(os.path.join(output_dir,"data"),
+                             catId,
+                             user_params,
+                             versions["VERSION_DATAMODEL"],
+                             versions["VERSION_DRP_STELLA"],
+                             versions["VERSION_OBS_PFS"],
+                             Parameters(params),
+                             wl_size,
+                             image_compression,
+                             float(quantize_level),
+                             pdf_storage,
+                             float(ln_pdf_floor),
+                             product_level
+                             )
+            shutil.copyfile(os.path.join(output_dir,"data",get_output_filename(catId)),
+                            os.path.join(output_dir,LAYOUT_DIR,get_output_filename(catId)))
     
 def pre_process(config):
     # initialize logger
@@ -155,34 +263,54 @@ def pre_process(config):
     logger = init_logger("pre_process", logdir, log_level)
     start_message = "Running pre_process"
     logger.info(start_message)
-    coadd_file = normpath(config.coadd_file)
+    coadd_files = list_coadd_files(config.coadd_file, getattr(config, 'coadd_list', ''), workdir)
+    if not coadd_files:
+        raise FileNotFoundError("No input file given, use coadd_file or coadd_list")
+    logger.info(f"{len(coadd_files)} input files")
+
+    # lets each bunch load its own spectra only
+    objects = []
+    catIds = []
+    coadd_indexes = []
+    for i, coadd_file in enumerate(coadd_files):
+        object_ids, file_catIds, coadd_index = _list_objects(coadd_file,
+                                                             os.path.join(output_dir, INDEX_FILENAME % i),
+                                                             logger)
+        objects += [(i, object_id) for object_id in object_ids]
+        catIds.append(file_catIds)
+        coadd_indexes.append(coadd_index)
 
     if bunch_size == 0 and config.concurrency > 1:
-        if os.path.basename(coadd_file).startswith("pfsCo"):
-            spectra = PfsCoadd.readFits(coadd_file)
-        else:
-            spectra = PfsCalibrated.readFits(coadd_file)
-        bunch_size = math.ceil(len(spectra)/config.concurrency)
-        logger.info(f"bunch size = {len(spectra)}/{config.concurrency}={bunch_size}")
+        bunch_size = math.ceil(len(objects)/config.concurrency)
+        logger.info(f"bunch size = {len(objects)}/{config.concurrency}={bunch_size}")
     nb_bunches = 0
     try:
-        init_output(coadd_file, config.output_dir, config.parameters_file, logger)
+        init_output(coadd_files, config.output_dir, config.parameters_file, logger,
+                    config.image_compression, config.quantize_level,
+                    config.pdf_storage, config.ln_pdf_floor, config.product_level, catIds)
     except Exception as e:
         logger.info(f'Failed to init pfsCoZCandidate : {e}')
         exit(-1)
         
     if config.object_id:
+        files = [i for i, object_id in objects if object_id == config.object_id] or [0]
         spectralist_file = os.path.join(output_dir, f'spectralist_B0.json')
         with open(spectralist_file, "w") as ff:
-            json.dump({'coadd_file':config.coadd_file,'objIdList':[config.object_id]}, ff)
+            json.dump({'coadd_file':coadd_files[files[0]],'objIdList':[config.object_id],'bunch_id':0}, ff)
         return 1
-    
 
-    for i, objid_list in enumerate(bunch_pfscoadd_file(bunch_size,coadd_file, config.concurrency)):
+    for i, bunch in enumerate(bunch_objects(bunch_size, objects, config.concurrency)):
         nb_bunches = i + 1
+        # objects of a bunch are grouped by input file
+        files = []
+        for file_number, object_id in bunch:
+            if not files or files[-1]['file_number'] != file_number:
+                files.append({'file_number': file_number, 'coadd_file': coadd_files[file_number],
+                              'coadd_index': coadd_indexes[file_number], 'objIdList': []})
+            files[-1]['objIdList'].append(object_id)
         spectralist_file = os.path.join(output_dir, f'spectralist_B{i}.json')
         with open(spectralist_file, "w") as ff:
-            json.dump({'coadd_file':coadd_file,'objIdList':objid_list}, ff)
+            json.dump({'bunch_id':i, 'files':files}, ff)
     return nb_bunches
     
     
@@ -18,5 +18,18 @@ config_defaults = {
     'parameters_file': '',
     'extended_results': True,
     'coadd_file': '',
-    'reader':'pfs'
+    'coadd_index': '',
+    'coadd_cache': '',
+    'reader':'pfs',
+    'output_mode':'shared',
+    'flush_size':1,
+    'flush_interval':0,
+    'writer_address':'',
+    'journal':'off',
+    'write_behind':'off',
+    'prefetch_depth':0,
+    'prefetch_memory':0,
+    'prescreen_min_valid':0,
+    'prescreen_target_types':'',
+    'output_backend':'fits'
     }
@@ -0,0 +1,93 @@
+import numpy as np
+
+
+def parse_target_types(target_types):
+    """targetTypes given as a comma separated string or a list"""
+    if isinstance(target_types, str):
+        target_types = target_types.split(',')
+    return {int(target_type) for target_type in target_types if str(target_type).strip()}
+
+
+class PreScreen:
+    """Rejection of the spectra not worth processing, before running the library
+
+    Parameters
+    ----------
+    min_valid : float
+        Minimum fraction of valid pixels, unmasked with finite flux and
+        positive finite error, 0 to disable
+    target_types : str or list
+        targetTypes not processed, as sky or engineering fibers
+    """
+
+    def __init__(self, min_valid=0., target_types=''):
+        self.min_valid = float(min_valid)
+        self.target_types = parse_target_types(target_types)
+        self.nb_rejected = 0
+
+    def reject(self, spectrum):
+        """Reason why spectrum is rejected
+
+        Parameters
+        ----------
+        spectrum : :obj:`Spectrum`
+            Amazed spectrum
+
+        Return
+        ------
+        str
+            Rejection message, empty when the spectrum is processed
+        """
+        message = self._get_message(spectrum)
+        if message:
+            self.nb_rejected += 1
+        return message
+
+    def _get_message(self, spectrum):
+        if self.target_types:
+            target_type = spectrum.get_spectrum_infos().get("targetType")
+            if target_type is not None and int(target_type) in self.target_types:
+                return f"targetType {int(target_type)} not processed"
+        if self.min_valid > 0:
+            mask = np.asarray(spectrum.get_others(filtered_only=False)["mask"])
+            flux = np.asarray(spectrum.get_flux(filtered_only=False))
+            error = np.asarray(spectrum.get_error(filtered_only=False))
+            with np.errstate(invalid='ignore'):
+                valid = (mask == 0) & np.isfinite(flux) & np.isfinite(error) & (error > 0)
+            fraction = np.count_nonzero(valid) / max(len(valid), 1)
+            if fraction < self.min_valid:
+                return f"{fraction:.1%} valid pixels, under {self.min_valid:.1%}"
+        return ""
+
+
+class RejectedOutput:
+    """Output of a spectrum rejected by `PreScreen`, in place of the library output
+
+    All stages are in error, init with the PRESCREEN_REJECTED pipeline
+    error code, so that the spectrum is written without candidates.
+
+    Parameters
+    ----------
+    message : str
+        Rejection message
+    """
+    object_results = dict()
+
+    def __init__(self, message):
+        self.message = message
+
+    def has_error(self, object_type, stage):
+        return True
+
+    def get_error(self, object_type, stage):
+        if stage == "init":
+            return {"code": "PRESCREEN_REJECTED", "message": self.message}
+        return {"code": "", "message": ""}
+
+    def has_attribute(self, object_type, stage, attribute):
+        return False
+
+    def get_attribute(self, object_type, stage, attribute):
+        if attribute == "InitWarningFlags":
+            return 0
+        raise KeyError(f"no {attribute} for a rejected spectrum")
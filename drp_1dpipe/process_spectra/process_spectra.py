@@ -4,6 +4,8 @@ import logging
 import time
 import argparse
 import shutil
+import glob
+import uuid
 
 from pylibamazed.CalibrationLibrary import CalibrationLibrary
 from pylibamazed.ResultStoreOutput import ResultStoreOutput
@@ -20,8 +22,15 @@ from drp_1dpipe.core.get_default_summary import get_default_summary_columns
 
 from drp_1dpipe.io.PFSDataProvider import PFSDataProvider
 
-from drp_1dpipe.io.redshiftCoCandidates import RedshiftCoCandidates
+from drp_1dpipe.io.redshiftCoCandidates import (RedshiftCoCandidates, CoZcandidatesWriter,
+                                              clear_output_file, get_output_filename)
+from drp_1dpipe.io.writerService import ServiceWriter, connect
+from drp_1dpipe.io.columnarOutput import H5CandidatesWriter
+from drp_1dpipe.io.writeBehind import WriteBehind, WriteBehindWriter
+from drp_1dpipe.io.journal import (Journal, JournaledWriter, get_journaled_spectra,
+                                   get_unwritten_records, JOURNAL_FILENAME)
 from drp_1dpipe.process_spectra.parameters import default_parameters
+from drp_1dpipe.process_spectra.prescreen import PreScreen, RejectedOutput
 
 from pylibamazed.redshift import (CLog,
                                   CLogFileHandler,
@@ -30,6 +39,7 @@ import collections.abc
 from flufl.lock import Lock
 from datetime import timedelta,datetime
 import resource
+from astropy.io import fits
 
 
 zlog = CLog.GetInstance()
@@ -82,6 +92,37 @@ def define_specific_program_options():
                         ' be stored. Relative to workdir.')
     parser.add_argument('--continue', action='store_true', dest='continue_',
                         help='Continue a previous processing.')
+    parser.add_argument('--output_mode', choices=['shared', 'shards', 'service'],
+                        help='Write into the shared pfsCoZcandidates file under lock (shared), '
+                        'into a per-bunch shard file (shards) or through the writer service (service).')
+    parser.add_argument('--writer_address', metavar='SOCKET',
+                        help='Unix socket of the writer service, for service output mode.')
+    parser.add_argument('--flush_size', type=int,
+                        help='Number of spectra results buffered before writing them.')
+    parser.add_argument('--flush_interval', type=float,
+                        help='Maximum time in seconds results stay buffered, 0 to disable.')
+    parser.add_argument('--output_backend', choices=['fits', 'hdf5'],
+                        help='Append results to the pfsCoZcandidates files (fits) or to HDF5 files '
+                        'next to them (hdf5), exported to pfsCoZcandidates by merge_results.')
+    parser.add_argument('--coadd_cache', metavar='FILE',
+                        help='Manifest of the coadd decoded in shared memory by the scheduler.')
+    parser.add_argument('--prefetch_depth', type=int,
+                        help='Number of spectra loaded ahead by a background thread, 0 to disable.')
+    parser.add_argument('--prefetch_memory', type=float,
+                        help='Maximum size in MB of the spectra loaded ahead, 0 for no limit.')
+    parser.add_argument('--write_behind', choices=['on', 'off'],
+                        help='Write results from a background thread while the next spectra are '
+                        'processed. Not used with service output mode.')
+    parser.add_argument('--journal', choices=['on', 'off'],
+                        help='Journal spectra results in the bunch directory before writing them, '
+                        'for recovery with drp_1drecover. With --continue, journaled spectra '
+                        'are skipped, those not written yet being written from the journal.')
+    parser.add_argument('--prescreen_min_valid', type=float,
+                        help='Minimum fraction of valid pixels of a processed spectrum, others get '
+                        'a PRESCREEN_REJECTED init error without running the library. 0 to disable.')
+    parser.add_argument('--prescreen_target_types', metavar='TYPES',
+                        help='Comma separated targetTypes not processed, getting a '
+                        'PRESCREEN_REJECTED init error.')
 
     return parser
 
@@ -90,45 +131,121 @@ def _output_path(args, *path):
     return normpath(args.workdir, args.output_dir, *path)
 
 
-def _process_spectrum(output_dir, spectrum, process_flow, user_param, storage) :
-    try:
-        zlog.LogInfo(f"Processing spectrum {spectrum.source_id}")
-        output = process_flow.run(spectrum) 
-    except Exception as e:
-        logger.log(logging.ERROR,"Could not process spectrum: {}".format(e))
-        return 0
-    try:
-        rc = RedshiftCoCandidates(output, spectrum, logger, process_flow.calibration_library)
+def _init_shard(data_dir, shard_dir):
+    """Initialize the bunch shard directory with a copy of the empty
+    pfsCoZcandidates files created by pre_process.
 
-        l = Lock(os.path.join(output_dir,"coZcand.lock"))
-        l.lifetime = timedelta(hours=2)
-        tstart = datetime.now()
-        debut_user_time = resource.getrusage(resource.RUSAGE_SELF).ru_utime
-        debut_system_time = resource.getrusage(resource.RUSAGE_SELF).ru_stime
+    Parameters
+    ----------
+    data_dir : str
+        Directory holding the empty pfsCoZcandidates files
+    shard_dir : str
+        Bunch directory where the shard files are written
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(data_dir, "pfsCoZcandidates-*.fits")):
+        shard_path = os.path.join(shard_dir, os.path.basename(path))
+        if not os.path.exists(shard_path):
+            shutil.copyfile(path, shard_path)
+            # data files may already hold rows of a recovered run
+            clear_output_file(shard_path)
+            with fits.open(shard_path, "update") as hdulist:
+                # lets merge_results tell whether the shard is merged
+                hdulist[0].header["SHARDID"] = (uuid.uuid4().hex, "Identifier of the shard")
+                hdulist[0].header.remove("MERGED", ignore_missing=True)
+
+
+def _write_fits(writer, label):
+    tstart = datetime.now()
+    debut_user_time = resource.getrusage(resource.RUSAGE_SELF).ru_utime
+    debut_system_time = resource.getrusage(resource.RUSAGE_SELF).ru_stime
+    writer.flush()
+    end_user_time = resource.getrusage(resource.RUSAGE_SELF).ru_utime
+    end_system_time = resource.getrusage(resource.RUSAGE_SELF).ru_stime
+    tend = datetime.now()
+    memory_used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    logger.log(logging.INFO, f"{label}|writing|{end_user_time - debut_user_time}|{end_system_time - debut_system_time}|{tend-tstart}|{memory_used}")
+
+
+def _flush_writer(writer, lock_path, label):
+    """Write the buffered rows of writer
 
-        l.lock()
-        
+    Parameters
+    ----------
+    writer : :obj:`CoZcandidatesWriter`
+        Writer to flush
+    lock_path : str
+        Path of the lock protecting the shared output file, None when the
+        file belongs to this bunch only
+    label : str
+        Label used in rusage log lines
+    """
+    if lock_path is None:
+        _write_fits(writer, label)
+        return
+    l = Lock(lock_path)
+    l.lifetime = timedelta(hours=2)
+    tstart = datetime.now()
+    debut_user_time = resource.getrusage(resource.RUSAGE_SELF).ru_utime
+    debut_system_time = resource.getrusage(resource.RUSAGE_SELF).ru_stime
+
+    l.lock()
+    try:
         end_user_time = resource.getrusage(resource.RUSAGE_SELF).ru_utime
         end_system_time = resource.getrusage(resource.RUSAGE_SELF).ru_stime
         tend = datetime.now()
         memory_used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-        logger.log(logging.INFO, f"{spectrum.source_id}|waiting|{end_user_time - debut_user_time}|{end_system_time - debut_system_time}|{tend-tstart}|{memory_used}")
+        logger.log(logging.INFO, f"{label}|waiting|{end_user_time - debut_user_time}|{end_system_time - debut_system_time}|{tend-tstart}|{memory_used}")
 
-        tstart = datetime.now()
-        debut_user_time = resource.getrusage(resource.RUSAGE_SELF).ru_utime
-        debut_system_time = resource.getrusage(resource.RUSAGE_SELF).ru_stime
-        rc.write_fits(output_dir)
-        end_user_time = resource.getrusage(resource.RUSAGE_SELF).ru_utime
-        end_system_time = resource.getrusage(resource.RUSAGE_SELF).ru_stime
-        tend = datetime.now()
-        memory_used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-        logger.log(logging.INFO, f"{spectrum.source_id}|writing|{end_user_time - debut_user_time}|{end_system_time - debut_system_time}|{tend-tstart}|{memory_used}")
+        _write_fits(writer, label)
+    finally:
         l.unlock()
+
+
+def _get_writer(path, config, connection, journal=None, write_behind=None):
+    if connection is not None:
+        writer = ServiceWriter(path, connection)
+    else:
+        writer_class = H5CandidatesWriter if config.output_backend == 'hdf5' else CoZcandidatesWriter
+        writer = writer_class(path, int(config.flush_size), float(config.flush_interval))
+        if write_behind is not None:
+            writer = WriteBehindWriter(writer, write_behind)
+    if journal is not None:
+        writer = JournaledWriter(writer, journal)
+    return writer
+
+
+def _process_spectrum(output_dir, spectrum, process_flow, writers, config, lock_path, connection=None,
+                      journal=None, write_behind=None, prescreen=None) :
+    message = prescreen.reject(spectrum) if prescreen is not None else ""
+    if message:
+        logger.log(logging.INFO, f"Spectrum {spectrum.source_id} rejected : {message}")
+        output = RejectedOutput(message)
+    else:
+        try:
+            zlog.LogInfo(f"Processing spectrum {spectrum.source_id}")
+            output = process_flow.run(spectrum) 
+        except Exception as e:
+            logger.log(logging.ERROR,"Could not process spectrum: {}".format(e))
+            return 0
+    try:
+        rc = RedshiftCoCandidates(output, spectrum, logger, process_flow.calibration_library)
+        path = rc.get_output_path(output_dir)
+        if path not in writers:
+            writers[path] = _get_writer(path, config, connection, journal, write_behind)
+        writer = writers[path]
+        rc.write(writer)
     except Exception as e:
         logger.log(logging.ERROR,"Failed to write fits result for spectrum "
                    "{} : {}".format(spectrum.source_id, e))
-        l.unlock()
         return 0
+    if writer.need_flush():
+        try:
+            _flush_writer(writer, lock_path, spectrum.source_id)
+        except Exception as e:
+            # rows are kept buffered for next flush
+            logger.log(logging.ERROR,"Failed to write fits result for spectrum "
+                       "{} : {}".format(spectrum.source_id, e))
     return output
 
 def _setup_pass(config):
@@ -179,9 +296,16 @@ def amazed(config):
     with open(normpath(config.workdir, config.spectra_listfile), 'r') as f:
         spectra_list = json.load(f)
         
-    if type(spectra_list)==dict and 'coadd_file' in spectra_list.keys():
-        config.coadd_file = spectra_list['coadd_file']
-        spectra_list = spectra_list['objIdList']
+    bunch_id = 0
+    bunch_files = [{'coadd_file': config.coadd_file, 'coadd_index': config.coadd_index,
+                    'objIdList': spectra_list}]
+    if type(spectra_list)==dict and 'files' in spectra_list.keys():
+        # bunch spanning several input files
+        bunch_id = spectra_list.get('bunch_id', 0)
+        bunch_files = spectra_list['files']
+    elif type(spectra_list)==dict and 'coadd_file' in spectra_list.keys():
+        bunch_id = spectra_list.get('bunch_id', 0)
+        bunch_files = [spectra_list]
     
         
     outdir = normpath(config.workdir, config.output_dir)
@@ -190,21 +314,116 @@ def amazed(config):
     data_dir = os.path.join(outdir, 'data')
     os.makedirs(data_dir, exist_ok=True)
 
-    data_provider = PFSDataProvider(
-        config,
-        process_flow.calibration_library.parameters,
-        process_flow.calibration_library
-        )
-
-    for i, object_id in enumerate(spectra_list):
+    connection = None
+    if config.output_mode == 'shards':
+        # the shard files belong to this bunch only, no lock needed
+        write_dir = os.path.join(outdir, f'B{bunch_id}')
+        _init_shard(data_dir, write_dir)
+        lock_path = None
+    elif config.output_mode == 'service':
+        # the writer service owns the files, records are sent to it
+        write_dir = data_dir
+        lock_path = None
+        connection = connect(config.writer_address)
+    else:
+        write_dir = data_dir
+        lock_path = os.path.join(data_dir, "coZcand.lock")
+    writers = dict()
+
+    journal = None
+    done = set()
+    unwritten = []
+    if config.journal == 'on':
+        bunch_dir = os.path.join(outdir, f'B{bunch_id}')
+        os.makedirs(bunch_dir, exist_ok=True)
+        journal_path = os.path.join(bunch_dir, JOURNAL_FILENAME)
+        if config.continue_ and os.path.exists(journal_path):
+            done = get_journaled_spectra(journal_path)
+            logger.log(logging.INFO, f"{len(done)} spectra already journaled, skipped")
+            if lock_path is None:
+                unwritten = get_unwritten_records(journal_path, write_dir)
+            else:
+                # partly written records are removed from the shared files
+                l = Lock(lock_path)
+                l.lifetime = timedelta(hours=2)
+                l.lock()
+                try:
+                    unwritten = get_unwritten_records(journal_path, write_dir)
+                finally:
+                    l.unlock()
+        elif os.path.exists(journal_path):
+            os.remove(journal_path)
+        journal = Journal(journal_path)
+
+    write_behind = None
+    if config.write_behind == 'on' and connection is None:
+        # at most one batch of records waits for the writing thread
+        write_behind = WriteBehind(lambda writer: _flush_writer(writer, lock_path, f"B{bunch_id}"),
+                                   int(config.flush_size), logger)
+
+    prescreen = None
+    if float(config.prescreen_min_valid) > 0 or config.prescreen_target_types:
+        prescreen = PreScreen(config.prescreen_min_valid, config.prescreen_target_types)
+
+    for filename, record in unwritten:
+        # journaled before the interruption, appended without journaling them again
+        path = os.path.join(write_dir, filename)
+        if path not in writers:
+            writers[path] = _get_writer(path, config, connection, journal, write_behind)
+        writers[path].writer.append(record)
+    if unwritten:
+        logger.log(logging.WARNING, f"{len(unwritten)} journaled spectra were not written, "
+                   "written from the journal")
+
+    for bunch_file in bunch_files:
+        config.coadd_file = bunch_file['coadd_file']
+        config.coadd_index = bunch_file.get('coadd_index', '')
+        spectra_list = bunch_file['objIdList']
+        data_provider = PFSDataProvider(
+            config,
+            process_flow.calibration_library.parameters,
+            process_flow.calibration_library,
+            spectra_list
+            )
+
+        if int(config.prefetch_depth) > 0:
+            spectra = data_provider.prefetch(spectra_list, int(config.prefetch_depth),
+                                             float(config.prefetch_memory) * 2**20)
+        else:
+            spectra = data_provider.iter_spectra(spectra_list)
+
+        for object_id, spectrum, e in spectra:
+            if e is not None:
+                logger.log(logging.ERROR, f"Could not read spectrum with id {object_id} : {e}")
+                continue
+            if done:
+                # objIds are unique within a catId only, the skip is keyed on the file
+                pfs_object_id = spectrum.get_spectrum_infos()["pfs_object_id"]
+                if (get_output_filename(pfs_object_id["catId"]), int(pfs_object_id["objId"])) in done:
+                    continue
+
+            # results are written to the pfsCoZcandidates file of their catId
+            output = _process_spectrum(write_dir, spectrum, process_flow, writers, config, lock_path,
+                                       connection, journal, write_behind, prescreen)
+
+    if prescreen is not None:
+        logger.log(logging.INFO, f"{prescreen.nb_rejected} spectra rejected by pre-screening")
+    if write_behind is not None:
+        # writers are flushed by the write-behind thread
         try:
-            spectrum = data_provider.get_spectrum(object_id)
+            write_behind.close()
         except Exception as e:
-            logger.log(logging.ERROR, f"Could not read spectrum with id {object_id} : {e}")
-            continue
-        
-        output = _process_spectrum(data_dir, spectrum, process_flow, user_parameters, None)
-        
+            logger.log(logging.ERROR, f"Failed to write fits results : {e}")
+    else:
+        for writer in writers.values():
+            try:
+                _flush_writer(writer, lock_path, f"B{bunch_id}")
+            except Exception as e:
+                logger.log(logging.ERROR, f"Failed to write fits results to {writer.path} : {e}")
+    if connection is not None:
+        connection.close()
+    if journal is not None:
+        journal.close()
     logger.log(logging.INFO, "Bunch terminated")
 
 
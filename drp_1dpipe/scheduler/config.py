@@ -15,6 +15,7 @@ config_defaults = {
     'venv': '',
     'concurrency': 1,
     'coadd_file': '',
+    'coadd_list': '',
     'bunch_size': 8,
     'notification_url': '',
     'output_dir':'@AUTO@',
@@ -23,6 +24,24 @@ config_defaults = {
     'get_default_parameters': None,
     'debug':False,
     'object_id':0,
-    'report_line_snr_threshold':3
+    'report_line_snr_threshold':3,
+    'output_mode':'shared',
+    'flush_size':1,
+    'flush_interval':0,
+    'writer_address':'',
+    'journal':'off',
+    'write_behind':'off',
+    'prefetch_depth':0,
+    'prefetch_memory':0,
+    'prescreen_min_valid':0,
+    'prescreen_target_types':'',
+    'shared_coadd':'off',
+    'coadd_cache':'',
+    'output_backend':'fits',
+    'image_compression':'none',
+    'quantize_level':16,
+    'pdf_storage':'dense',
+    'ln_pdf_floor':-20.,
+    'product_level':'full'
     }
 
@@ -22,9 +22,11 @@ from drp_1dpipe.core.workers import get_worker,list_workers
 
 
 from drp_1dpipe.scheduler.config import config_defaults
-from drp_1dpipe.pre_process.pre_process import pre_process
+from drp_1dpipe.pre_process.pre_process import pre_process, list_coadd_files
 from drp_1dpipe.merge_results.merge_results import merge_results
 from drp_1dpipe.process_spectra.process_spectra import main_no_parse
+from drp_1dpipe.io.writerService import start_service, stop_service
+from drp_1dpipe.io.PFSSharedCoadd import create_shared_coadd, release_shared_coadd
 from drp_1dpipe import version as drp_1dpipe_version
 # logger = logging.getLogger("scheduler")
 
@@ -50,8 +52,11 @@ def define_specific_program_options():
     parser.add_argument('--concurrency', '-j', type=int,
                         help='Concurrency level for local parallel run. -1 means maximum.')
     parser.add_argument('--coadd_file', metavar='FILE', action=AbspathAction,
-                        help='Base path where to find pfsCoadd file '
-                        'Relative to workdir.')
+                        help='Base path where to find pfsCoadd file, or glob pattern of several '
+                        'files. Relative to workdir.')
+    parser.add_argument('--coadd_list', metavar='FILE', action=AbspathAction,
+                        help='Text file listing pfsCoadd files or glob patterns, one per line. '
+                        'Bunches are built across all the files.')
     parser.add_argument('--bunch_size', '-n', metavar='SIZE',
                         help='Maximum number of spectra per bunch.')
     parser.add_argument('--notification_url', metavar='URL',
@@ -70,6 +75,48 @@ def define_specific_program_options():
                         help='Run pipeline on a single object id belonging to coadd_file')
     parser.add_argument('--report_line_snr_threshold',type=float,
                         help='snr threshold use to define correctness of a line measurement in report.json')
+    parser.add_argument('--output_mode', choices=['shared', 'shards', 'service'],
+                        help='Whether bunches write into a single locked pfsCoZcandidates '
+                        'file (shared), into their own shard merged at the end (shards) '
+                        'or send their results to a single writer process (service, local '
+                        'scheduler only).')
+    parser.add_argument('--flush_size', type=int,
+                        help='Number of spectra results buffered by each bunch before writing them.')
+    parser.add_argument('--flush_interval', type=float,
+                        help='Maximum time in seconds results stay buffered, 0 to disable.')
+    parser.add_argument('--output_backend', choices=['fits', 'hdf5'],
+                        help='Append results to the pfsCoZcandidates files (fits) or to HDF5 files '
+                        'next to them (hdf5), exported to pfsCoZcandidates by merge_results.')
+    parser.add_argument('--shared_coadd', choices=['on', 'off'],
+                        help='Decode the coadd once in shared memory for all the process_spectra '
+                        'of a local run.')
+    parser.add_argument('--prefetch_depth', type=int,
+                        help='Number of spectra loaded ahead by a background thread, 0 to disable.')
+    parser.add_argument('--prefetch_memory', type=float,
+                        help='Maximum size in MB of the spectra loaded ahead, 0 for no limit.')
+    parser.add_argument('--prescreen_min_valid', type=float,
+                        help='Minimum fraction of valid pixels of a processed spectrum, others get '
+                        'a PRESCREEN_REJECTED init error without running the library. 0 to disable.')
+    parser.add_argument('--prescreen_target_types', metavar='TYPES',
+                        help='Comma separated targetTypes not processed, as sky fibers, getting a '
+                        'PRESCREEN_REJECTED init error.')
+    parser.add_argument('--write_behind', choices=['on', 'off'],
+                        help='Write results from a background thread while the next spectra are '
+                        'processed.')
+    parser.add_argument('--journal', choices=['on', 'off'],
+                        help='Journal spectra results in the bunch directories before writing them, '
+                        'for recovery with drp_1drecover.')
+    parser.add_argument('--image_compression', choices=['none', 'lossless', 'quantized'],
+                        help='Tile compression of the pfsCoZcandidates models and ln pdf images, '
+                        'lossless or quantized, applied once all results are merged.')
+    parser.add_argument('--quantize_level', type=float,
+                        help='Quantization level of quantized image compression.')
+    parser.add_argument('--pdf_storage', choices=['dense', 'sparse'],
+                        help='Store ln pdf as full grids (dense) or as the bins above ln_pdf_floor (sparse).')
+    parser.add_argument('--ln_pdf_floor', type=float,
+                        help='ln pdf value under which bins are not stored in sparse pdf storage.')
+    parser.add_argument('--product_level', choices=['full', 'standard', 'minimal'],
+                        help='Products written, standard skips models, minimal skips models and ln pdf.')
     return parser
 
 
@@ -135,8 +182,31 @@ def main_method(config):
         traceback.print_exc()
         raise e
 
+    # options are checked before starting the writer service, which would outlive an error
+    if config.output_mode == 'service' and config.scheduler.lower() == 'slurm':
+        raise Exception("service output mode is not available with slurm scheduler")
+    if config.shared_coadd == 'on' and not config.debug and config.scheduler.lower() != 'local':
+        raise Exception("shared coadd is only available with local scheduler")
+
+    shared_blocks = []
+    if config.shared_coadd == 'on' and not config.debug:
+        coadd_files = list_coadd_files(config.coadd_file, config.coadd_list, normpath(config.workdir))
+        if len(coadd_files) == 1:
+            config.coadd_cache = os.path.join(config.output_dir, 'coadd_cache.json')
+            try:
+                shared_blocks = create_shared_coadd(coadd_files[0], config.coadd_cache)
+            except Exception as e:
+                logger.warning(f"failed to share coadd, each bunch reads it : {e}")
+                config.coadd_cache = ''
+        else:
+            logger.warning("shared coadd is only available with a single input file, each bunch reads its files")
+
     worker = get_worker(config.scheduler)(config)
-    
+
+    service = None
+    if config.output_mode == 'service':
+        service, config.writer_address = start_service(config)
+
     # process spectra
 
     try:
@@ -148,6 +218,17 @@ def main_method(config):
                               'spectra_listfile': os.path.join(config.output_dir,'spectralist_B0.json'),
                               'output_dir': os.path.join(config.output_dir,'B0'),
                               'logdir': os.path.join(config.output_dir,'log','B0'),
+                              'output_mode': config.output_mode,
+                              'flush_size': config.flush_size,
+                              'flush_interval': config.flush_interval,
+                              'writer_address': config.writer_address,
+                              'journal': config.journal,
+                              'write_behind': config.write_behind,
+                              'prefetch_depth': config.prefetch_depth,
+                              'prefetch_memory': config.prefetch_memory,
+                              'prescreen_min_valid': config.prescreen_min_valid,
+                              'prescreen_target_types': config.prescreen_target_types,
+                              'output_backend': config.output_backend,
                              })
         else:
             for i in range(nb_bunches):
@@ -155,7 +236,12 @@ def main_method(config):
     except Exception as e:
         traceback.print_exc()
 
-    worker.wait_all()
+    try:
+        worker.wait_all()
+    finally:
+        if service is not None:
+            stop_service(service, config.writer_address)
+        release_shared_coadd(shared_blocks)
 
     merge_results(config)
     return 0
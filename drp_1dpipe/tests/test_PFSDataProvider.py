@@ -1,4 +1,6 @@
+import pytest
 from collections import namedtuple
+import numpy as np
 
 from drp_1dpipe.io.PFSDataProvider import PFSDataProvider
 
@@ -30,3 +32,61 @@ def test_PFSDataProvider(mocker):
 
     spectrum = dp.get_spectrum('4')
     assert spectrum.source_id == '4'
+
+
+def test_PFSDataProvider_prefetch():
+    """
+    Check prefetched spectra come in order with their loading errors
+    """
+    Config = namedtuple("Config", "reader coadd_file")
+    dp = PFSDataProvider(Config(reader="pfs", coadd_file=None), MyParam(), None)
+    loading = []
+
+    class FakeSpectrum:
+        def __init__(self, object_id):
+            self.object_id = object_id
+        def get_wave(self, filtered_only=True):
+            return np.zeros(10)
+
+    def iter_spectra(object_ids):
+        for object_id in object_ids:
+            loading.append(object_id)
+            if object_id == 2:
+                yield object_id, None, Exception("bad spectrum")
+            else:
+                yield object_id, FakeSpectrum(object_id), None
+
+    dp.iter_spectra = iter_spectra
+    seen = []
+    for object_id, spectrum, error in dp.prefetch(range(5), 2):
+        # at most depth spectra are loaded ahead
+        assert len(loading) <= object_id + 3
+        if object_id == 2:
+            assert spectrum is None and str(error) == "bad spectrum"
+        else:
+            assert spectrum.object_id == object_id and error is None
+        seen.append(object_id)
+    assert seen == list(range(5))
+    # memory ceiling of one spectrum
+    assert [object_id for object_id, _, _ in dp.prefetch(range(3), 5, 1)] == [0, 1, 2]
+
+
+def test_PFSDataProvider_prefetch_error():
+    """
+    Check an error of the loading thread is raised by the iteration
+    """
+    Config = namedtuple("Config", "reader coadd_file")
+    dp = PFSDataProvider(Config(reader="pfs", coadd_file=None), MyParam(), None)
+
+    class BrokenSpectrum:
+        def get_wave(self, filtered_only=True):
+            raise ValueError("no wavelength")
+
+    def iter_spectra(object_ids):
+        for object_id in object_ids:
+            yield object_id, BrokenSpectrum(), None
+
+    dp.iter_spectra = iter_spectra
+    with pytest.raises(ValueError, match="no wavelength"):
+        for item in dp.prefetch(range(3), 2):
+            pass
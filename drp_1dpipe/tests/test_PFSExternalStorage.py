@@ -1,10 +1,13 @@
+import os
 import pytest
 from collections import namedtuple
 import numpy as np
+from astropy.io import fits
 
 from drp_1dpipe.process_spectra.config import config_defaults
 from drp_1dpipe.core.utils import  config_update
-from drp_1dpipe.io.PFSExternalStorage import PFSExternalStorage
+from drp_1dpipe.io.PFSExternalStorage import PFSExternalStorage, read_observation_infos
+from drp_1dpipe.io.PFSSharedCoadd import create_shared_coadd, release_shared_coadd
 
 # Define local test content
 class FackPfsObject():
@@ -79,4 +82,80 @@ def test_PFSExternalStorage(mocker):
     new_storage.read("0","my_file.fits","obs_id")
     mock_read_pfs_product.assert_called_once()
     new_storage.read("0","my_file.fits","obs_id")
-    mock_read_pfs_product.assert_called_once()
\ No newline at end of file
+    mock_read_pfs_product.assert_called_once()
+
+def test_PFSExternalStorage_shared_coadd(mocker, tmp_path):
+    """
+    Check spectra are read from the coadd shared by the scheduler
+    """
+    mocker.patch("pfs.datamodel.drp.PfsCoadd.readFits").return_value = {"source": FackPfsObject()}
+    manifest_path = str(tmp_path / "coadd_cache.json")
+    blocks = create_shared_coadd("my_file.fits", manifest_path)
+    try:
+        config = config_update(config_defaults)
+        config.coadd_cache = manifest_path
+        storage = PFSExternalStorage(config)
+        pfs_object = storage.read("12", "my_file.fits", "obs_id")
+        assert storage.global_infos["damd_version"] == "2.0"
+        assert storage.spectrum_infos["astronomical_source_id"] == "00001-00002-PP-000000000000000c"
+        assert np.array_equal(pfs_object.flux, FackPfsObject.flux)
+        assert not pfs_object.flux.flags.writeable
+    finally:
+        release_shared_coadd(blocks)
+
+
+def _write_coadd(path):
+    target = np.zeros(2, dtype=[('targetId', '>i4'), ('objId', '>i8'), ('ra', '>f8'),
+                                ('dec', '>f8'), ('targetType', '>i4')])
+    target['targetId'] = [5, 6]
+    target['objId'] = [20, 10]
+    target['ra'] = [1., 2.]
+    target['dec'] = [3., 4.]
+    target['targetType'] = 1
+    observations = np.zeros(3, dtype=[('targetId', '>i4'), ('arm', 'S1'), ('pfsDesignId', '>i8'),
+                                      ('visit', '>i4'), ('fiberId', '>i4')])
+    observations['targetId'] = [6, 5, 6]
+    observations['arm'] = [b'r', b'b', b'b']
+    observations['pfsDesignId'] = [100, 101, 102]
+    observations['visit'] = [1, 2, 3]
+    observations['fiberId'] = [7, 8, 9]
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.BinTableHDU(target, name="TARGET"),
+                  fits.BinTableHDU(observations, name="OBSERVATIONS"),
+                  fits.ImageHDU(np.arange(8.).reshape(2, 4), name="FLUX")]).writeto(path)
+
+
+def test_read_observation_infos(tmp_path):
+    """
+    Check the column-wise observation infos of a coadd file
+    """
+    path = os.path.join(tmp_path, "pfsCoadd.fits")
+    _write_coadd(path)
+    infos = read_observation_infos(path)
+    assert list(infos) == [20, 10]
+    assert infos[20] == {"arms": "b", "nVisit": 1, "RA": 1., "DEC": 3., "designIds": [101],
+                         "visits": [2], "fiberId": [8], "targetType": 1}
+    assert infos[10]["arms"] == "br"
+    assert infos[10]["visits"] == [1, 3]
+    assert infos[10]["designIds"] == [100, 102]
+
+
+def test_PFSExternalStorage_lazy(mocker, tmp_path):
+    """
+    Check only the rows of the bunch are decoded from a pfsCalibrated file
+    """
+    path = os.path.join(tmp_path, "pfsCalibrated.fits")
+    _write_coadd(path)
+    decoded = dict()
+
+    def read_fits(source):
+        hdulist = fits.open(source)
+        decoded.update({hdu.name: hdu.data.copy() for hdu in hdulist[1:]})
+
+    mocker.patch("pfs.datamodel.drp.PfsCalibrated.readFits").side_effect = read_fits
+    storage = PFSExternalStorage(config_update(config_defaults))
+    assert storage.load(path, ["10", "30"]) == ["10", "30"]
+    assert list(decoded["TARGET"]["objId"]) == [10]
+    assert list(decoded["OBSERVATIONS"]["visit"]) == [1, 3]
+    assert decoded["FLUX"].tolist() == [[4., 5., 6., 7.]]
+    assert list(storage.observation_infos) == [10]
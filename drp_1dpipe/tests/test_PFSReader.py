@@ -1,9 +1,10 @@
 import pytest
+import numpy as np
 from collections import namedtuple
 
 from drp_1dpipe.process_spectra.config import config_defaults
 from drp_1dpipe.core.utils import  config_update
-from drp_1dpipe.io.PFSReader import PFSReader
+from drp_1dpipe.io.PFSReader import PFSReader, get_flux_factor
 
 def test_PFSReader():
 
@@ -14,3 +15,46 @@ def test_PFSReader():
     reader = PFSReader(None, None, None)
 
 
+
+
+def test_get_flux_factor():
+    """
+    Check the flux factor is computed once per wavelength grid
+    """
+    wave = np.linspace(3800., 12600., 100)
+    factor = get_flux_factor(wave)
+    assert factor.dtype == np.float32
+    assert np.allclose(factor, 1 / wave ** 2 * 2.99792458 / 10 ** 14, rtol=1e-6)
+    assert get_flux_factor(wave.copy()) is factor
+    other = wave.copy()
+    other[50] += 1
+    assert get_flux_factor(other) is not factor
+    assert get_flux_factor(other)[50] != factor[50]
+
+
+def test_load_flux_error_float32():
+    """
+    Check float32 flux and error match the float64 conversion
+    """
+    class Container(dict):
+        def append(self, data, obs_id):
+            self[obs_id] = data
+
+    rng = np.random.default_rng(0)
+    nm_wave = np.linspace(380., 1260., 11501)
+    pfs_object = namedtuple("PfsCoadd", ["wavelength", "flux", "covar"])(
+        nm_wave, rng.normal(1e3, 1e2, nm_wave.size), rng.uniform(1., 1e4, (3, nm_wave.size)))
+    reader = PFSReader(None, None, None)
+    reader.waves, reader.fluxes, reader.errors = Container(), Container(), Container()
+    reader.load_wave(pfs_object)
+    reader.load_flux(pfs_object)
+    reader.load_error(pfs_object)
+
+    wave = nm_wave * 10
+    flux = 1 / wave ** 2 * pfs_object.flux * 2.99792458 / 10 ** 14
+    error = 1 / wave ** 2 * np.sqrt(pfs_object.covar[0]) * 2.99792458 / 10 ** 14
+    assert reader.fluxes.get("").dtype == np.float32
+    assert reader.errors.get("").dtype == np.float32
+    # float32 rounding of the factor and of the data
+    assert np.allclose(reader.fluxes.get(""), flux, rtol=5e-7, atol=0)
+    assert np.allclose(reader.errors.get(""), error, rtol=5e-7, atol=0)
@@ -1,4 +1,34 @@
-from drp_1dpipe.io.redshiftCoCandidates import filter_warning
+import os
+import tempfile
+import time
+import threading
+import logging
+import pytest
+from types import SimpleNamespace
+import h5py
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from pylibamazed.Exception import AmazedError
+
+from drp_1dpipe.io import redshiftCoCandidates
+from drp_1dpipe.io.redshiftCoCandidates import (filter_warning, concatenate_output_files,
+                                              CoZcandidatesWriter, GrowableArray,
+                                              sparsify_ln_pdf, expand_ln_pdf, _ln_pdf_hdu, LN_PDF_CHUNK,
+                                              InterpolationPlan, get_model_factor, convert_to_regular,
+                                              compress_output_file,
+                                              RedshiftCoCandidates, get_skipped_hdus)
+from drp_1dpipe.io.writerService import start_service, stop_service, connect, ServiceWriter
+from drp_1dpipe.io.journal import (Journal, JournaledWriter, read_journal, recover_output,
+                                   get_unwritten_records, get_journaled_spectra)
+from drp_1dpipe.io.columnarOutput import (H5CandidatesWriter, concatenate_columnar_files,
+                                          export_fits, read_table, get_columnar_path)
+from drp_1dpipe.io.writeBehind import WriteBehind, WriteBehindWriter
+from drp_1dpipe.io.gridCache import GridCache
+from drp_1dpipe.merge_results.merge_results import export_columnar_files, merge_shards
+from drp_1dpipe.io.PFSMetadata import probe_coadd_metadata
+from drp_1dpipe.io.PFSCoaddIndex import (write_coadd_index, read_coadd_index, find_coadd_rows,
+                                         read_coadd_rows)
 
 def test_filter_warning():
     """
@@ -8,4 +38,783 @@ def test_filter_warning():
     assert filter_warning(5,[2]) == 4
     assert filter_warning(5,[1]) == 0
     assert filter_warning(5,[0, 2]) == 5
-    assert filter_warning(7,[0, 1, 2]) == 7
\ No newline at end of file
+    assert filter_warning(7,[0, 1, 2]) == 7
+
+def _rows(nb_targets, value):
+    """Rows of nb_targets targets with objId value, two candidates each"""
+    target = np.zeros(nb_targets, dtype=[('targetId', '>i2'), ('objId', '>i8')])
+    target['targetId'] = np.arange(nb_targets)
+    target['objId'] = value
+    candidates = np.zeros(2*nb_targets, dtype=[('targetId', '>i2'), ('modelId', '>i2')])
+    candidates['targetId'] = np.repeat(np.arange(nb_targets), 2)
+    candidates['modelId'] = np.arange(2*nb_targets)
+    return {"TARGET": target,
+            "GALAXY_CANDIDATES": candidates,
+            "GALAXY_MODELS": np.full((2*nb_targets, 3), value, dtype=np.float32)}
+
+
+def _write_shard(path, nb_targets, value):
+    rows = _rows(nb_targets, value)
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.BinTableHDU(rows["TARGET"], name="TARGET"),
+                  fits.BinTableHDU(rows["GALAXY_CANDIDATES"], name="GALAXY_CANDIDATES"),
+                  fits.ImageHDU(rows["GALAXY_MODELS"], name="GALAXY_MODELS"),
+                  fits.BinTableHDU.from_columns([fits.Column(name="redshift", format="E",
+                                                             array=np.arange(4))],
+                                                name="GALAXY_REDSHIFT_GRID")
+                  ]).writeto(path)
+
+
+def test_concatenate_output_files():
+    """
+    Check shards are appended with renumbered targetId and modelId
+    """
+    wd = tempfile.TemporaryDirectory()
+    paths = [os.path.join(wd.name, f"{i}.fits") for i in range(3)]
+    for i, path in enumerate(paths):
+        _write_shard(path, i, i)
+    concatenate_output_files(paths[0], paths[1:])
+    with fits.open(paths[0]) as hdulist:
+        assert list(hdulist["TARGET"].data["targetId"]) == [0, 1, 2]
+        assert list(hdulist["TARGET"].data["objId"]) == [1, 2, 2]
+        assert list(hdulist["GALAXY_CANDIDATES"].data["targetId"]) == [0, 0, 1, 1, 2, 2]
+        assert list(hdulist["GALAXY_CANDIDATES"].data["modelId"]) == [0, 1, 2, 3, 4, 5]
+        assert hdulist["GALAXY_MODELS"].data.shape == (6, 3)
+        assert len(hdulist["GALAXY_REDSHIFT_GRID"].data) == 4
+
+
+def test_merge_shards():
+    """
+    Check shards merged by an interrupted merge are not appended again
+    """
+    wd = tempfile.TemporaryDirectory()
+    os.makedirs(os.path.join(wd.name, "data"))
+    path = os.path.join(wd.name, "data", "pfsCoZcandidates-test.fits")
+    _write_shard(path, 0, 0)
+    shard_paths = []
+    for bunch_id in range(3):
+        os.makedirs(os.path.join(wd.name, f"B{bunch_id}"))
+        shard_paths.append(os.path.join(wd.name, f"B{bunch_id}", "pfsCoZcandidates-test.fits"))
+        _write_shard(shard_paths[-1], 1, bunch_id + 1)
+        fits.setval(shard_paths[-1], "SHARDID", value=f"{bunch_id:032x}")
+    copies = []
+    for shard_path in shard_paths:
+        with open(shard_path, "rb") as f:
+            copies.append(f.read())
+    merge_shards(wd.name, 2)
+    assert list(read_table(path, "TARGET")["objId"]) == [1, 2]
+    assert not os.path.exists(shard_paths[0]) and os.path.exists(shard_paths[2])
+    # interrupted before removing the shards
+    for shard_path, copy in zip(shard_paths[:2], copies):
+        with open(shard_path, "wb") as f:
+            f.write(copy)
+    merge_shards(wd.name, 3)
+    assert list(read_table(path, "TARGET")["objId"]) == [1, 2, 3]
+    assert list(read_table(path, "GALAXY_CANDIDATES")["modelId"]) == list(range(6))
+    assert fits.getheader(path)["MERGED"].split() == [f"{bunch_id:032x}" for bunch_id in range(3)]
+    assert not any(os.path.exists(shard_path) for shard_path in shard_paths)
+
+
+def _record(nb_targets):
+    """Record of nb_targets targets, their objId being nb_targets"""
+    return _rows(nb_targets, nb_targets)
+
+
+@pytest.fixture
+def empty_file(tmp_path):
+    """Path of a pfsCoZcandidates file without rows"""
+    path = str(tmp_path / "pfsCoZcandidates-00001.fits")
+    _write_shard(path, 0, 0)
+    return path
+
+
+def _get_nb_targets(path):
+    return fits.getheader(path, "TARGET")["NAXIS2"]
+
+
+def test_writer_buffering(empty_file):
+    """
+    Check rows are written in one pass every flush_size spectra or flush_interval seconds
+    """
+    writer = CoZcandidatesWriter(empty_file, flush_size=3)
+    for nb_targets in [1, 2]:
+        writer.append(_record(nb_targets))
+        assert not writer.need_flush()
+    assert _get_nb_targets(empty_file) == 0
+    writer.append(_record(1))
+    assert writer.need_flush()
+    writer.flush()
+    assert not writer.need_flush()
+    assert _get_nb_targets(empty_file) == 4
+
+    writer = CoZcandidatesWriter(empty_file, flush_size=100, flush_interval=0.05)
+    writer.append(_record(1))
+    assert not writer.need_flush()
+    time.sleep(0.1)
+    assert writer.need_flush()
+    writer.flush()
+    time.sleep(0.1)
+    # nothing buffered
+    assert not writer.need_flush()
+
+
+def test_writers_sharing_file(empty_file):
+    """
+    Check interleaved flushes of two writers keep ids contiguous
+    """
+    path = empty_file
+    first = CoZcandidatesWriter(path, flush_size=2)
+    second = CoZcandidatesWriter(path, flush_size=2)
+    first.append(_record(1))
+    assert not first.need_flush()
+    second.append(_record(2))
+    first.append(_record(1))
+    assert first.need_flush()
+    first.flush()
+    second.flush()
+    with fits.open(path) as hdulist:
+        assert list(hdulist["TARGET"].data["targetId"]) == [0, 1, 2, 3]
+        assert list(hdulist["TARGET"].data["objId"]) == [1, 1, 2, 2]
+        assert list(hdulist["GALAXY_CANDIDATES"].data["targetId"]) == [0, 0, 1, 1, 2, 2, 3, 3]
+        assert list(hdulist["GALAXY_CANDIDATES"].data["modelId"]) == list(range(8))
+        assert list(hdulist["GALAXY_MODELS"].data[:, 0]) == [1, 1, 1, 1, 2, 2, 2, 2]
+
+
+def test_growable_array():
+    """
+    Check rows are kept when the buffer capacity grows
+    """
+    image = GrowableArray(np.empty((0, 3), dtype=np.float32), capacity=1)
+    for i in range(5):
+        image.append_row(np.full(3, i))
+    assert image.data.shape == (5, 3)
+    assert list(image.data[:, 0]) == [0, 1, 2, 3, 4]
+    table = GrowableArray(np.empty(0, dtype=[('targetId', '>i2'), ('objId', '>i8')]), capacity=1)
+    assert table.append_row((0, 7)) == 0
+    table.append(np.array([(1, 8), (2, 9)], dtype=[('targetId', 'i4'), ('objId', 'i4')]))
+    assert list(table.data["objId"]) == [7, 8, 9]
+    table.clear()
+    assert len(table) == 0
+
+
+def test_writer_service(empty_file, tmp_path):
+    """
+    Check records sent by several clients are all written by the service
+    """
+    path = empty_file
+    config = SimpleNamespace(flush_size=2, flush_interval=0, logdir=str(tmp_path), log_level=30,
+                             output_backend="fits")
+    service, address = start_service(config)
+    for nb_targets in [1, 2, 1]:
+        with connect(address) as connection:
+            ServiceWriter(path, connection).append(_record(nb_targets))
+    stop_service(service, address)
+    with fits.open(path) as hdulist:
+        assert list(hdulist["TARGET"].data["targetId"]) == [0, 1, 2, 3]
+        assert sorted(hdulist["TARGET"].data["objId"]) == [1, 1, 2, 2]
+        assert list(hdulist["GALAXY_CANDIDATES"].data["modelId"]) == list(range(8))
+
+
+def test_writer_compressed_images(empty_file):
+    """
+    Check rows are appended to empty tile-compressed images without loss
+    """
+    path = empty_file
+    with fits.open(path, "update") as hdulist:
+        hdulist["GALAXY_MODELS"] = fits.CompImageHDU(np.empty((0, 3), dtype=np.float32),
+                                                     name="GALAXY_MODELS",
+                                                     compression_type="GZIP_2",
+                                                     quantize_level=0.0)
+    record = _record(2)
+    record["GALAXY_MODELS"] = np.random.default_rng(0).normal(size=(4, 3)).astype(np.float32)
+    writer = CoZcandidatesWriter(path)
+    writer.append(record)
+    writer.flush()
+    with fits.open(path) as hdulist:
+        assert isinstance(hdulist["GALAXY_MODELS"], fits.CompImageHDU)
+        assert np.array_equal(hdulist["GALAXY_MODELS"].data, record["GALAXY_MODELS"])
+
+
+def test_quantized_images(empty_file, tmp_path):
+    """
+    Check quantized images are compressed once, after rows written by several flushes
+    """
+    with fits.open(empty_file, "update") as hdulist:
+        hdulist[0].header["IMGCOMP"] = "quantized"
+        hdulist[0].header["QUANTLVL"] = 16
+    models = np.random.default_rng(0).normal(size=(40, 3)).astype(np.float32)
+    writer = CoZcandidatesWriter(empty_file, flush_size=1)
+    for i in range(20):
+        writer.append(dict(_record(1), GALAXY_MODELS=models[2*i:2*i + 2]))
+        writer.flush()
+    with fits.open(empty_file) as hdulist:
+        assert not isinstance(hdulist["GALAXY_MODELS"], fits.CompImageHDU)
+        assert np.array_equal(hdulist["GALAXY_MODELS"].data, models)
+    compress_output_file(empty_file)
+    # error of the same rows compressed in a single write
+    once_path = str(tmp_path / "once.fits")
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.CompImageHDU(models, name="GALAXY_MODELS", compression_type="RICE_1",
+                                    quantize_level=16, quantize_method=2)]).writeto(once_path)
+    with fits.open(once_path) as hdulist:
+        once_error = np.max(np.abs(hdulist["GALAXY_MODELS"].data - models))
+    with fits.open(empty_file) as hdulist:
+        assert isinstance(hdulist["GALAXY_MODELS"], fits.CompImageHDU)
+        assert hdulist["GALAXY_MODELS"].quantize_level == 16
+        assert np.max(np.abs(hdulist["GALAXY_MODELS"].data - models)) <= 1.5 * once_error
+    writer.append(_record(1))
+    with pytest.raises(Exception, match="quantized again"):
+        writer.flush()
+
+
+def test_product_levels():
+    """
+    Check the HDUs skipped by each product level are left empty
+    """
+    wd = tempfile.TemporaryDirectory()
+    for level, skipped in [("full", []),
+                           ("standard", ["GALAXY_MODELS"]),
+                           ("minimal", ["GALAXY_MODELS", "GALAXY_LN_PDF"])]:
+        path = os.path.join(wd.name, f"{level}.fits")
+        _write_shard(path, 0, 0)
+        with fits.open(path, "update") as hdulist:
+            hdulist[0].header["PRODLVL"] = level
+            hdulist.append(fits.ImageHDU(np.empty((0, 4), dtype=np.float32), name="GALAXY_LN_PDF"))
+        header = fits.getheader(path)
+        assert [name for name in ["GALAXY_MODELS", "GALAXY_LN_PDF"] if name in get_skipped_hdus(header)] == skipped
+        writer = CoZcandidatesWriter(path)
+        assert {"GALAXY_MODELS", "GALAXY_LN_PDF"} - set(writer.layout) == set(skipped)
+        record = {name: rows for name, rows in _record(1).items() if name in writer.layout}
+        if "GALAXY_LN_PDF" in writer.layout:
+            record["GALAXY_LN_PDF"] = np.zeros((1, 4), dtype=np.float32)
+        writer.append(record)
+        writer.flush()
+        with fits.open(path) as hdulist:
+            assert hdulist["TARGET"].header["NAXIS2"] == 1
+            # one model per candidate, one ln pdf per target
+            for name, nb_rows in [("GALAXY_MODELS", 2), ("GALAXY_LN_PDF", 1)]:
+                assert hdulist[name].header.get("NAXIS2", 0) == (0 if name in skipped else nb_rows)
+
+
+def test_sparse_ln_pdf(empty_file):
+    """
+    Check sparse ln pdf rows are written and expand back to the bins above floor
+    """
+    grid = np.arange(1000)
+    ln_pdfs = [np.float32(-0.5*((grid - 300)/3.)**2), np.float32(-0.5*((grid - 700)/2.)**2)]
+    ln_pdfs[0][750] = 0
+    with fits.open(empty_file, "update") as hdulist:
+        hdulist.append(_ln_pdf_hdu("GALAXY_LN_PDF", len(grid), "none", 16, "sparse", -10))
+    writer = CoZcandidatesWriter(empty_file)
+    assert writer.ln_pdf_floors == {"GALAXY_LN_PDF": -10}
+    # the last target has no ln pdf, as for a solver error
+    for ln_pdf in ln_pdfs + [None]:
+        rows = np.array(writer.layout["GALAXY_LN_PDF"])
+        if ln_pdf is not None:
+            starts, values = sparsify_ln_pdf(ln_pdf, -10)
+            rows = np.zeros(len(starts), dtype=rows.dtype)
+            rows["start"] = starts
+            rows["values"] = values
+        writer.append(dict(_record(1), GALAXY_LN_PDF=rows))
+    writer.flush()
+    with fits.open(empty_file) as hdulist:
+        hdu = hdulist["GALAXY_LN_PDF"]
+        assert list(np.unique(hdu.data["targetId"])) == [0, 1]
+        # a few rows instead of one row of all the bins per target
+        assert len(hdu.data) * LN_PDF_CHUNK < 3 * len(grid) / 10
+        dense = expand_ln_pdf(hdu, 3)
+    for i, ln_pdf in enumerate(ln_pdfs):
+        above = ln_pdf >= -10
+        assert np.array_equal(dense[i][above], ln_pdf[above])
+        assert np.all(dense[i][~above] == -10)
+    assert np.all(dense[2] == 0)
+
+
+def test_interpolation_plan():
+    """
+    Check the interpolation plan gives the same values as numpy.interp
+    """
+    rng = np.random.default_rng(0)
+    native_grid = np.cumsum(rng.uniform(0.01, 0.1, 500))
+    regular_grid = np.linspace(native_grid[0] - 1, native_grid[-1] + 1, 1000)
+    plan = InterpolationPlan(native_grid, regular_grid)
+    for _ in range(3):
+        values = rng.normal(size=500) * 100
+        assert np.array_equal(plan.apply(values), np.interp(regular_grid, native_grid, values))
+
+
+def test_convert_to_regular(mocker):
+    """
+    Check the interpolation plan replaces convertToRegular after the first spectrum
+    """
+    rng = np.random.default_rng(0)
+    native_grid = np.cumsum(rng.uniform(0.01, 0.1, 50))
+    regular_grid = np.linspace(native_grid[0], native_grid[-1], 80)
+    builds = []
+
+    class Output:
+        def __init__(self, ln_pdf):
+            self.ln_pdf = ln_pdf
+        def get_attribute(self, object_type, dataset, attribute):
+            return {"PDFZGrid": native_grid, "LogZPdfNative": self.ln_pdf}[attribute]
+
+    class Handler:
+        def __init__(self, output):
+            builds.append(output)
+            self.redshifts = native_grid
+            self.valProbaLog = output.ln_pdf
+        def convertToRegular(self):
+            self.valProbaLog = np.interp(regular_grid, native_grid, self.valProbaLog)
+
+    builder = mocker.patch("drp_1dpipe.io.redshiftCoCandidates.BuilderPdfHandler")
+    builder.return_value.add_params.side_effect = lambda output, object_type, logsampling: \
+        SimpleNamespace(build=lambda: Handler(output))
+    mocker.patch("drp_1dpipe.io.redshiftCoCandidates.get_final_regular_z_grid").return_value = regular_grid
+    parameters = object()
+    for _ in range(3):
+        ln_pdf = rng.normal(size=50) * 100
+        pdf = convert_to_regular(Output(ln_pdf), "galaxy", parameters)
+        assert np.allclose(pdf, np.interp(regular_grid, native_grid, ln_pdf), rtol=1e-12)
+    # only the first spectrum went through a PdfHandler
+    assert len(builds) == 1
+
+
+def test_grid_cache():
+    """
+    Check grid values are cached per grid, in a bounded cache
+    """
+    cache = GridCache(maxsize=2)
+    grids = [np.linspace(0., 1., 10) + i for i in range(3)]
+    calls = []
+    compute = lambda grid: calls.append(grid[0]) or grid * 2
+    for grid in grids[:2] + grids[:2]:
+        cache.get(grid, compute)
+    assert calls == [0., 1.]
+    # same size and bounds, different content
+    other = grids[0].copy()
+    other[5] += 0.01
+    assert cache.get(other, compute)[5] == other[5] * 2
+    cache.get(grids[2], compute)
+    assert len(cache.entries) == 2
+    wavelength = np.linspace(3800., 12600., 100)
+    assert get_model_factor(wavelength.copy()) is get_model_factor(wavelength)
+    assert np.allclose(get_model_factor(wavelength), wavelength ** 2 / 2.99792458 * 1e14, rtol=1e-6)
+
+
+def test_model_on_lambda_range():
+    """
+    Check models of a masked spectrum match the float64 np.place reconstruction
+    """
+    wavelength = np.linspace(3800., 12600., 50)
+    mask = np.zeros(50, dtype=int)
+    mask[[0, 1, 10, 30, 49]] = 1
+    fluxes = [np.linspace(1e-17, 2e-17, 45), np.linspace(1e-17, 2e-17, 20)]
+
+    class Output:
+        def get_dataset(self, object_type, dataset, rank):
+            return {"ModelFlux": fluxes[rank]}
+
+    spectrum = SimpleNamespace(get_spectrum_infos=dict,
+                               get_wave=lambda filtered_only: wavelength,
+                               get_others=lambda filtered_only: {"mask": mask})
+    rc = RedshiftCoCandidates(Output(), spectrum, None, None)
+    models = np.empty((2, 50), dtype=np.float32)
+    # a model shorter than the unmasked pixels is repeated, as by np.place
+    for rank, flux in enumerate(fluxes):
+        expected = np.array(wavelength, dtype=np.float64, copy=True)
+        expected.fill(np.nan)
+        np.place(expected, mask == 0, flux)
+        expected = np.float32(wavelength ** 2 * expected * (1 / 2.99792458) * 10 ** 14)
+        model = rc._get_model_on_lambda_range("galaxy", rank, models[rank])
+        assert model.dtype == np.float32 and np.shares_memory(model, models)
+        assert np.array_equal(np.isnan(model), mask == 1)
+        np.testing.assert_allclose(model, expected, rtol=2e-7)
+
+
+def test_get_candidates_data(caplog):
+    """
+    Check candidates attributes missing from the rank dataset are requested one by one,
+    a missing dataset being logged once
+    """
+    class Output:
+        def __init__(self, error=AmazedError("no model_parameters dataset")):
+            self.requested = []
+            self.error = error
+        def get_dataset(self, object_type, dataset, rank):
+            if rank == 1:
+                raise self.error
+            return {"Redshift": 0.5}
+        def get_candidate_data(self, object_type, rank, name):
+            self.requested.append((rank, name))
+            return {"Redshift": 1.5, "PValue": rank}[name]
+
+    redshiftCoCandidates._missing_model_parameters.discard("galaxy")
+    for i in range(2):
+        output = Output()
+        rc = RedshiftCoCandidates(output, SimpleNamespace(get_spectrum_infos=dict), None, None)
+        with caplog.at_level(logging.INFO, logger="process_spectra"):
+            candidates = rc._get_candidates_data("galaxy", 2, ["Redshift", "PValue"])
+        assert candidates == {"Redshift": [0.5, 1.5], "PValue": [0, 1]}
+        assert output.requested == [(0, "PValue"), (1, "Redshift"), (1, "PValue")]
+    assert len([record for record in caplog.records if "model_parameters" in record.message]) == 1
+
+    # other errors are not hidden
+    rc = RedshiftCoCandidates(Output(KeyError("Redshift")), SimpleNamespace(get_spectrum_infos=dict), None, None)
+    with pytest.raises(KeyError):
+        rc._get_candidates_data("galaxy", 2, ["Redshift", "PValue"])
+
+
+def test_get_lines():
+    """
+    Check linemeas frames are computed once per spectrum and follow a replaced line catalog
+    """
+    class Output:
+        nb_calls = 0
+        def get_dataset(self, object_type, dataset):
+            self.nb_calls += 1
+            return {"LinemeasLineID": [1, 2, 3], "LinemeasLineLambda": [6563., 0., 4861.]}
+
+    def get_names(names):
+        catalog = pd.DataFrame({"Name": names, "WaveLength": [6563., 5007., 4861.]}, index=[1, 2, 3])
+        calibration_library = SimpleNamespace(line_catalogs_df={"galaxy": {"lineMeasSolve": catalog}})
+        output = Output()
+        rc = RedshiftCoCandidates(output, SimpleNamespace(get_spectrum_infos=dict), None, calibration_library)
+        lines = rc._get_lines("galaxy")
+        assert rc._get_lines("galaxy") is lines
+        assert output.nb_calls == 1
+        return list(lines["Name"])
+
+    nb_catalogs = len(redshiftCoCandidates._line_catalogs)
+    assert get_names(["Halpha", "OIII", "Hbeta"]) == ["Halpha", "Hbeta"]
+    # catalogs replaced, their id may be reused
+    for i in range(10):
+        assert get_names([f"Ha{i}", "OIII", f"Hb{i}"]) == [f"Ha{i}", f"Hb{i}"]
+    # projections are dropped with their catalog
+    assert len(redshiftCoCandidates._line_catalogs) == nb_catalogs
+
+
+def test_journal_recovery(monkeypatch):
+    """
+    Check journaled records are synced, survive a truncated entry and are
+    recovered into a copy of the empty layout
+    """
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fsync(fd)))
+    wd = tempfile.TemporaryDirectory()
+    data_dir = os.path.join(wd.name, "data")
+    os.makedirs(data_dir)
+    path = os.path.join(data_dir, "pfsCoZcandidates-test.fits")
+    _write_shard(path, 0, 0)
+    os.makedirs(os.path.join(wd.name, "layout"))
+    _write_shard(os.path.join(wd.name, "layout", "pfsCoZcandidates-test.fits"), 0, 0)
+    for bunch_id, sizes in enumerate([[1, 2], [1]]):
+        bunch_dir = os.path.join(wd.name, f"B{bunch_id}")
+        os.makedirs(bunch_dir)
+        journal_path = os.path.join(bunch_dir, "coZcandidates.journal")
+        journal = Journal(journal_path)
+        writer = JournaledWriter(CoZcandidatesWriter(path, flush_size=10), journal)
+        nb_synced = len(synced)
+        for nb_targets in sizes:
+            writer.append(_record(nb_targets))
+        assert len(synced) == nb_synced + len(sizes)
+        journal.close()
+    size = os.path.getsize(journal_path)
+    # a crash while writing an entry
+    with open(journal_path, "ab") as f:
+        f.write(b"\x10\x00")
+    assert len(list(read_journal(journal_path))) == 1
+    Journal(journal_path).close()
+    assert os.path.getsize(journal_path) == size
+    # a crash while writing the data file
+    with open(path, "r+b") as f:
+        f.truncate(4000)
+    assert recover_output(wd.name) == {0: 2, 1: 1}
+    assert not os.path.exists(path + ".tmp")
+    with fits.open(path) as hdulist:
+        assert list(hdulist["TARGET"].data["targetId"]) == [0, 1, 2, 3]
+        assert list(hdulist["TARGET"].data["objId"]) == [1, 2, 2, 1]
+        assert list(hdulist["GALAXY_CANDIDATES"].data["modelId"]) == list(range(8))
+
+
+def test_journaled_spectra():
+    """
+    Check journaled spectra are identified by their file, objIds being unique within a catId only
+    """
+    wd = tempfile.TemporaryDirectory()
+    journal_path = os.path.join(wd.name, "coZcandidates.journal")
+    journal = Journal(journal_path)
+    journal.append("pfsCoZcandidates-00001.fits", _record(2))
+    journal.append("pfsCoZcandidates-00002.fits", _record(1))
+    journal.close()
+    assert get_journaled_spectra(journal_path) == {("pfsCoZcandidates-00001.fits", 2),
+                                                   ("pfsCoZcandidates-00002.fits", 1)}
+
+
+def test_journal_unsafe_recovery():
+    """
+    Check recovery neither removes spectra missing from the journals nor
+    replays records of unknown files, and unwritten records are found
+    """
+    wd = tempfile.TemporaryDirectory()
+    data_dir = os.path.join(wd.name, "data")
+    os.makedirs(data_dir)
+    path = os.path.join(data_dir, "pfsCoZcandidates-test.fits")
+    _write_shard(path, 0, 0)
+    bunch_dir = os.path.join(wd.name, "B0")
+    os.makedirs(bunch_dir)
+    journal_path = os.path.join(bunch_dir, "coZcandidates.journal")
+    journal = Journal(journal_path)
+    writer = JournaledWriter(CoZcandidatesWriter(path, flush_size=10), journal)
+    writer.append(_record(1))
+    writer.flush()
+    # interrupted before the flush of this record
+    writer.append(_record(2))
+    assert [record["TARGET"]["objId"][0] for _, record in get_unwritten_records(journal_path, data_dir)] == [2]
+
+    # a spectrum written by a bunch without journal
+    unjournaled = CoZcandidatesWriter(path)
+    unjournaled.append(_record(3))
+    unjournaled.flush()
+    with pytest.raises(Exception, match="not journaled"):
+        recover_output(wd.name)
+    with fits.open(path) as hdulist:
+        assert list(hdulist["TARGET"].data["objId"]) == [1, 3, 3, 3]
+
+    journal.append("pfsCoZcandidates-unknown.fits", _record(1))
+    journal.close()
+    with pytest.raises(Exception, match="pfsCoZcandidates-unknown.fits"):
+        recover_output(wd.name)
+
+
+@pytest.mark.parametrize("writer_class", [CoZcandidatesWriter, H5CandidatesWriter])
+def test_journal_partly_written(writer_class):
+    """
+    Check records written to some HDUs only are written again, and rows of
+    unjournaled spectra following them are not removed
+    """
+    wd = tempfile.TemporaryDirectory()
+    path = os.path.join(wd.name, "pfsCoZcandidates-test.fits")
+    _write_shard(path, 0, 0)
+    journal_path = os.path.join(wd.name, "coZcandidates.journal")
+    journal = Journal(journal_path)
+    writer = JournaledWriter(writer_class(path, flush_size=10), journal)
+    for nb_targets in [1, 2]:
+        writer.append(_record(nb_targets))
+        writer.flush()
+    # a flush interrupted before writing the models of the second record
+    if writer_class is H5CandidatesWriter:
+        with h5py.File(get_columnar_path(path), "a") as f:
+            f["GALAXY_MODELS"].resize(3, axis=0)
+    else:
+        with fits.open(path, "update") as hdulist:
+            hdulist["GALAXY_MODELS"].data = hdulist["GALAXY_MODELS"].data[:3]
+    assert [record["TARGET"]["objId"][0] for _, record in get_unwritten_records(journal_path, wd.name)] == [2]
+    assert list(read_table(path, "TARGET")["objId"]) == [1]
+    assert list(read_table(path, "GALAXY_CANDIDATES")["modelId"]) == [0, 1]
+    writer = writer_class(path)
+    for _, record in get_unwritten_records(journal_path, wd.name):
+        writer.append(record)
+    writer.flush()
+    assert get_unwritten_records(journal_path, wd.name) == []
+    assert list(read_table(path, "TARGET")["objId"]) == [1, 2, 2]
+    if writer_class is H5CandidatesWriter:
+        with h5py.File(get_columnar_path(path), "r") as f:
+            assert len(f["GALAXY_MODELS"]) == 6
+    else:
+        assert fits.getheader(path, "GALAXY_MODELS")["NAXIS2"] == 6
+
+    # rows of a record written to TARGET only, then a spectrum of another bunch
+    record = _rows(1, 4)
+    journal.append(os.path.basename(path), record)
+    journal.close()
+    writer = writer_class(path)
+    writer.append({"TARGET": record["TARGET"]})
+    writer.append(_record(3))
+    writer.flush()
+    with pytest.raises(Exception, match="drp_1drecover"):
+        get_unwritten_records(journal_path, wd.name)
+    assert list(read_table(path, "TARGET")["objId"]) == [1, 2, 2, 4, 3, 3, 3]
+
+
+def test_columnar_output():
+    """
+    Check rows are appended to HDF5 datasets, read from there, and exported to the pfsCoZcandidates file
+    """
+    wd = tempfile.TemporaryDirectory()
+    paths = [os.path.join(wd.name, f"{i}.fits") for i in range(3)]
+    for path in paths:
+        _write_shard(path, 0, 0)
+    for path, sizes in zip(paths[1:], [[1, 2], [1]]):
+        writer = H5CandidatesWriter(path, flush_size=1)
+        nb_targets = 0
+        for size in sizes:
+            writer.append(_record(size))
+            writer.flush()
+            nb_targets += size
+            with h5py.File(get_columnar_path(path), "r") as f:
+                assert f["TARGET"].shape == (nb_targets,)
+                assert f["TARGET"].maxshape == (None,)
+        # the FITS file is only written by the export
+        assert _get_nb_targets(path) == 0
+    concatenate_columnar_files(paths[0], paths[1:])
+    targets = read_table(paths[0], 1, ["objId"])
+    assert list(targets.columns) == ["objId"]
+    assert list(targets["objId"]) == [1, 2, 2, 1]
+    assert list(read_table(paths[0], "GALAXY_CANDIDATES")["targetId"]) == [0, 0, 1, 1, 2, 2, 3, 3]
+    assert _get_nb_targets(paths[0]) == 0
+    export_fits(paths[0])
+    with fits.open(paths[0]) as hdulist:
+        assert list(hdulist["TARGET"].data["targetId"]) == [0, 1, 2, 3]
+        assert list(hdulist["TARGET"].data["objId"]) == [1, 2, 2, 1]
+        assert list(hdulist["GALAXY_CANDIDATES"].data["modelId"]) == list(range(8))
+        assert list(hdulist["GALAXY_MODELS"].data[:, 0]) == [1, 1, 2, 2, 2, 2, 1, 1]
+
+
+def test_export_columnar_files_twice():
+    """
+    Check exporting HDF5 results again, or after an interrupted merge, does not duplicate rows
+    """
+    wd = tempfile.TemporaryDirectory()
+    os.makedirs(os.path.join(wd.name, "data"))
+    os.makedirs(os.path.join(wd.name, "B0"))
+    path = os.path.join(wd.name, "data", "pfsCoZcandidates-00001.fits")
+    shard_path = os.path.join(wd.name, "B0", "pfsCoZcandidates-00001.fits")
+    _write_shard(path, 0, 0)
+    _write_shard(shard_path, 0, 0)
+    fits.setval(shard_path, "SHARDID", value="0" * 32)
+    writer = H5CandidatesWriter(shard_path)
+    writer.append(_record(2))
+    writer.flush()
+    with open(get_columnar_path(shard_path), "rb") as f:
+        shard = f.read()
+    export_columnar_files(wd.name, 1)
+    assert not os.path.exists(get_columnar_path(shard_path))
+    # interrupted before removing the shard
+    with open(get_columnar_path(shard_path), "wb") as f:
+        f.write(shard)
+    export_columnar_files(wd.name, 1)
+    assert not os.path.exists(get_columnar_path(shard_path))
+    # spectralists are removed once merged
+    export_columnar_files(wd.name, 0)
+    with fits.open(path) as hdulist:
+        assert len(hdulist["TARGET"].data) == 2
+        assert len(hdulist["GALAXY_CANDIDATES"].data) == 4
+        assert hdulist["GALAXY_MODELS"].data.shape == (4, 3)
+    with h5py.File(get_columnar_path(path), "r") as f:
+        assert f.attrs["merged"] == "0" * 32
+
+
+def test_write_behind(empty_file):
+    """
+    Check records are written by the write-behind thread while appending goes on, and synced on close
+    """
+    path = empty_file
+    release = threading.Event()
+    flushes = []
+    synced = []
+
+    def flush(writer):
+        release.wait(5)
+        flushes.append((threading.current_thread(), writer.nb_spectra))
+        writer.flush()
+
+    write_behind = WriteBehind(flush, 2)
+    inner = CoZcandidatesWriter(path, flush_size=2)
+    fsync = inner.fsync
+    inner.fsync = lambda: synced.append(fsync())
+    writer = WriteBehindWriter(inner, write_behind)
+    for nb_targets in [1, 2, 1]:
+        writer.append(_record(nb_targets))
+        assert not writer.need_flush()
+    # appended while the thread waits to write
+    assert not flushes and _get_nb_targets(path) == 0
+    release.set()
+    write_behind.close()
+    assert flushes == [(write_behind.thread, 2), (threading.current_thread(), 1)]
+    assert len(synced) == 1
+    with fits.open(path) as hdulist:
+        assert list(hdulist["TARGET"].data["objId"]) == [1, 2, 2, 1]
+        assert list(hdulist["GALAXY_CANDIDATES"].data["modelId"]) == list(range(8))
+
+
+def test_write_behind_error():
+    """
+    Check a failure of the write-behind thread is raised instead of blocking
+    """
+    class BrokenWriter:
+        path = "broken.fits"
+        def append(self, record):
+            pass
+        def need_flush(self):
+            raise ValueError("broken writer")
+        def fsync(self):
+            pass
+
+    write_behind = WriteBehind(lambda writer: None, 1)
+    write_behind.put(BrokenWriter(), {})
+    with pytest.raises(ValueError, match="broken writer"):
+        for _ in range(10):
+            write_behind.put(BrokenWriter(), {})
+            time.sleep(0.01)
+    with pytest.raises(ValueError, match="broken writer"):
+        write_behind.close()
+
+
+def test_probe_coadd_metadata():
+    """
+    Check coadd metadata are read from the TARGET table, headers and METADATA table
+    """
+    wd = tempfile.TemporaryDirectory()
+    path = os.path.join(wd.name, "pfsCoadd.fits")
+    target = np.zeros(2, dtype=[('targetId', '>i2'), ('catId', '>i4')])
+    target['catId'] = 10091
+    metadata = b"VERSION_DATAMODEL: 8.0\nVERSION_DRP_STELLA: 8.1\nVERSION_OBS_PFS: 8.2\n"
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.BinTableHDU(target, name="TARGET"),
+                  fits.ImageHDU(np.zeros((2, 12)), name="WAVELENGTH"),
+                  fits.BinTableHDU.from_columns([fits.Column(name="metadata", format=f"{len(metadata)}A",
+                                                             array=[metadata, metadata])],
+                                                name="METADATA")
+                  ]).writeto(path)
+    catId, versions, wl_size = probe_coadd_metadata(path)
+    assert (catId, wl_size) == (10091, 12)
+    assert versions == {"VERSION_DATAMODEL": 8.0, "VERSION_DRP_STELLA": 8.1, "VERSION_OBS_PFS": 8.2}
+
+
+def test_coadd_index():
+    """
+    Check the coadd index and the extraction of indexed spectra
+    """
+    wd = tempfile.TemporaryDirectory()
+    path = os.path.join(wd.name, "pfsCoadd.fits")
+    target = np.zeros(3, dtype=[('targetId', '>i4'), ('catId', '>i4'), ('objId', '>i8')])
+    target['targetId'] = [5, 6, 7]
+    target['catId'] = 1
+    target['objId'] = [30, 20, 10]
+    observations = np.zeros(4, dtype=[('targetId', '>i4'), ('visit', '>i4')])
+    observations['targetId'] = [5, 6, 6, 7]
+    observations['visit'] = [1, 2, 3, 4]
+    mask = np.zeros((3, 4), dtype=np.int32)
+    mask[1, :3] = 1
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.BinTableHDU(target, name="TARGET"),
+                  fits.BinTableHDU(observations, name="OBSERVATIONS"),
+                  fits.ImageHDU(np.arange(12.).reshape(3, 4), name="FLUX"),
+                  fits.ImageHDU(mask, name="MASK"),
+                  fits.BinTableHDU.from_columns([fits.Column(name="metadata", format="1A",
+                                                             array=[b"a", b"b", b"c"])],
+                                                name="METADATA")
+                  ]).writeto(path)
+    index_path = os.path.join(wd.name, "index.fits")
+    write_coadd_index(path, index_path)
+    index = read_coadd_index(index_path)
+    assert list(index["objId"]) == [30, 20, 10]
+    assert list(index["nVisit"]) == [1, 2, 1]
+    assert list(index["nValid"]) == [4, 1, 4]
+    assert list(find_coadd_rows(path, [10, 20, 40])) == [1, 2]
+    with fits.open(read_coadd_rows(path, [2, 1])) as subset:
+        assert list(subset["TARGET"].data["objId"]) == [20, 10]
+        assert list(subset["OBSERVATIONS"].data["visit"]) == [2, 3, 4]
+        assert subset["FLUX"].data[:, 0].tolist() == [4., 8.]
+        assert list(subset["METADATA"].data["metadata"]) == ["b", "c"]
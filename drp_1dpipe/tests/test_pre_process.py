@@ -5,11 +5,13 @@ import collections
 import tempfile
 import types
 import glob
+import numpy as np
+from astropy.io import fits
 
 from drp_1dpipe.core.utils import normpath, config_update
 from drp_1dpipe.core.config import Config
 
-from drp_1dpipe.pre_process.pre_process import main_method
+from drp_1dpipe.pre_process.pre_process import main_method, pre_process, list_coadd_files, bunch_objects
 from drp_1dpipe.pre_process.config import config_defaults
 
 
@@ -51,3 +53,51 @@ def test_main_method():
     
 
 
+
+
+def _write_coadd(path, object_ids, catId):
+    target = np.zeros(len(object_ids), dtype=[('targetId', '>i4'), ('catId', '>i4'), ('objId', '>i8')])
+    target['targetId'] = np.arange(len(object_ids))
+    target['catId'] = catId
+    target['objId'] = object_ids
+    observations = np.zeros(len(object_ids), dtype=[('targetId', '>i4'), ('visit', '>i4')])
+    observations['targetId'] = target['targetId']
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.BinTableHDU(target, name="TARGET"),
+                  fits.BinTableHDU(observations, name="OBSERVATIONS"),
+                  fits.ImageHDU(np.zeros((len(object_ids), 4), dtype=np.int32), name="MASK")
+                  ]).writeto(path)
+
+
+def test_bunch_objects():
+    objects = [(0, 1), (0, 2), (1, 3), (1, 4), (1, 5)]
+    assert list(bunch_objects(2, objects, 1)) == [[(0, 1), (0, 2)], [(1, 3), (1, 4)], [(1, 5)]]
+
+
+def test_pre_process_campaign(mocker):
+    """
+    Check bunches are built across the input files of a campaign
+    """
+    wd = tempfile.TemporaryDirectory()
+    _write_coadd(os.path.join(wd.name, "pfsCoadd-1.fits"), [10, 11, 12], 1)
+    _write_coadd(os.path.join(wd.name, "pfsCoadd-2.fits"), [20, 21], 2)
+    with open(os.path.join(wd.name, "coadd_list.txt"), "w") as f:
+        f.write("pfsCoadd-2.fits\npfsCoadd-*.fits\n")
+    coadd_files = list_coadd_files("", "coadd_list.txt", wd.name)
+    assert [os.path.basename(path) for path in coadd_files] == ["pfsCoadd-2.fits", "pfsCoadd-1.fits"]
+
+    init_output = mocker.patch("drp_1dpipe.pre_process.pre_process.init_output")
+    config = Config(config_defaults)
+    config.workdir = wd.name
+    config.logdir = wd.name
+    config.output_dir = wd.name
+    config.coadd_file = os.path.join(wd.name, "pfsCoadd-*.fits")
+    config.bunch_size = 2
+    config.concurrency = 1
+    assert pre_process(config) == 3
+    assert init_output.call_args[0][-1] == [[1], [2]]
+    with open(os.path.join(wd.name, "spectralist_B1.json")) as f:
+        bunch = json.load(f)
+    assert [(os.path.basename(bunch_file["coadd_file"]), bunch_file["objIdList"])
+            for bunch_file in bunch["files"]] == [("pfsCoadd-1.fits", [12]), ("pfsCoadd-2.fits", [20])]
+    assert os.path.isfile(bunch["files"][1]["coadd_index"])
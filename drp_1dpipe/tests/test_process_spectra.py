@@ -10,6 +10,7 @@ from drp_1dpipe.core.utils import normpath, config_update
 from drp_1dpipe.core.config import Config
 
 from drp_1dpipe.process_spectra.process_spectra import main_method
+from drp_1dpipe.process_spectra.prescreen import PreScreen, RejectedOutput
 from drp_1dpipe.pre_process.config import config_defaults
 
 
@@ -47,6 +48,36 @@ def test_main_method():
     assert os.path.exists(logpath_amazed)
 
 
+
+class FakeSpectrum:
+    def __init__(self, flux, mask, target_type=1):
+        self.flux = np.array(flux)
+        self.mask = np.array(mask)
+        self.target_type = target_type
+    def get_spectrum_infos(self):
+        return {"targetType": self.target_type}
+    def get_flux(self, filtered_only=True):
+        return self.flux
+    def get_error(self, filtered_only=True):
+        return np.ones(len(self.flux))
+    def get_others(self, filtered_only=True):
+        return {"mask": self.mask}
+
+
+def test_prescreen():
+    """
+    Check unusable spectra are rejected before processing
+    """
+    prescreen = PreScreen(0.5, "2")
+    assert prescreen.reject(FakeSpectrum([1., 2., 3., 4.], [0, 0, 0, 1])) == ""
+    assert prescreen.reject(FakeSpectrum([1., np.nan, np.nan, 4.], [0, 0, 0, 1]))
+    assert prescreen.reject(FakeSpectrum([1., 2., 3., 4.], [0, 0, 0, 0], target_type=2))
+    assert prescreen.nb_rejected == 2
+    output = RejectedOutput("rejected")
+    assert output.has_error("galaxy", "redshiftSolver")
+    assert output.get_error(None, "init") == {"code": "PRESCREEN_REJECTED", "message": "rejected"}
+    assert output.get_attribute(None, "init_warningFlag", "InitWarningFlags") == 0
+
 # @pytest.fixture()
 # def context():
 #     pass